@@ -2,8 +2,21 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 
+# Java classes of the fields whose values are given to the JVM as the text
+# written by the CSV generators (java.lang.Object fields as the translations
+# in language~value|language~value form), whatever the data format.
+TEXT_CLASSES = ('java.lang.String', 'java.lang.Object')
+
 
 class AbstractDataGenerator:
+    # Workspace whose quota is checked while generate() writes fileName
+    workspace = None
+    fileName = None
+
     # Simple function all DataGenerators should implement
     def generate(self, fileName):
         pass
+
+    def checkQuota(self):
+        if self.workspace:
+            self.workspace.checkQuota(self.fileName)
@@ -0,0 +1,73 @@
+# This file is part jasper_reports module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import threading
+from contextlib import contextmanager
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+PRIORITIES = (INTERACTIVE, BATCH)
+
+
+class AdmissionController:
+    """
+    Limits the number of concurrent executions in the JasperServer process
+    (limit, 0 means unlimited) and the number of them used by batch work
+    (batchLimit, 0 means up to limit).
+
+    When a slot is freed, waiting interactive executions are admitted before
+    any batch one so a large batch does not delay single prints.
+    """
+
+    def __init__(self, limit=0, batchLimit=0):
+        self.limit = limit
+        self.batchLimit = batchLimit
+        self.condition = threading.Condition()
+        self.active = dict.fromkeys(PRIORITIES, 0)
+        self.waiting = dict.fromkeys(PRIORITIES, 0)
+
+    def admissible(self, priority):
+        if self.limit and sum(self.active.values()) >= self.limit:
+            return False
+        if priority == BATCH:
+            if self.waiting[INTERACTIVE]:
+                return False
+            if self.batchLimit and self.active[BATCH] >= self.batchLimit:
+                return False
+        return True
+
+    def acquire(self, priority=INTERACTIVE):
+        if priority not in PRIORITIES:
+            priority = INTERACTIVE
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while not self.admissible(priority):
+                    self.condition.wait()
+            finally:
+                self.waiting[priority] -= 1
+            self.active[priority] += 1
+        return priority
+
+    def release(self, priority):
+        with self.condition:
+            self.active[priority] -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, priority=INTERACTIVE):
+        priority = self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def queueDepth(self):
+        """
+        Return the number of waiting and running executions by priority.
+        """
+        with self.condition:
+            return {
+                'waiting': dict(self.waiting),
+                'active': dict(self.active),
+                }
@@ -0,0 +1,199 @@
+# This file is part jasper_reports module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+
+# Compact typed format shared with com.nantic.jasperreports.BinaryCodec.
+#
+# A data file starts with MAGIC, the format VERSION and the column names.
+# Each row is introduced by a ROW byte followed by one typed value per column
+# and the file is terminated by an END byte. Every value is a tag byte
+# followed by its payload, all numbers are big endian.
+
+import struct
+import datetime
+from decimal import Decimal
+
+MAGIC = b'TJRB'
+VERSION = 1
+
+END = 0
+ROW = 1
+
+TAG_NULL = 0
+TAG_STRING = 1
+TAG_LONG = 2
+TAG_DOUBLE = 3
+TAG_DECIMAL = 4
+TAG_DATE = 5
+TAG_DATETIME = 6
+TAG_BOOLEAN = 7
+TAG_MAP = 8
+TAG_LIST = 9
+
+_byte = struct.Struct('>B')
+_int = struct.Struct('>i')
+_long = struct.Struct('>q')
+_double = struct.Struct('>d')
+_date = struct.Struct('>BhBB')
+_datetime = struct.Struct('>BhBBBBBi')
+
+LONG_MIN = -2 ** 63
+LONG_MAX = 2 ** 63 - 1
+
+
+def encodeString(buffer, value):
+    value = value.encode('utf-8')
+    buffer += _int.pack(len(value))
+    buffer += value
+
+
+def encodeValue(buffer, value):
+    """
+    Append the tagged representation of value to the buffer (a bytearray).
+    Values without a native encoding are sent as their str().
+    """
+    if value is None:
+        buffer += _byte.pack(TAG_NULL)
+    elif isinstance(value, str):
+        buffer += _byte.pack(TAG_STRING)
+        encodeString(buffer, value)
+    elif isinstance(value, bool):
+        buffer += _byte.pack(TAG_BOOLEAN)
+        buffer += _byte.pack(1 if value else 0)
+    elif isinstance(value, int):
+        if LONG_MIN <= value <= LONG_MAX:
+            buffer += _byte.pack(TAG_LONG)
+            buffer += _long.pack(value)
+        else:
+            encodeDecimal(buffer, Decimal(value))
+    elif isinstance(value, float):
+        buffer += _byte.pack(TAG_DOUBLE)
+        buffer += _double.pack(value)
+    elif isinstance(value, Decimal):
+        if value.is_finite():
+            encodeDecimal(buffer, value)
+        else:
+            buffer += _byte.pack(TAG_STRING)
+            encodeString(buffer, str(value))
+    elif isinstance(value, datetime.datetime):
+        buffer += _datetime.pack(TAG_DATETIME, value.year, value.month,
+            value.day, value.hour, value.minute, value.second,
+            value.microsecond)
+    elif isinstance(value, datetime.date):
+        buffer += _date.pack(TAG_DATE, value.year, value.month, value.day)
+    elif isinstance(value, dict):
+        buffer += _byte.pack(TAG_MAP)
+        buffer += _int.pack(len(value))
+        for key, item in value.items():
+            encodeString(buffer, str(key))
+            encodeValue(buffer, item)
+    elif isinstance(value, (list, tuple)):
+        buffer += _byte.pack(TAG_LIST)
+        buffer += _int.pack(len(value))
+        for item in value:
+            encodeValue(buffer, item)
+    else:
+        buffer += _byte.pack(TAG_STRING)
+        encodeString(buffer, str(value))
+
+
+def encodeDecimal(buffer, value):
+    # Sent as the scale and the two's complement bytes of the unscaled value
+    # so the JVM can build a BigDecimal without any parsing.
+    sign, digits, exponent = value.as_tuple()
+    unscaled = int(''.join(map(str, digits)) or '0')
+    if sign:
+        unscaled = -unscaled
+    if exponent > 0:
+        unscaled *= 10 ** exponent
+        exponent = 0
+    data = unscaled.to_bytes(unscaled.bit_length() // 8 + 1, 'big',
+        signed=True)
+    buffer += _byte.pack(TAG_DECIMAL)
+    buffer += _int.pack(-exponent)
+    buffer += _int.pack(len(data))
+    buffer += data
+
+
+def decodeString(data, offset):
+    size, = _int.unpack_from(data, offset)
+    offset += _int.size
+    return data[offset:offset + size].decode('utf-8'), offset + size
+
+
+def decodeValue(data, offset=0):
+    """
+    Return the value encoded at offset of data and the offset that follows
+    it.
+    """
+    tag = data[offset]
+    offset += 1
+    if tag == TAG_NULL:
+        return None, offset
+    elif tag == TAG_STRING:
+        return decodeString(data, offset)
+    elif tag == TAG_LONG:
+        return _long.unpack_from(data, offset)[0], offset + _long.size
+    elif tag == TAG_DOUBLE:
+        return _double.unpack_from(data, offset)[0], offset + _double.size
+    elif tag == TAG_DECIMAL:
+        scale, size = struct.unpack_from('>ii', data, offset)
+        offset += 8
+        unscaled = int.from_bytes(data[offset:offset + size], 'big',
+            signed=True)
+        return Decimal(unscaled).scaleb(-scale), offset + size
+    elif tag == TAG_DATE:
+        year, month, day = _date.unpack_from(data, offset - 1)[1:]
+        return datetime.date(year, month, day), offset + _date.size - 1
+    elif tag == TAG_DATETIME:
+        values = _datetime.unpack_from(data, offset - 1)[1:]
+        return datetime.datetime(*values), offset + _datetime.size - 1
+    elif tag == TAG_BOOLEAN:
+        return data[offset] != 0, offset + 1
+    elif tag == TAG_MAP:
+        size, = _int.unpack_from(data, offset)
+        offset += _int.size
+        value = {}
+        for i in range(size):
+            key, offset = decodeString(data, offset)
+            value[key], offset = decodeValue(data, offset)
+        return value, offset
+    elif tag == TAG_LIST:
+        size, = _int.unpack_from(data, offset)
+        offset += _int.size
+        value = []
+        for i in range(size):
+            item, offset = decodeValue(data, offset)
+            value.append(item)
+        return value, offset
+    raise ValueError('Unknown value tag %d' % tag)
+
+
+class BinaryDataWriter:
+    """
+    Writes rows of typed values in the binary data format. It follows the
+    csv.DictWriter interface so generators can use both interchangeably.
+    """
+
+    def __init__(self, f, fieldNames):
+        self.file = f
+        self.fieldNames = fieldNames
+        buffer = bytearray(MAGIC)
+        buffer += _byte.pack(VERSION)
+        buffer += _int.pack(len(fieldNames))
+        for name in fieldNames:
+            encodeString(buffer, name)
+        self.file.write(buffer)
+
+    def writerow(self, row):
+        buffer = bytearray(_byte.pack(ROW))
+        for name in self.fieldNames:
+            encodeValue(buffer, row.get(name))
+        self.file.write(buffer)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        self.file.write(_byte.pack(END))
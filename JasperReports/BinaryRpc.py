@@ -0,0 +1,109 @@
+# This file is part jasper_reports module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+
+# Client of com.nantic.jasperreports.BinaryRpcServer.
+#
+# Each frame is a 4 byte big endian length followed by a BinaryCodec value.
+# Requests are a list with the method name and the list of arguments,
+# responses a list with OK and the result or FAULT, a fault code and a fault
+# string.
+
+import socket
+import struct
+import threading
+import xmlrpc.client
+
+from .BinaryCodec import encodeValue, decodeValue
+
+OK = 0
+FAULT = 1
+
+_length = struct.Struct('>i')
+
+
+class _Method:
+    # Supports "nested" methods (e.g. Report.execute) like xmlrpc.client
+    def __init__(self, send, name):
+        self._send = send
+        self._name = name
+
+    def __getattr__(self, name):
+        return _Method(self._send, '%s.%s' % (self._name, name))
+
+    def __call__(self, *args):
+        return self._send(self._name, args)
+
+
+class BinaryRpcProxy:
+    """
+    Calls the methods of the JasperServer process through its Unix domain
+    socket with the same interface as xmlrpc.client.ServerProxy. Each thread
+    keeps its connection open between calls and opens a new one if the
+    process closed it. Faults are raised as xmlrpc.client.Fault and
+    connection problems as socket.error so callers handle both transports the
+    same way.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _Method(self._request, name)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                connection.connect(self.path)
+            except socket.error:
+                connection.close()
+                raise
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self._local.connection = None
+            connection.close()
+
+    def _request(self, method, args):
+        request = bytearray(_length.size)
+        encodeValue(request, [method, list(args)])
+        _length.pack_into(request, 0, len(request) - _length.size)
+        reused = getattr(self._local, 'connection', None) is not None
+        connection = self._connection()
+        try:
+            connection.sendall(request)
+            size, = _length.unpack(self._receive(connection, _length.size))
+            response = self._receive(connection, size)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close()
+            if not reused:
+                raise
+            # The process closes connections waiting for a request when it
+            # needs room for new ones, so it is sent on a new connection
+            return self._request(method, args)
+        except socket.error:
+            # The connection can not be reused after a partial exchange
+            self.close()
+            raise
+        response, _ = decodeValue(response)
+        if response[0] == FAULT:
+            raise xmlrpc.client.Fault(response[1], response[2])
+        return response[1]
+
+    @staticmethod
+    def _receive(connection, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = connection.recv(min(size - len(data), 65536))
+            if not chunk:
+                raise ConnectionResetError('Connection closed by JasperServer')
+            data += chunk
+        return bytes(data)
@@ -6,45 +6,148 @@ import os
 import csv
 import tempfile
 
-from .AbstractDataGenerator import AbstractDataGenerator
+from .AbstractDataGenerator import AbstractDataGenerator, TEXT_CLASSES
+from .BinaryCodec import BinaryDataWriter
+from .XmlDataWriter import XmlDataWriter
 
 from trytond.model import Model
 from trytond.pool import Pool
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
 
 import logging
 
+# Maximum number of serialised column segments kept in a BrowseDataCache
+SEGMENT_CACHE_SIZE = 10000
+# Rows written between two checks of the workspace quota
+QUOTA_CHECK_ROWS = 1000
+
+
+class JoinedRecord:
+    """
+    One row of the LEFT JOIN built by generateIds: the record joined for a
+    path plus the row it extends. Rows sharing a prefix of the join share
+    its JoinedRecord instances instead of copying a dict per combination.
+    """
+    __slots__ = ('parent', 'path', 'record')
+
+    def __init__(self, parent, path, record):
+        self.parent = parent
+        self.path = path
+        self.record = record
+
+    def get(self, path):
+        joined = self
+        while joined is not None:
+            if joined.path == path:
+                return joined.record
+            joined = joined.parent
+        return None
+
+    def joinedUnder(self, path):
+        "Return the (path, id) of the records joined below the given path"
+        prefix = path + '/'
+        result = []
+        joined = self
+        while joined is not None:
+            if joined.path.startswith(prefix):
+                result.append((joined.path, joined.record.id))
+            joined = joined.parent
+        return tuple(result)
+
+
+class BrowseDataCache:
+    """
+    Data shared by all the generators of a render: the browsed records (and
+    so the values already read through them), the translations, the image
+    files and the serialised segments. Subreports browsing the same ids as
+    the main report reuse what it already loaded.
+    """
+    def __init__(self, workspace=None):
+        # Where image files are written and whose quota is checked while
+        # writing, the system temporary directory if None
+        self.workspace = workspace
+        self.directory = workspace.path if workspace else None
+        self.records = {}
+        self.languages = []
+        self.translations = {}
+        self.imageFiles = {}
+        self.temporary_files = []
+        self.segments = {}
+        self._attachments = {}
+
+    def browse(self, model, ids):
+        key = (model, tuple(ids))
+        if key not in self.records:
+            self.records[key] = Pool().get(model).browse(ids)
+        return self.records[key]
+
+    def attachments(self, record):
+        """
+        Return the attachments of the record. Those of all the records
+        browsed together with it are fetched by the same search.
+        """
+        resource = str(record)
+        if resource not in self._attachments:
+            Attachment = Pool().get('ir.attachment')
+            ids = getattr(record, '_ids', None) or [record.id]
+            resources = ['%s,%s' % (record.__name__, id) for id in ids]
+            resources = [x for x in resources if x not in self._attachments]
+            if resource not in resources:
+                resources.append(resource)
+            for name in resources:
+                self._attachments[name] = []
+            for sub_resources in grouped_slice(resources):
+                for attachment in Attachment.search([
+                            ('resource', 'in', list(sub_resources)),
+                            ]):
+                    self._attachments[str(attachment.resource)].append(
+                        attachment)
+        return self._attachments[resource]
+
 
 class BrowseDataGenerator(AbstractDataGenerator):
-    def __init__(self, report, model, ids):
+    def __init__(self, report, model, ids, cache=None, maxRows=0):
         self.report = report
         self.model = model
         self.ids = ids
-        self._languages = []
-        self.imageFiles = {}
-        self.temporary_files = []
+        # Rows after which generation stops (0 means all of them)
+        self.maxRows = maxRows
+        # Records of ids whose rows were generated
+        self.rootCount = 0
+        if cache is None:
+            cache = BrowseDataCache()
+        self.cache = cache
+        self.imageFiles = cache.imageFiles
+        self.temporary_files = cache.temporary_files
+        self.workspace = cache.workspace
+        self.directory = cache.directory
+        self.segments = cache.segments
+        self.rowCount = 0
         self.logger = logging.getLogger('jasper_reports')
 
     def warning(self, message):
         self.logger.warning(message)
 
     def languages(self):
-        if self._languages:
-            return self._languages
+        if self.cache.languages:
+            return self.cache.languages
         pool = Pool()
         ids = pool.get('ir.lang').search([('translatable', '=', '1')])
-        self._languages = [x.code for x in pool.get('ir.lang').browse(ids)]
-        return self._languages
+        self.cache.languages = [x.code
+            for x in pool.get('ir.lang').browse(ids)]
+        return self.cache.languages
 
     def valueInAllLanguages(self, model, id, field):
+        key = (model.__name__, id, field)
+        if key in self.cache.translations:
+            return self.cache.translations[key]
         values = {}
         for language in self.languages():
             with Transaction().set_context(language=(language or 'en')):
                 values[language] = model.read([id], [field])[0][field] or ''
-        result = []
-        for key, value in values.items():
-            result.append('%s~%s' % (key, value))
-        return '|'.join(result)
+        self.cache.translations[key] = values
+        return values
 
     def generateIds(self, record, relations, path, currentRecords):
         pool = Pool()
@@ -56,9 +159,7 @@ class BrowseDataGenerator(AbstractDataGenerator):
             else:
                 currentPath = root
             if root == 'Attachments':
-                value = pool.get('ir.attachment').search([
-                        ('resource', '=', str(record)),
-                        ])
+                value = self.cache.attachments(record)
             elif root == 'User':
                 value = pool.get('res.user').browse([Transaction().user])
             else:
@@ -84,17 +185,13 @@ class BrowseDataGenerator(AbstractDataGenerator):
             # If we wanted an INNER JOIN we wouldn't check for "value" and
             # return an empty currentRecords
             if value:
-                # Only
+                relations2 = [f.partition('/')[2] for f in relations
+                        if f.partition('/')[0] == root and
+                        f.partition('/')[2]]
                 newRecords = []
                 for v in value:
-                    currentNewRecords = []
-                    for id in currentRecords:
-                        new = id.copy()
-                        new[currentPath] = v
-                        currentNewRecords.append(new)
-                    relations2 = [f.partition('/')[2] for f in relations
-                            if f.partition('/')[0] == root and
-                            f.partition('/')[2]]
+                    currentNewRecords = [JoinedRecord(id, currentPath, v)
+                        for id in currentRecords]
                     newRecords += self.generateIds(v, relations2, currentPath,
                             currentNewRecords)
 
@@ -108,27 +205,41 @@ class CsvBrowseDataGenerator(BrowseDataGenerator):
     # record will be created for each model id we've been asked to show. If
     # there are any elements in the TRYTON_RELATIONS list, they will imply a
     # LEFT JOIN like behaviour on the rows to be shown.
-    def generate(self, fileName):
-        pool = Pool()
-
-        self.allRecords = []
+    def generateRows(self):
         relations = self.report.relations()
-        # The following loop generates one entry to allRecords list for each
-        # record that will be created. If there are any relations it acts like
-        # a LEFT JOIN against the main model/table.
-        for record in pool.get(self.model).browse(self.ids):
-            newRecords = self.generateIds(record, relations, '', [{
-                    'root': record
-                    }])
+        fields = self.report.fields()
+        self.rowCount = 0
+        self.rootCount = 0
+        # The following loop generates one row for each record that will be
+        # created. If there are any relations it acts like a LEFT JOIN
+        # against the main model/table. Rows are written as soon as the joins
+        # of each main record are known so they are never all in memory.
+        for record in self.cache.browse(self.model, self.ids):
+            if self.maxRows and self.rowCount >= self.maxRows:
+                return
+            self.rootCount += 1
+            newRecords = self.generateIds(record, relations, '', [
+                    JoinedRecord(None, 'root', record)])
             copies = 1
             if self.report.copiesField() and hasattr(record,
                     self.report.copiesField()):
                 copies = int(getattr(record, self.report.copiesField()))
-            for new in newRecords:
+            for records in newRecords:
+                # Copies are the same row so it is only serialised once
+                row = {}
+                self.generateCsvRecord(records.get('root'), records, row, '',
+                    fields)
                 for x in range(copies):
-                    self.allRecords.append(new)
+                    if self.maxRows and self.rowCount >= self.maxRows:
+                        return
+                    if not self.rowCount % QUOTA_CHECK_ROWS:
+                        self.checkQuota()
+                    self.rowCount += 1
+                    yield row
 
-        f = open(fileName, 'w+', encoding='utf-8')
+    def generate(self, fileName):
+        self.fileName = fileName
+        f = open(fileName, 'w', encoding='utf-8')
         try:
             csv.QUOTE_ALL = True
             # JasperReports CSV reader requires an extra colon at the end of
@@ -139,19 +250,13 @@ class CsvBrowseDataGenerator(BrowseDataGenerator):
             for field in self.report.fieldNames() + ['']:
                 header[field] = field
             writer.writerow(header)
-            # Once all records have been calculated, create the CSV structure
-            # itself
-            for records in self.allRecords:
-                row = {}
-                self.generateCsvRecord(records['root'], records, row, '',
-                        self.report.fields())
+            for row in self.generateRows():
                 writer.writerow(row)
         finally:
             f.close()
 
     def generateCsvRecord(self, record, records, row, path, fields):
         pool = Pool()
-        Attachment = pool.get('ir.attachment')
         User = pool.get('res.user')
 
         # One field (many2one, many2many or one2many) can appear several times.
@@ -166,9 +271,7 @@ class CsvBrowseDataGenerator(BrowseDataGenerator):
             else:
                 currentPath = root
             if root == 'Attachments':
-                value = Attachment.search([
-                        ('resource', '=', str(record)),
-                        ])
+                value = self.cache.attachments(record)
             elif root == 'User':
                 value = User(Transaction().user)
             else:
@@ -186,7 +289,7 @@ class CsvBrowseDataGenerator(BrowseDataGenerator):
             if isinstance(value, Model):
                 fields2 = [f.partition('/')[2] for f in fields if
                         f.partition('/')[0] == root]
-                self.generateCsvRecord(value, records, row, currentPath,
+                self.generateSegment(value, records, row, currentPath,
                         fields2)
                 continue
 
@@ -196,13 +299,14 @@ class CsvBrowseDataGenerator(BrowseDataGenerator):
                     continue
                 fields2 = [f.partition('/')[2] for f in fields
                         if f.partition('/')[0] == root]
-                if currentPath in records:
-                    self.generateCsvRecord(records[currentPath], records, row,
+                joined = records.get(currentPath)
+                if joined is not None:
+                    self.generateSegment(joined, records, row,
                             currentPath, fields2)
                 else:
                     # If the field is not marked to be iterated use the first
                     # record only
-                    self.generateCsvRecord(value[0], records, row,
+                    self.generateSegment(value[0], records, row,
                             currentPath, fields2)
                 continue
 
@@ -222,32 +326,107 @@ class CsvBrowseDataGenerator(BrowseDataGenerator):
             if type == 'java.lang.Object':
                 value = self.valueInAllLanguages(record, record.id, root)
 
-            # The rest of field types must be converted into str
-            if field == 'id':
-                # Check for field 'id' because we can't find it's
-                # type in _fields
-                value = str(value)
-            elif value is None:
-                value = ''
-            elif field_type == 'date':
-                value = '%s 00:00:00' % str(value)
-            elif field_type == 'binary':
-                imageId = (record.id, field)
-                if imageId in self.imageFiles:
-                    fileName = self.imageFiles[imageId]
-                else:
-                    fd, fileName = tempfile.mkstemp()
-                    try:
-                        os.write(fd, value)
-                    finally:
-                        os.close(fd)
-                    self.temporary_files.append(fileName)
-                    self.imageFiles[imageId] = fileName
-                value = fileName
-            elif field_type == 'timedelta':
-                value = value.total_seconds()
-            elif isinstance(value, float):
-                value = '%.10f' % value
-            elif not isinstance(value, str):
-                value = str(value)
+            value = self.formatValue(record, field, field_type, value, type)
             row[self.report.fields()[currentPath]['name']] = value
+
+    def generateSegment(self, record, records, row, path, fields):
+        # The columns of a related record only depend on it and on the
+        # records joined below its path so they are serialised once and
+        # reused by every row sharing them (e.g. the party of all the lines
+        # of an invoice).
+        key = (self.report, path, str(record), tuple(fields),
+            records.joinedUnder(path))
+        segment = self.segments.get(key)
+        if segment is None:
+            segment = {}
+            self.generateCsvRecord(record, records, segment, path, fields)
+            if len(self.segments) >= SEGMENT_CACHE_SIZE:
+                self.segments.clear()
+            self.segments[key] = segment
+        row.update(segment)
+
+    def formatValue(self, record, field, field_type, value, valueClass=None):
+        # The rest of field types must be converted into str
+        if field == 'id':
+            # Check for field 'id' because we can't find it's
+            # type in _fields
+            value = str(value)
+        elif value is None:
+            value = ''
+        elif isinstance(value, dict):
+            # Translations of a field as language~value|language~value
+            value = '|'.join('%s~%s' % x for x in value.items())
+        elif field_type == 'date':
+            value = '%s 00:00:00' % str(value)
+        elif field_type == 'binary':
+            value = self.imageFile(record, field, value)
+        elif field_type == 'timedelta':
+            value = value.total_seconds()
+        elif isinstance(value, float):
+            value = '%.10f' % value
+        elif not isinstance(value, str):
+            value = str(value)
+        return value
+
+    def imageFile(self, record, field, value):
+        imageId = (str(record), field)
+        if imageId in self.imageFiles:
+            return self.imageFiles[imageId]
+        if self.workspace:
+            fileName = self.workspace.file()
+            with open(fileName, 'wb') as f:
+                f.write(value)
+            self.workspace.checkQuota(fileName)
+        else:
+            fd, fileName = tempfile.mkstemp()
+            try:
+                os.write(fd, value)
+            finally:
+                os.close(fd)
+        self.temporary_files.append(fileName)
+        self.imageFiles[imageId] = fileName
+        return fileName
+
+
+class BinaryBrowseDataGenerator(CsvBrowseDataGenerator):
+    # Same rows as the CSV generator but written with their native types in
+    # the binary format read by BinaryMultiLanguageDataSource, which avoids
+    # formatting them here and parsing them again in the JVM. Values of the
+    # fields shown as text are the ones of the CSV generator.
+    def generate(self, fileName):
+        self.fileName = fileName
+        f = open(fileName, 'wb')
+        try:
+            writer = BinaryDataWriter(f, self.report.fieldNames())
+            for row in self.generateRows():
+                writer.writerow(row)
+            writer.close()
+        finally:
+            f.close()
+
+    def formatValue(self, record, field, field_type, value, valueClass=None):
+        if valueClass in TEXT_CLASSES:
+            return CsvBrowseDataGenerator.formatValue(self, record, field,
+                field_type, value)
+        if field_type == 'binary' and value is not None:
+            return self.imageFile(record, field, value)
+        elif field_type == 'timedelta' and value is not None:
+            return value.total_seconds()
+        return value
+
+
+class XmlBrowseDataGenerator(CsvBrowseDataGenerator):
+    # Same rows as the CSV generator written incrementally as XML for
+    # JRXmlDataSource.
+    def generate(self, fileName):
+        self.fileName = fileName
+        f = open(fileName, 'wb')
+        try:
+            writer = XmlDataWriter(f, self.report)
+            for row in self.generateRows():
+                writer.writerow(row)
+            writer.close()
+        finally:
+            f.close()
+
+    formatValue = BinaryBrowseDataGenerator.formatValue
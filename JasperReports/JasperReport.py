@@ -9,10 +9,21 @@ import logging
 from trytond.config import config
 
 dataSourceExpressionRegExp = re.compile(r"""\$P\{(\w+)\}""")
+moveFirstRegExp = re.compile(r"""\bmoveFirst\s*\(""")
 logger = logging.getLogger(__name__)
 
+NS = 'http://jasperreports.sourceforge.net/jasperreports'
+QUERY_STRING = '{%s}queryString' % NS
+PROPERTY = '{%s}property' % NS
+PARAMETER = '{%s}parameter' % NS
+FIELD = '{%s}field' % NS
+REPORT_ELEMENT = '{%s}reportElement' % NS
+SUBREPORT = '{%s}subreport' % NS
+DATASET_RUN = '{%s}datasetRun' % NS
+SUB_DATASET = '{%s}subDataset' % NS
+
 class JasperReport:
-    def __init__(self, fileName='', pathPrefix=''):
+    def __init__(self, fileName='', pathPrefix='', memo=None):
         self._reportPath = fileName
         self._pathPrefix = pathPrefix.strip()
         if self._pathPrefix and self._pathPrefix[-1] != '/':
@@ -22,10 +33,20 @@ class JasperReport:
         self._relations = []
         self._fields = {}
         self._fieldNames = []
+        self._parameters = []
         self._subreports = []
         self._datasets = []
         self._copiesField = False
         self._isHeader = False
+        self._rewindsDataSource = False
+        # Shared by all the subreports of a parse so each file is only read
+        # once and each (file, pathPrefix) view only built once.
+        if memo is None:
+            memo = {
+                'parsed': {},
+                'reports': {},
+                }
+        self._memo = memo
         if fileName:
             self.extractProperties()
 
@@ -38,6 +59,9 @@ class JasperReport:
     def fieldNames(self):
         return self._fieldNames
 
+    def parameters(self):
+        return self._parameters
+
     def subreports(self):
         return self._subreports
 
@@ -53,6 +77,14 @@ class JasperReport:
     def isHeader(self):
         return self._isHeader
 
+    def rewindsDataSource(self):
+        """
+        Return whether the main data source is read again from its start,
+        because a subreport or dataset calls moveFirst() on it, so it must be
+        a file.
+        """
+        return self._rewindsDataSource
+
     def subreportDirectory(self):
         return os.path.join(os.path.abspath(os.path.dirname(
             self._reportPath)), '')
@@ -75,7 +107,9 @@ class JasperReport:
             name = tag.get('name')
             type = tag.get('class')
             # children = tag.getchildren()
-            path = tag.findtext('{%s}fieldDescription' % ns, '').strip()
+            description = tag.findtext('{%s}fieldDescription' % ns,
+                '').strip()
+            path = description
             # Make the path relative if it isn't already
             if path.startswith('/data/record/'):
                 path = self._pathPrefix + path[13:]
@@ -96,60 +130,136 @@ class JasperReport:
             fields[path] = {
                 'name': name,
                 'type': type,
+                'description': description,
             }
             fieldNames.append(name)
         return fields, fieldNames
 
+    def parseRelations(self, value):
+        relation = value.strip()
+        if relation.startswith('['):
+            relations = eval(value)
+        else:
+            relations = [x.strip() for x in relation.split(',')]
+        return [self._pathPrefix + x for x in relations]
+
+    @staticmethod
+    def reportElementProperty(element, name):
+        """
+        Return the value of the given property of the reportElement child of
+        element or None.
+        """
+        if element is None:
+            return None
+        for reportElement in element.iterchildren(REPORT_ELEMENT):
+            for tag in reportElement.iterchildren(PROPERTY):
+                if tag.get('name') == name and 'value' in tag.keys():
+                    return tag.get('value')
+        return None
+
+    @staticmethod
+    def rewinds(element):
+        """
+        Return whether an expression of the subreport or dataset run element
+        calls moveFirst() on the main data source. Only passing it on is
+        fine, it is read forward.
+        """
+        for text in element.itertext():
+            if ('REPORT_DATA_SOURCE' in text
+                    and moveFirstRegExp.search(text)):
+                return True
+        return False
+
+    @staticmethod
+    def parse(fileName):
+        """
+        Collect in a single traversal of the jrxml file all the elements
+        extractProperties needs.
+        """
+        doc = etree.parse(fileName)
+        root = doc.getroot()
+        parsed = {
+            'queryString': None,
+            'properties': {},
+            'fields': [],
+            'parameters': [],
+            'reportElementProperties': {},
+            'subreports': [],
+            'datasetRuns': [],
+            'subDatasets': {},
+            'rewindsDataSource': False,
+            }
+        for element in root.iter(QUERY_STRING, PROPERTY, FIELD, PARAMETER,
+                SUBREPORT, DATASET_RUN, SUB_DATASET):
+            parent = element.getparent()
+            tag = element.tag
+            if tag == PROPERTY:
+                name = element.get('name')
+                if parent is root:
+                    properties = parsed['properties']
+                elif parent.tag == REPORT_ELEMENT:
+                    properties = parsed['reportElementProperties']
+                else:
+                    continue
+                # As with XPath queries, the first occurrence wins
+                if name not in properties and 'value' in element.keys():
+                    properties[name] = element.get('value')
+            elif tag == QUERY_STRING:
+                if parent is root and parsed['queryString'] is None:
+                    parsed['queryString'] = element
+            elif tag == FIELD:
+                if parent is root:
+                    parsed['fields'].append(element)
+            elif tag == PARAMETER:
+                if parent is root:
+                    parsed['parameters'].append(element.get('name'))
+            elif tag == SUBREPORT:
+                parsed['subreports'].append(element)
+                if JasperReport.rewinds(element):
+                    parsed['rewindsDataSource'] = True
+            elif tag == DATASET_RUN:
+                parsed['datasetRuns'].append(element)
+                if JasperReport.rewinds(element):
+                    parsed['rewindsDataSource'] = True
+            elif tag == SUB_DATASET:
+                parsed['subDatasets'].setdefault(element.get('name'),
+                    element)
+        return parsed
+
     def extractProperties(self):
         # The function will read all relevant information from the jrxml file
-        doc = etree.parse(self._reportPath)
-
-        # Define namespaces
-        ns = 'http://jasperreports.sourceforge.net/jasperreports'
-        nss = {'jr': ns}
+        parsed = self._memo['parsed'].get(self._reportPath)
+        if parsed is None:
+            parsed = self.parse(self._reportPath)
+            self._memo['parsed'][self._reportPath] = parsed
+        properties = parsed['properties']
 
         # Language
 
         # Note that if either queryString or language do not exist the default
         # (from the constructor) is XPath.
-        langTags = doc.xpath('/jr:jasperReport/jr:queryString', namespaces=nss)
-        if langTags:
-            if langTags[0].get('language'):
-                self._language = langTags[0].get('language').lower()
+        langTag = parsed['queryString']
+        if langTag is not None and langTag.get('language'):
+            self._language = langTag.get('language').lower()
 
         # Relations
-        relationTags = doc.xpath(
-            '/jr:jasperReport/jr:property[@name="TRYTON_RELATIONS"]',
-            namespaces=nss)
-        if relationTags and 'value' in relationTags[0].keys():
-            relation = relationTags[0].get('value').strip()
-            if relation.startswith('['):
-                self._relations = eval(relationTags[0].get('value'))
-            else:
-                self._relations = [x.strip() for x in relation.split(',')]
-            self._relations = [self._pathPrefix + x for x in self._relations]
+        if 'TRYTON_RELATIONS' in properties:
+            self._relations = self.parseRelations(
+                properties['TRYTON_RELATIONS'])
         if not self._relations and self._pathPrefix:
             self._relations = [self._pathPrefix[:-1]]
 
         # Repeat field
-        copiesFieldTags = doc.xpath(
-            '/jr:jasperReport/jr:property[@name="TRYTON_COPIES_FIELD"]',
-            namespaces=nss)
-        if copiesFieldTags and 'value' in copiesFieldTags[0].keys():
-            self._copiesField = self._pathPrefix + copiesFieldTags[0].get(
-                'value')
+        if 'TRYTON_COPIES_FIELD' in properties:
+            self._copiesField = (self._pathPrefix
+                + properties['TRYTON_COPIES_FIELD'])
 
-        self._isHeader = False
-        headerTags = doc.xpath(
-            '/jr:jasperReport/jr:property[@name="TRYTON_HEADER"]',
-            namespaces=nss)
-        if headerTags and 'value' in headerTags[0].keys():
-            self._isHeader = True
+        self._isHeader = 'TRYTON_HEADER' in properties
+        self._rewindsDataSource = parsed['rewindsDataSource']
 
-        fieldTags = doc.xpath(
-            '/jr:jasperReport/jr:field',
-            namespaces=nss)
-        self._fields, self._fieldNames = self.extractFields(fieldTags, ns)
+        self._fields, self._fieldNames = self.extractFields(parsed['fields'],
+            NS)
+        self._parameters = parsed['parameters']
 
         # Subreports
         # Here we expect the following structure in the .jrxml file:
@@ -160,10 +270,15 @@ class JasperReport:
         #           <![CDATA[$P{STANDARD_DIR} + "report_header.jasper"]]>
         #       </subreportExpression>
         # </subreport>
-        subreportTags = doc.xpath('//jr:subreport', namespaces=nss)
-        for tag in subreportTags:
+        #
+        # Model and path prefix are taken from the first reportElement
+        # defining them in the whole document.
+        model = parsed['reportElementProperties'].get('TRYTON_MODEL', '')
+        pathPrefix = parsed['reportElementProperties'].get(
+            'TRYTON_PATH_PREFIX', '')
+        for tag in parsed['subreports']:
             subreportExpression = tag.findtext(
-                '{%s}subreportExpression' % ns, '')
+                '{%s}subreportExpression' % NS, '')
             if not subreportExpression:
                 continue
             subreportExpression = subreportExpression.strip()
@@ -182,25 +297,6 @@ class JasperReport:
             if subreportExpression.endswith('.jasper'):
                 subreportExpression = subreportExpression[:-6] + 'jrxml'
 
-            # Model
-            model = ''
-            modelTags = tag.xpath(
-                '//jr:reportElement/jr:property[@name="TRYTON_MODEL"]',
-                namespaces=nss)
-            if modelTags and 'value' in modelTags[0].keys():
-                model = modelTags[0].get('value')
-
-            pathPrefix = ''
-            pathPrefixTags = tag.xpath(
-                '//jr:reportElement/jr:property[@name="TRYTON_PATH_PREFIX"]',
-                namespaces=nss)
-            if pathPrefixTags and 'value' in pathPrefixTags[0].keys():
-                pathPrefix = pathPrefixTags[0].get('value')
-
-            headerTags = tag.xpath(
-                '//jr:reportElement/jr:property[@name="TRYTON_HEADER"]',
-                namespaces=nss)
-
             # Add our own pathPrefix to subreport's pathPrefix
             subPrefix = []
             if self._pathPrefix:
@@ -210,7 +306,7 @@ class JasperReport:
             subPrefix = '/'.join(subPrefix)
 
             dataSourceExpression = tag.findtext(
-                '{%s}dataSourceExpression' % ns, '')
+                '{%s}dataSourceExpression' % NS, '')
             if dataSourceExpression:
                 dataSourceExpression = dataSourceExpression.strip()
                 m = dataSourceExpressionRegExp.match(dataSourceExpression)
@@ -218,7 +314,12 @@ class JasperReport:
                     continue
                 dataSourceExpression = m.group(1)
 
-            subreport = JasperReport(subreportExpression, subPrefix)
+            key = (subreportExpression, subPrefix)
+            subreport = self._memo['reports'].get(key)
+            if subreport is None:
+                subreport = JasperReport(subreportExpression, subPrefix,
+                    self._memo)
+                self._memo['reports'][key] = subreport
             self._subreports.append({
                 'parameter': dataSourceExpression,
                 'filename': subreportExpression,
@@ -228,7 +329,10 @@ class JasperReport:
                 'depth': 1,
             })
             for subsubInfo in subreport.subreports():
-                subsubInfo['depth'] += 1
+                # The subreport may be shared with other uses so its infos
+                # are copied instead of updated.
+                subsubInfo = subsubInfo.copy()
+                subsubInfo['depth'] = subsubInfo.get('depth', 0) + 1
                 # Note hat 'parameter' (the one used to pass report's
                 # DataSource) must be the same in all reports
                 self._subreports.append(subsubInfo)
@@ -238,12 +342,9 @@ class JasperReport:
         # <datasetRun>
         #  <dataSourceExpression><![CDATA[$P{REPORT_DATA_SOURCE}]]></dataSourceExpression>
         # </datasetRun>
-        datasetTags = doc.xpath(
-            '//jr:datasetRun',
-            namespaces=nss)
-        for tag in datasetTags:
+        for tag in parsed['datasetRuns']:
             dataSourceExpression = tag.findtext(
-                '{%s}dataSourceExpression' % ns, '')
+                '{%s}dataSourceExpression' % NS, '')
             if not dataSourceExpression:
                 continue
             dataSourceExpression = dataSourceExpression.strip()
@@ -257,64 +358,45 @@ class JasperReport:
             if not subDatasetName:
                 continue
 
+            # The reportElement is in the element containing the dataset
+            # run (../../jr:reportElement)
+            container = tag.getparent()
+            if container is not None:
+                container = container.getparent()
+
             # Relations
             relations = []
-            relationTags = tag.xpath(
-                '../../jr:reportElement/jr:property[@name="TRYTON_RELATIONS"]',
-                namespaces=nss)
+            relation = self.reportElementProperty(container,
+                'TRYTON_RELATIONS')
             # Add suport for crosstabs. (reportElement is one level upper)
-            if not relationTags:
-                relationTags = tag.xpath(
-                    '../../../jr:reportElement/jr:property'
-                    '[@name="TRYTON_RELATIONS"]',
-                    namespaces=nss)
-
-            if relationTags and 'value' in relationTags[0].keys():
-                relation = relationTags[0].get('value').strip()
-                if relation.startswith('['):
-                    relations = eval(relationTags[0].get('value'))
-                else:
-                    relations = [x.strip() for x in relation.split(',')]
-                relations = [self._pathPrefix + x for x in relations]
+            if relation is None and container is not None:
+                relation = self.reportElementProperty(container.getparent(),
+                    'TRYTON_RELATIONS')
+            if relation is not None:
+                relations = self.parseRelations(relation)
             if not relations and self._pathPrefix:
                 relations = [self._pathPrefix[:-1]]
 
             # Repeat field
-            copiesField = None
-            copiesFieldTags = tag.xpath(
-                '../../jr:reportElement/'
-                'jr:property[@name="TRYTON_COPIES_FIELD"]',
-                namespaces=nss)
-            if copiesFieldTags and 'value' in copiesFieldTags[0].keys():
-                copiesField = self._pathPrefix + copiesFieldTags[0].get(
-                    'value')
+            copiesField = self.reportElementProperty(container,
+                'TRYTON_COPIES_FIELD')
+            if copiesField is not None:
+                copiesField = self._pathPrefix + copiesField
 
             # Model
-            model = ''
-            modelTags = tag.xpath(
-                '../../jr:reportElement/jr:property[@name="TRYTON_MODEL"]',
-                namespaces=nss)
-            if modelTags and 'value' in modelTags[0].keys():
-                model = modelTags[0].get('value')
-
-            pathPrefix = ''
-            pathPrefixTags = tag.xpath(
-                '../../jr:reportElement/'
-                'jr:property[@name="TRYTON_PATH_PREFIX"]',
-                namespaces=nss)
-            if pathPrefixTags and 'value' in pathPrefixTags[0].keys():
-                pathPrefix = pathPrefixTags[0].get('value')
+            datasetModel = self.reportElementProperty(container,
+                'TRYTON_MODEL') or ''
+
+            datasetPathPrefix = self.reportElementProperty(container,
+                'TRYTON_PATH_PREFIX') or ''
 
             # We need to find the appropriate subDataset definition
             # for this dataset run.
-            subDatasets = doc.xpath(
-                '//jr:subDataset[@name="%s"]' % subDatasetName,
-                namespaces=nss)
-            if not subDatasets:
+            subDataset = parsed['subDatasets'].get(subDatasetName)
+            if subDataset is None:
                 continue
-            subDataset = subDatasets[0]
-            fieldTags = subDataset.xpath('jr:field', namespaces=nss)
-            fields, fieldNames = self.extractFields(fieldTags, ns)
+            fieldTags = subDataset.findall(FIELD)
+            fields, fieldNames = self.extractFields(fieldTags, NS)
 
             dataset = JasperReport()
             dataset._fields = fields
@@ -323,8 +405,8 @@ class JasperReport:
             dataset._copiesField = copiesField
             self._subreports.append({
                 'parameter': dataSourceExpression,
-                'model': model,
-                'pathPrefix': pathPrefix,
+                'model': datasetModel,
+                'pathPrefix': datasetPathPrefix,
                 'report': dataset,
                 'filename': 'DATASET',
             })
@@ -9,19 +9,64 @@ import socket
 import subprocess
 import xmlrpc.client
 import logging
+import tempfile
+import shlex
+import json
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from trytond.config import config
 from trytond.exceptions import UserWarning
 
+from .BinaryRpc import BinaryRpcProxy
+
+
+# Seconds to wait for the JasperServer process to accept connections
+START_TIMEOUT = 40
+# Main class of the JasperServer process, looked for in the command line of
+# the pid read from the pid file
+MAIN_CLASS = 'com.nantic.jasperreports.JasperServer'
+# Seconds to wait for the reports in progress before recycling the process
+DRAIN_TIMEOUT = 300
+# Fault code of calls to retry later (e.g. while the process is recycled or
+# overloaded)
+RETRY_LATER = 503
+# Seconds during which refused calls are retried, enough for a recycle to
+# drain the old process, stop it and start the new one
+RETRY_TIMEOUT = DRAIN_TIMEOUT + 2 * START_TIMEOUT
+
 
 class JasperServer(UserWarning):
     pid = None
+    # Callables receiving the stats of the process each time they are reported
+    metricsHooks = []
+    lastStats = 0
+    # Binary RPC proxies by socket path, shared so their connections are
+    # reused by all the reports of the process
+    binaryProxies = {}
 
-    def __init__(self, port=8090):
+    def __init__(self, port=8090, socketPath=None):
         self.port = port
         self.pidfile = None
+        self.jvmOptions = ''
+        self.recycleRenders = 0
+        self.recycleMemory = 0
+        self.maxFills = 0
+        self.queueSize = -1
+        self.statsInterval = 0
         url = 'http://localhost:%d' % port
         self.proxy = xmlrpc.client.ServerProxy(url, allow_none=True)
+        if not hasattr(socket, 'AF_UNIX'):
+            socketPath = None
+        self.socketPath = socketPath
+        self.binaryProxy = None
+        if socketPath:
+            self.binaryProxy = JasperServer.binaryProxies.setdefault(
+                socketPath, BinaryRpcProxy(socketPath))
         self.logger = logging.getLogger('jasper_reports')
 
     def error(self, message):
@@ -33,6 +78,161 @@ class JasperServer(UserWarning):
     def setPidFile(self, pidfile):
         self.pidfile = pidfile
 
+    def setJvmOptions(self, options):
+        self.jvmOptions = options
+
+    def setFillLimits(self, maxFills=0, queueSize=-1):
+        """
+        Limit the number of reports the process fills and exports at the same
+        time (0 means unlimited) and the number of reports waiting for them
+        (-1 means unlimited). Reports above the limits are retried later.
+        """
+        self.maxFills = maxFills
+        self.queueSize = queueSize
+
+    def setStatsInterval(self, seconds):
+        """
+        Report the stats of the process after a report at most every given
+        seconds (0 disables it).
+        """
+        self.statsInterval = seconds
+
+    @classmethod
+    def addMetricsHook(cls, hook):
+        cls.metricsHooks.append(hook)
+
+    def setRecycle(self, renders=0, memory=0):
+        """
+        Recycle the process after the given number of renders or when its
+        memory (in megabytes) passes the given threshold. 0 disables each
+        limit.
+        """
+        self.recycleRenders = renders
+        self.recycleMemory = memory
+
+    def lockFile(self):
+        if self.pidfile:
+            return self.pidfile + '.lock'
+        return os.path.join(tempfile.gettempdir(),
+            'tryton-jasper-%d.lock' % self.port)
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the lock shared by all the processes of the host using this
+        JasperServer so only one of them starts it.
+        """
+        if not fcntl:
+            # Without flock each process starts the server on its own
+            yield
+            return
+        with open(self.lockFile(), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def readPid(pidfile):
+        try:
+            with open(pidfile) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def isRunning(pid):
+        if not pid:
+            return False
+        if hasattr(os, 'WNOHANG'):
+            # A child of this process that exited is a zombie until reaped
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    return False
+            except ChildProcessError:
+                pass
+        if os.name == 'nt':
+            # os.kill terminates the process on Windows
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            # It exists but belongs to another user
+            pass
+        return True
+
+    @classmethod
+    def isJasperServer(cls, pid):
+        """
+        Return whether pid is a running JasperServer process. The pid file
+        may be left by a process that crashed and its pid reused by another
+        process, which must never be waited for nor killed.
+        """
+        if not cls.isRunning(pid):
+            return False
+        if os.path.isdir('/proc/self'):
+            try:
+                with open('/proc/%d/cmdline' % pid, 'rb') as f:
+                    command = f.read()
+            except OSError:
+                return False
+        elif os.name == 'nt':
+            # There is no cheap way to get the command line of the process
+            return True
+        else:
+            try:
+                command = subprocess.check_output(['ps', '-o', 'command=',
+                        '-p', str(pid)])
+            except (OSError, subprocess.CalledProcessError):
+                return False
+        return MAIN_CLASS.encode() in command
+
+    def isReady(self):
+        try:
+            socket.create_connection(('localhost', self.port), timeout=1
+                ).close()
+        except socket.error:
+            return False
+        return True
+
+    def waitReady(self, pid=None):
+        for x in range(START_TIMEOUT):
+            if self.isReady():
+                return True
+            if pid and not self.isRunning(pid):
+                return False
+            time.sleep(1)
+        return self.isReady()
+
+    def ensureStarted(self):
+        """
+        Start the JasperServer process unless it is running. The check and the
+        start happen under the lock so when the process is down exactly one
+        trytond process starts it while the others wait for it to be ready.
+        """
+        with self.lock():
+            if self.isReady():
+                # Started by another process while we waited for the lock
+                return
+            pid = self.pidfile and self.readPid(self.pidfile)
+            if not self.isJasperServer(pid):
+                # Stale pid file, the process is started again
+                pid = None
+            elif self.waitReady(pid):
+                # Still loading its classpath
+                return
+            if self.isRunning(pid):
+                self.logger.warning('JasperServer process %s is not '
+                    'answering, restarting it.' % pid)
+                self.stop(self.pidfile)
+            self.start()
+            if not self.waitReady(JasperServer.pid):
+                self.error('JasperServer process did not start in %d '
+                    'seconds.' % START_TIMEOUT)
+
     def start(self):
         env = {}
         env.update(os.environ)
@@ -64,8 +264,7 @@ class JasperServer(UserWarning):
         # X session and if session is
         # closed JasperServer would start throwing exceptions. So we better
         # avoid using the session at all.
-        command = [
-            'java',
+        command = ['java'] + shlex.split(self.jvmOptions) + [
             '-Djava.awt.headless=true',
             '--add-opens',
             'java.base/java.lang=ALL-UNNAMED',
@@ -78,6 +277,11 @@ class JasperServer(UserWarning):
             'com.nantic.jasperreports.JasperServer',
             str(self.port),
             ]
+        if self.socketPath:
+            command.append('--socket=%s' % self.socketPath)
+        if self.maxFills:
+            command.append('--max-fills=%d' % self.maxFills)
+            command.append('--queue-size=%d' % self.queueSize)
         process = subprocess.Popen(command, env=env, cwd=cwd, close_fds=True)
         JasperServer.pid = process.pid
         if self.pidfile:
@@ -85,32 +289,154 @@ class JasperServer(UserWarning):
                 f.write(str(process.pid))
 
     @staticmethod
-    def stop():
-        if not JasperServer.pid:
+    def stop(pidfile=None):
+        pids = [JasperServer.pid]
+        if pidfile:
+            # It may have been started by another trytond process
+            pids.insert(0, JasperServer.readPid(pidfile))
+        for pid in pids:
+            if JasperServer.isJasperServer(pid):
+                break
+        else:
             return
         try:
-            os.kill(JasperServer.pid, signal.SIGTERM)
+            os.kill(pid, signal.SIGTERM)
             time.sleep(2)
-            os.kill(JasperServer.pid, signal.SIGKILL)
+            if JasperServer.isJasperServer(pid):
+                os.kill(pid, signal.SIGKILL)
         except ProcessLookupError:
             pass
 
+    def call(self, method, *args):
+        """
+        Call the given method of the JasperServer process through the binary
+        transport if available or XML-RPC otherwise.
+        """
+        if self.binaryProxy:
+            try:
+                return getattr(self.binaryProxy.Report, method)(*args)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The process does not serve the binary transport (e.g. its
+                # java version has no Unix domain sockets) or is down, in
+                # which case XML-RPC fails too.
+                pass
+        return getattr(self.proxy.Report, method)(*args)
+
+    def stats(self):
+        """
+        Return the memory (in kilobytes), render and compile counters of the
+        process and the average fill and export times (in milliseconds) of
+        each report by name.
+        """
+        return self.call('stats')
+
+    def reportStats(self):
+        """
+        Log the stats of the process as a JSON line in the jasper_reports.stats
+        logger and give them to the metrics hooks.
+        """
+        stats = self.stats()
+        logging.getLogger('jasper_reports.stats').info(json.dumps(stats,
+                sort_keys=True))
+        for hook in JasperServer.metricsHooks:
+            try:
+                hook(stats)
+            except Exception:
+                self.logger.exception('Metrics hook %r failed.' % hook)
+        return stats
+
+    def needsRecycle(self, stats):
+        if stats.get('draining'):
+            # A previous recycle did not finish
+            return True
+        if self.recycleRenders and stats['renders'] >= self.recycleRenders:
+            return True
+        memory = stats.get('rss') or stats['heapUsed']
+        if self.recycleMemory and memory >= self.recycleMemory * 1024:
+            return True
+        return False
+
+    def recycle(self):
+        """
+        Replace the process by a new one if it reached the recycle limits.
+        It stops accepting reports, which are retried by their callers, and
+        is only stopped once the reports in progress are finished. A drained
+        process also exits by itself, so if this one dies while waiting for
+        it the next report starts the new one.
+        """
+        with self.lock():
+            # Checked again as another process may have recycled it
+            try:
+                stats = self.stats()
+                if not self.needsRecycle(stats):
+                    return
+                self.logger.info('Recycling JasperServer process after %d '
+                    'renders using %d kB.' % (stats['renders'],
+                        stats.get('rss') or stats['heapUsed']))
+                self.call('drain')
+            except (xmlrpc.client.Error, socket.error):
+                return
+            for x in range(DRAIN_TIMEOUT):
+                try:
+                    if not self.stats()['activeRenders']:
+                        break
+                except (xmlrpc.client.Error, socket.error):
+                    # The process exits by itself once drained
+                    break
+                time.sleep(1)
+            else:
+                self.logger.warning('Recycling JasperServer process '
+                    'with reports in progress.')
+            self.stop(self.pidfile)
+            self.start()
+            if not self.waitReady(JasperServer.pid):
+                self.error('JasperServer process did not start in %d '
+                    'seconds.' % START_TIMEOUT)
+
     def execute(self, *args):
         """
         Render report and return the number of pages generated.
+        Reports refused while the process is recycled or overloaded are
+        retried for up to RETRY_TIMEOUT seconds.
         """
-        try:
-            return self.proxy.Report.execute(*args)
-        except (xmlrpc.client.ProtocolError, socket.error):
-            self.start()
-            for x in range(40):
-                time.sleep(1)
-                try:
-                    return self.proxy.Report.execute(*args)
-                except (xmlrpc.client.ProtocolError, socket.error):
-                    pass
-                except xmlrpc.client.Fault as e:
+        start = time.time()
+        failures = 0
+        while True:
+            try:
+                pages = self.call('execute', *args)
+                break
+            except (xmlrpc.client.ProtocolError, socket.error):
+                if not failures:
+                    self.ensureStarted()
+                failures += 1
+                if failures > START_TIMEOUT:
+                    return
+            except xmlrpc.client.Fault as e:
+                if (e.faultCode == RETRY_LATER
+                        and time.time() - start < RETRY_TIMEOUT):
+                    time.sleep(1)
+                    continue
+                if failures:
                     self.error("EXCEPTION: %s %s" % (str(e), str(e.args)))
-                    raise
-        except xmlrpc.client.Fault:
-            raise
+                raise
+            time.sleep(1)
+        self.afterExecute()
+        return pages
+
+    def afterExecute(self):
+        recycle = self.recycleRenders or self.recycleMemory
+        report = (self.statsInterval
+            and time.time() - JasperServer.lastStats >= self.statsInterval)
+        if not recycle and not report:
+            return
+        try:
+            if report:
+                JasperServer.lastStats = time.time()
+                stats = self.reportStats()
+            else:
+                stats = self.stats()
+            if recycle and self.needsRecycle(stats):
+                # Waiting for the other reports must not delay this one
+                threading.Thread(target=self.recycle, daemon=True).start()
+        except (xmlrpc.client.Error, socket.error):
+            pass
@@ -0,0 +1,106 @@
+# This file is part jasper_reports module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from io import BytesIO
+
+from pypdf import PdfReader
+from pypdf.generic import (ArrayObject, DictionaryObject, IndirectObject,
+    NameObject, StreamObject)
+
+
+class PdfConcatenator:
+    """
+    Writes the pages of several PDF documents to a file as a single document.
+
+    Unlike pypdf's PdfWriter, which keeps all the pages (and the readers they
+    come from) in memory until the end, the objects of each document are
+    written as soon as it is added, so only the document being added is in
+    memory. Only the pages (with everything they use) are kept: outlines,
+    named destinations and forms of the documents are dropped.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        # Byte offset of each object, object 1 is the page tree written by
+        # close() and object 2 the catalog
+        self.offsets = [None, None]
+        self.pages = []
+        self.stream.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+
+    def append(self, data):
+        "Add the pages of the PDF document data"
+        reader = PdfReader(BytesIO(data))
+        numbers = {}
+        pending = []
+        # Pages of the reader have their inherited attributes copied in, so
+        # they are written instead of the objects they come from
+        pages = {}
+
+        def number(reference):
+            key = (reference.idnum, reference.generation)
+            if key not in numbers:
+                self.offsets.append(None)
+                numbers[key] = len(self.offsets)
+                pending.append(reference)
+            return IndirectObject(numbers[key], 0, None)
+
+        def renumber(value):
+            # Objects are only read once (the reader caches them) so they are
+            # renumbered in place
+            if isinstance(value, IndirectObject):
+                return number(value)
+            if isinstance(value, DictionaryObject):
+                for key, item in list(value.items()):
+                    if key == '/Length' and isinstance(value, StreamObject):
+                        # Written from the data of the stream
+                        continue
+                    value[key] = renumber(item)
+            elif isinstance(value, ArrayObject):
+                for index, item in enumerate(value):
+                    value[index] = renumber(item)
+            return value
+
+        for page in reader.pages:
+            # Pages are numbered first so the references to them from other
+            # pages (e.g. links) are kept
+            reference = number(page.indirect_reference)
+            self.pages.append(reference.idnum)
+            # The page tree of the document is not written
+            del page['/Parent']
+            pages[reference.idnum] = page
+        while pending:
+            reference = pending.pop()
+            idnum = numbers[(reference.idnum, reference.generation)]
+            if idnum in pages:
+                value = renumber(pages.pop(idnum))
+                value[NameObject('/Parent')] = IndirectObject(1, 0, None)
+            else:
+                value = renumber(reference.get_object())
+            self.writeObject(idnum, value)
+
+    def writeObject(self, number, value):
+        self.offsets[number - 1] = self.stream.tell()
+        self.stream.write(b'%d 0 obj\n' % number)
+        if value is None:
+            self.stream.write(b'null')
+        else:
+            value.write_to_stream(self.stream)
+        self.stream.write(b'\nendobj\n')
+
+    def close(self):
+        "Write the page tree, the catalog and the cross-reference table"
+        self.offsets[0] = self.stream.tell()
+        self.stream.write(b'1 0 obj\n<< /Type /Pages /Count %d /Kids [' % (
+                len(self.pages)))
+        for number in self.pages:
+            self.stream.write(b'\n%d 0 R' % number)
+        self.stream.write(b' ] >>\nendobj\n')
+        self.offsets[1] = self.stream.tell()
+        self.stream.write(b'2 0 obj\n<< /Type /Catalog /Pages 1 0 R >>\n'
+            b'endobj\n')
+        xref = self.stream.tell()
+        self.stream.write(b'xref\n0 %d\n0000000000 65535 f \n' % (
+                len(self.offsets) + 1))
+        for offset in self.offsets:
+            self.stream.write(b'%010d 00000 n \n' % offset)
+        self.stream.write(b'trailer\n<< /Size %d /Root 2 0 R >>\n'
+            b'startxref\n%d\n%%%%EOF\n' % (len(self.offsets) + 1, xref))
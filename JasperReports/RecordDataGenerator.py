@@ -3,24 +3,100 @@
 # the full copyright notices and license terms.
 
 import csv
-from xml.dom.minidom import getDOMImplementation
-import codecs
+from itertools import islice
 import logging
 
-from .AbstractDataGenerator import AbstractDataGenerator
+from .AbstractDataGenerator import AbstractDataGenerator, TEXT_CLASSES
+from .BinaryCodec import BinaryDataWriter
+from .XmlDataWriter import XmlDataWriter
 logger = logging.getLogger(__name__)
 
 
+# Number of rows handed to the writer at once
+CHUNK_SIZE = 1000
+
+
 class CsvRecordDataGenerator(AbstractDataGenerator):
-    def __init__(self, report, records):
+    """
+    Generates the data file from the records provided by the parser
+    function: any iterable of dictionaries or, if columns (the report field
+    paths of each position) are given, of tuples.
+    """
+    def __init__(self, report, records, columns=None, maxRows=0,
+            workspace=None):
         self.report = report
         self.records = records
+        self.columns = columns
+        # Rows after which generation stops (0 means all of them)
+        self.maxRows = maxRows
+        # Workspace whose quota is checked before writing each chunk
+        self.workspace = workspace
         self.temporaryFiles = []
+        self.rowCount = 0
+        self._columns = {}
+
+    def column(self, field):
+        """
+        Return the report column of the field and its Java class or None if
+        it is not used
+        """
+        if field not in self._columns:
+            if field in self.report.fields():
+                info = self.report.fields()[field]
+                self._columns[field] = (info['name'], info['type'])
+            else:
+                logger.warning("FIELD '%s' NOT FOUND IN REPORT." % field)
+                self._columns[field] = None
+        return self._columns[field]
+
+    def generateRows(self):
+        self.rowCount = 0
+        formatValue = self.formatValue
+        records = self.records
+        if self.maxRows:
+            records = islice(records, self.maxRows)
+        if self.columns:
+            positions = [(i,) + self.column(field)
+                for i, field in enumerate(self.columns)
+                if self.column(field)]
+            for record in records:
+                self.rowCount += 1
+                yield dict((name, formatValue(record[i], valueClass))
+                    for i, name, valueClass in positions)
+            return
+
+        column = self.column
+        for record in records:
+            row = {}
+            for field, value in record.items():
+                info = column(field)
+                if info:
+                    name, valueClass = info
+                    row[name] = formatValue(value, valueClass)
+            self.rowCount += 1
+            yield row
+
+    def generateChunks(self):
+        rows = self.generateRows()
+        while True:
+            chunk = list(islice(rows, CHUNK_SIZE))
+            if not chunk:
+                break
+            self.checkQuota()
+            yield chunk
+
+    def formatValue(self, value, valueClass=None):
+        if value is None:
+            value = ''
+        elif isinstance(value, float):
+            value = '%.10f' % value
+        elif not isinstance(value, str):
+            value = str(value)
+        return value
 
-    # CSV file generation using a list of dictionaries provided by the parser
-    # function.
     def generate(self, fileName):
-        f = open(fileName, 'w+', encoding='utf-8')
+        self.fileName = fileName
+        f = open(fileName, 'w', encoding='utf-8')
         try:
             csv.QUOTE_ALL = True
             fieldNames = self.report.fieldNames()
@@ -32,58 +108,45 @@ class CsvRecordDataGenerator(AbstractDataGenerator):
             for field in fieldNames + ['']:
                 header[field] = field
             writer.writerow(header)
-            error_reported_fields = []
-            for record in self.records:
-                row = {}
-                for field in record:
-                    if field not in self.report.fields():
-                        if field not in error_reported_fields:
-                            logger.warning("FIELD '%s' NOT FOUND IN REPORT." % field)
-                            error_reported_fields.append(field)
-                        continue
-                    value = record.get(field, None)
-                    if value is None:
-                        value = ''
-                    elif isinstance(value, float):
-                        value = '%.10f' % value
-                    elif not isinstance(value, str):
-                        value = str(value)
-                    row[self.report.fields()[field]['name']] = value
-                writer.writerow(row)
+            for chunk in self.generateChunks():
+                writer.writerows(chunk)
         finally:
             f.close()
 
 
-class XmlRecordDataGenerator(AbstractDataGenerator):
-    """
-    XML file generation using a list of dictionaries provided by the parser
-    function.
-    """
+class BinaryRecordDataGenerator(CsvRecordDataGenerator):
+    # Binary file generation from the records provided by the parser
+    # function. Values keep their native types except those of the fields
+    # shown as text, which are formatted as the CSV generator does.
+    def generate(self, fileName):
+        self.fileName = fileName
+        f = open(fileName, 'wb')
+        try:
+            writer = BinaryDataWriter(f, self.report.fieldNames())
+            for chunk in self.generateChunks():
+                writer.writerows(chunk)
+            writer.close()
+        finally:
+            f.close()
+
+    def formatValue(self, value, valueClass=None):
+        if valueClass in TEXT_CLASSES:
+            return CsvRecordDataGenerator.formatValue(self, value)
+        return value
+
 
+class XmlRecordDataGenerator(CsvRecordDataGenerator):
+    # XML file generation from the records provided by the parser function.
+    # Records are written as they are generated, not built as a DOM first.
     def generate(self, fileName):
-        # Once all records have been calculated, create the XML structure
-        # itself
-        self.document = getDOMImplementation().createDocument(None, 'data',
-            None)
-        topNode = self.document.documentElement
-        for record in self.data['records']:
-            recordNode = self.document.createElement('record')
-            topNode.appendChild(recordNode)
-            for field, value in record.items():
-                fieldNode = self.document.createElement(field)
-                recordNode.appendChild(fieldNode)
-                # The rest of field types must be converted into str
-                if value is None:
-                    value = ''
-                elif isinstance(value, float):
-                    value = '%.10f' % value
-                elif not isinstance(value, str):
-                    value = str(value)
-                valueNode = self.document.createTextNode(value)
-                fieldNode.appendChild(valueNode)
-        # Once created, the only missing step is to store the XML into a file
-        f = codecs.open(fileName, 'w+', encoding='utf-8')
+        self.fileName = fileName
+        f = open(fileName, 'wb')
         try:
-            topNode.writexml(f)
+            writer = XmlDataWriter(f, self.report)
+            for chunk in self.generateChunks():
+                writer.writerows(chunk)
+            writer.close()
         finally:
             f.close()
+
+    formatValue = BinaryRecordDataGenerator.formatValue
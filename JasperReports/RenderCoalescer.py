@@ -0,0 +1,165 @@
+# This file is part jasper_reports module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import os
+import time
+import tempfile
+import threading
+import logging
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Seconds after which shared outputs and lock files left by other renders
+# are removed
+OUTPUT_TTL = 300
+
+
+class _Flight:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RenderCoalescer:
+    """
+    Single-flight execution of renders: while a render for a key is running,
+    other requests for the same key wait for it and get its result instead of
+    rendering again. If it fails they render it themselves.
+
+    Requests are always coalesced within the process. If a directory is given
+    they are also coalesced across the processes of the host through a lock
+    and an output file per key in that directory. Results are tuples of
+    (output format, data, pages).
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.logger = logging.getLogger(__name__)
+        if directory and fcntl:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        else:
+            self.directory = None
+
+    def run(self, key, function, *args):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+        if not leader:
+            self.logger.info('Waiting for identical render %s' % key)
+            flight.event.wait()
+            if flight.error is not None:
+                # The failure may be of the leader only (e.g. its
+                # transaction), so they render again, coalesced among them
+                return self.run(key, function, *args)
+            return flight.result
+        try:
+            if self.directory:
+                flight.result = self.runShared(key, function, *args)
+            else:
+                flight.result = function(*args)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+
+    def runShared(self, key, function, *args):
+        path = os.path.join(self.directory, key)
+        start = time.time()
+        f, waited = self.acquire(key)
+        try:
+            if waited:
+                result = self.readOutput(path, start)
+                if result is not None:
+                    return result
+            self.removeExpired()
+            result = function(*args)
+            self.writeOutput(path, result)
+            return result
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def acquire(self, key):
+        """
+        Lock the lock file of the key and return it with whether another
+        process held it. As removeExpired() may remove the file while it is
+        waited for, it is opened again until the file locked is the one at
+        its path.
+        """
+        lock = os.path.join(self.directory, key + '.lock')
+        waited = False
+        while True:
+            f = open(lock, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is rendering it
+                if not waited:
+                    self.logger.info('Waiting for identical render %s of '
+                        'another process' % key)
+                waited = True
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.stat(lock).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f, waited
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    @staticmethod
+    def readOutput(path, since):
+        """
+        Return the result written to path by a render that finished after
+        since or None.
+        """
+        try:
+            with open(path + '.out', 'rb') as f:
+                if os.fstat(f.fileno()).st_mtime < since:
+                    return None
+                output_format = f.readline().decode('utf-8').strip()
+                pages = int(f.readline())
+                return (output_format, f.read(), pages)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def writeOutput(path, result):
+        output_format, data, pages = result
+        fd, temporary = tempfile.mkstemp(suffix='.tmp',
+            dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(('%s\n%d\n' % (output_format, pages or 0)).encode('utf-8'))
+            f.write(data)
+        os.replace(temporary, path + '.out')
+
+    def removeExpired(self):
+        limit = time.time() - OUTPUT_TTL
+        for name in os.listdir(self.directory):
+            if not name.endswith(('.out', '.tmp', '.lock')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime >= limit:
+                    continue
+                if name.endswith('.lock'):
+                    with open(path, 'a') as f:
+                        # Fails while a render holds it
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        os.unlink(path)
+                else:
+                    os.unlink(path)
+            except OSError:
+                pass
@@ -0,0 +1,110 @@
+# This file is part jasper_reports module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import os
+import time
+import shutil
+import tempfile
+import logging
+
+from .JasperServer import JasperServer
+
+PREFIX = 'jasper-'
+# Seconds between two sweeps of the root directory by the same process
+SWEEP_INTERVAL = 3600
+
+logger = logging.getLogger(__name__)
+
+
+class WorkspaceQuotaExceeded(Exception):
+    pass
+
+
+class Workspace:
+    """
+    Directory holding all the files of a render (data, images, ids and
+    output files) so they can be removed at once whatever happens.
+
+    Its name contains the process ID and creation time so workspaces left by
+    crashed processes can be found by sweep().
+    """
+    lastSweep = 0
+
+    def __init__(self, root=None, quota=0):
+        if root:
+            os.makedirs(root, mode=0o700, exist_ok=True)
+        self.quota = quota
+        # Bytes used by the files of the workspace and by each of them when
+        # they were last counted
+        self.used = 0
+        self.sizes = {}
+        self.path = tempfile.mkdtemp(prefix='%s%d-%d-' % (PREFIX, os.getpid(),
+                int(time.time())), dir=root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.cleanup()
+
+    def file(self, suffix=''):
+        """
+        Return the path of a new empty file in the workspace.
+        """
+        self.checkQuota()
+        fd, fileName = tempfile.mkstemp(suffix=suffix, dir=self.path)
+        os.close(fd)
+        self.sizes[fileName] = 0
+        return fileName
+
+    def checkQuota(self, *fileNames):
+        """
+        Raise WorkspaceQuotaExceeded if the files of the workspace use more
+        than quota bytes. Only the sizes of the given files (those being
+        written) are read again, so checking is cheap however many files
+        there are.
+        """
+        for fileName in fileNames:
+            try:
+                size = os.stat(fileName).st_size
+            except OSError:
+                size = 0
+            self.used += size - self.sizes.get(fileName, 0)
+            self.sizes[fileName] = size
+        if self.quota and self.used > self.quota:
+            raise WorkspaceQuotaExceeded('Report files use more than %d '
+                'bytes.' % self.quota)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    @classmethod
+    def sweep(cls, root=None, maxAge=0):
+        """
+        Remove the workspaces of root whose process no longer exists or that
+        are older than maxAge seconds (0 means no limit). It is done at most
+        every SWEEP_INTERVAL seconds.
+        """
+        now = time.time()
+        if now - cls.lastSweep < SWEEP_INTERVAL:
+            return
+        cls.lastSweep = now
+        root = root or tempfile.gettempdir()
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            return
+        for entry in entries:
+            if not entry.name.startswith(PREFIX) or not entry.is_dir():
+                continue
+            try:
+                pid, created = map(int,
+                    entry.name[len(PREFIX):].split('-')[:2])
+            except ValueError:
+                continue
+            # Always True on Windows, where only maxAge applies
+            if JasperServer.isRunning(pid) and not (maxAge
+                    and now - created > maxAge):
+                continue
+            logger.info("Removing orphaned workspace '%s'." % entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
@@ -0,0 +1,87 @@
+# This file is part jasper_reports module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+
+import datetime
+from decimal import Decimal
+
+from lxml import etree
+
+
+def formatValue(value):
+    """
+    Return the text of the value in the patterns the JasperServer process
+    gives to JRXmlDataSource or None if the value is null.
+    """
+    if value is None:
+        return None
+    elif isinstance(value, str):
+        return value
+    elif isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(value, datetime.date):
+        return '%s 00:00:00' % value.isoformat()
+    elif isinstance(value, float):
+        return '%.10f' % value
+    elif isinstance(value, Decimal):
+        return format(value, 'f')
+    elif isinstance(value, dict):
+        # Translations of a field as language~value|language~value
+        return '|'.join('%s~%s' % (k, v if v is not None else '')
+            for k, v in value.items())
+    return str(value)
+
+
+class XmlDataWriter:
+    """
+    Writes rows as /data/record elements incrementally, so the document is
+    never held in memory. Each column is nested following the field
+    description of the report, relative to its record element, as
+    XmlMultiLanguageDataSource evaluates it. It follows the csv.DictWriter
+    interface like BinaryDataWriter.
+    """
+
+    def __init__(self, f, report):
+        self.elements = {}
+        for path, field in report.fields().items():
+            description = field.get('description') or ''
+            if description.startswith('/data/record/'):
+                description = description[13:]
+            if description:
+                self.elements[field['name']] = description.split('/')
+            else:
+                self.elements[field['name']] = [field['name']]
+        self._file = etree.xmlfile(f, encoding='utf-8')
+        self._xf = self._file.__enter__()
+        self._xf.write_declaration()
+        self._data = self._xf.element('data')
+        self._data.__enter__()
+
+    def writerow(self, row):
+        record = etree.Element('record')
+        nodes = {}
+        for name, segments in self.elements.items():
+            # Every field has its element, empty if it has no value, as
+            # each CSV row has all the columns
+            value = formatValue(row.get(name))
+            if value is None:
+                value = ''
+            parent = record
+            for i in range(1, len(segments)):
+                key = tuple(segments[:i])
+                if key not in nodes:
+                    nodes[key] = etree.SubElement(parent, segments[i - 1])
+                parent = nodes[key]
+            etree.SubElement(parent, segments[-1]).text = value
+        self._xf.write(record)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+        self._xf.flush()
+
+    def close(self):
+        self._data.__exit__(None, None, None)
+        self._file.__exit__(None, None, None)
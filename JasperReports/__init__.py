@@ -3,10 +3,20 @@
 # the full copyright notices and license terms.
 
 from .AbstractDataGenerator import AbstractDataGenerator
-from .BrowseDataGenerator import CsvBrowseDataGenerator
-from .RecordDataGenerator import CsvRecordDataGenerator
+from .BrowseDataGenerator import (BrowseDataCache, CsvBrowseDataGenerator,
+    BinaryBrowseDataGenerator, XmlBrowseDataGenerator)
+from .RecordDataGenerator import (CsvRecordDataGenerator,
+    BinaryRecordDataGenerator, XmlRecordDataGenerator)
 from .JasperReport import JasperReport
 from .JasperServer import JasperServer
+from .RenderCoalescer import RenderCoalescer
+from .AdmissionController import AdmissionController
+from .Workspace import Workspace, WorkspaceQuotaExceeded
+from .PdfConcatenator import PdfConcatenator
 
-__all__ = ['AbstractDataGenerator', 'CsvBrowseDataGenerator',
-    'CsvRecordDataGenerator', 'JasperReport', 'JasperServer']
+__all__ = ['AbstractDataGenerator', 'BrowseDataCache',
+    'CsvBrowseDataGenerator', 'BinaryBrowseDataGenerator',
+    'XmlBrowseDataGenerator', 'CsvRecordDataGenerator',
+    'BinaryRecordDataGenerator', 'XmlRecordDataGenerator', 'JasperReport',
+    'JasperServer', 'RenderCoalescer', 'AdmissionController', 'Workspace',
+    'WorkspaceQuotaExceeded', 'PdfConcatenator']
@@ -4,6 +4,7 @@
 from trytond.pool import Pool
 from . import data_template
 from . import action
+from . import mass_print
 from . import model
 from . import translation
 
@@ -14,6 +15,8 @@ def register():
         data_template.DataTemplateResult,
         action.ActionReport,
         model.Model,
+        mass_print.MassPrint,
+        mass_print.MassPrintChunk,
         module='jasper_reports', type_='model')
     Pool.register(
         data_template.DataTemplate,
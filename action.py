@@ -1,15 +1,31 @@
 # This file is part jasper_reports module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from trytond.model import fields
 from trytond.pool import PoolMeta
+from trytond.pyson import Eval
 
 __all__ = ['ActionReport']
 
 
 class ActionReport(metaclass=PoolMeta):
     __name__ = 'ir.action.report'
+    jasper_priority = fields.Selection([
+            ('interactive', 'Interactive'),
+            ('batch', 'Batch'),
+            ], 'Jasper Priority', required=True,
+        states={
+            'invisible': Eval('template_extension') != 'jrxml',
+            },
+        depends=['template_extension'],
+        help='Batch reports wait while interactive ones are pending to be '
+        'executed by the JasperServer.')
 
     @classmethod
     def __setup__(cls):
         super(ActionReport, cls).__setup__()
         cls.template_extension.selection.append(('jrxml', 'Jasper Reports'))
+
+    @staticmethod
+    def default_jasper_priority():
+        return 'interactive'
@@ -4,11 +4,16 @@
 import os
 import re
 import time
+import errno
+import json
+import math
+import hashlib
 import tempfile
 import logging
 import subprocess
 import xmlrpc
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from urllib.parse import urlparse
 from pypdf import PdfReader, PdfWriter
@@ -23,19 +28,61 @@ from trytond.tools import slugify
 from trytond.exceptions import UserError
 
 from .JasperReports import JasperReport as JReport, JasperServer
+from .JasperReports import BrowseDataCache
 from .JasperReports import CsvRecordDataGenerator, CsvBrowseDataGenerator
+from .JasperReports import BinaryRecordDataGenerator, BinaryBrowseDataGenerator
+from .JasperReports import XmlRecordDataGenerator, XmlBrowseDataGenerator
+from .JasperReports import RenderCoalescer, AdmissionController
+from .JasperReports import Workspace, WorkspaceQuotaExceeded
 
 # Determines the port where the JasperServer process should listen with its
 # XML-RPC server for incomming calls
 PORT = config_.getint('jasper', 'port', default=8090)
 
+# Determines the Unix domain socket where the JasperServer process serves
+# calls with a binary protocol over persistent connections (requires java 16
+# or later). XML-RPC is used if it is empty or not available.
+SOCKET = config_.get('jasper', 'socket', default='')
+
 # Determines the file name where the process ID of the JasperServer
 # process should be stored
 PID = config_.get('jasper', 'pid', default='tryton-jasper.pid')
 
+# Determines the options given to java when starting the JasperServer process
+# (e.g. "-Xmx2g -XX:+UseG1GC")
+JVM_OPTIONS = config_.get('jasper', 'jvm_options', default='')
+
+# Determines when the JasperServer process is replaced by a new one: after
+# recycle_renders reports or when its memory (resident set size or heap used)
+# passes recycle_memory megabytes. 0 disables each limit. Reports in progress
+# are finished first and new ones wait for the new process.
+RECYCLE_RENDERS = config_.getint('jasper', 'recycle_renders', default=0)
+RECYCLE_MEMORY = config_.getint('jasper', 'recycle_memory', default=0)
+
+# Determines the maximum number of reports the JasperServer process fills and
+# exports at the same time (0 means unlimited) and how many may wait for them
+# (-1 means unlimited). Reports above these limits are retried later.
+MAX_FILLS = config_.getint('jasper', 'max_fills', default=0)
+QUEUE_SIZE = config_.getint('jasper', 'queue_size', default=-1)
+
+# Determines how often (in seconds, 0 disables it) the stats of the
+# JasperServer process are logged as JSON lines in the jasper_reports.stats
+# logger and given to the hooks registered with JasperServer.addMetricsHook
+STATS_INTERVAL = config_.getint('jasper', 'stats_interval', default=0)
+
 # Determines if temporary files will be removed
 UNLINK = config_.getboolean('jasper', 'unlink', default=True)
 
+# Determines where the workspace directory holding the files of each report
+# is created (e.g. a tmpfs mount), the maximum size in megabytes of its data
+# files (0 means unlimited) and the age in seconds after which workspaces are
+# removed even if their process is still running (0 means never).
+WORKSPACE_DIRECTORY = config_.get('jasper', 'workspace_directory',
+    default=tempfile.gettempdir())
+WORKSPACE_QUOTA = config_.getint('jasper', 'workspace_quota', default=0)
+WORKSPACE_MAX_AGE = config_.getint('jasper', 'workspace_max_age',
+    default=86400)
+
 # Determines whether report path cache should be used or not
 USE_CACHE = config_.getboolean('jasper', 'use_cache', default=True)
 CACHE_FOLDER = config_.get('jasper', 'cache_folder', default=None)
@@ -46,8 +93,76 @@ COMPACT_ON_MERGE = config_.getboolean('jasper', 'compact_on_merge',
 
 REDIRECT_MODEL = config_.get('jasper', 'redirect_model')
 
+# Determines the format of the data files sent to the JasperServer process:
+# 'csv', 'binary' (typed values, no formatting nor parsing) or 'xml'
+DATA_FORMAT = config_.get('jasper', 'data_format', default='csv')
+
+# Determines whether JasperReports should page filled reports to disk instead
+# of keeping them in the heap of the JasperServer process: '' (disabled),
+# 'file' or 'swap'. It is only used for reports with at least
+# virtualizer_rows rows and keeps virtualizer_pages pages in memory.
+VIRTUALIZER = config_.get('jasper', 'virtualizer', default='')
+VIRTUALIZER_DIRECTORY = config_.get('jasper', 'virtualizer_directory',
+    default=tempfile.gettempdir())
+VIRTUALIZER_ROWS = config_.getint('jasper', 'virtualizer_rows', default=0)
+VIRTUALIZER_PAGES = config_.getint('jasper', 'virtualizer_pages',
+    default=100)
+
+# Determines whether the data of the main report is streamed to the
+# JasperServer process through a named pipe so it starts filling while the
+# rows are still being generated. Reports that rewind their main data source
+# (see JasperReport.rewindsDataSource) are never streamed.
+STREAMING = config_.getboolean('jasper', 'streaming', default=False)
+
+# Determines the number of ids from which SQL reports declaring the IDS_TABLE
+# parameter receive them through a file, staged by the JasperServer process in
+# a temporary table, instead of the IDS array. 0 disables it.
+IDS_TABLE_THRESHOLD = config_.getint('jasper', 'ids_table_threshold',
+    default=0)
+
+# Determines whether identical concurrent renders (same user, context,
+# report, ids, output format and parameters) wait for one of them and share
+# its output: '' (disabled), 'process' or 'host' (across the trytond
+# processes of the host, through files in coalesce_directory). Renders of
+# records modified by their own transaction are never shared but others may
+# get an output filled with data committed up to when the first of them
+# started.
+COALESCE = config_.get('jasper', 'coalesce', default='')
+COALESCE_DIRECTORY = config_.get('jasper', 'coalesce_directory',
+    default=os.path.join(tempfile.gettempdir(), 'tryton-jasper-coalesce'))
+
+# Determines the maximum number of reports each trytond process executes at
+# the same time in the JasperServer process (0 means unlimited) and how many
+# of them may be batch ones (0 means up to max_renders). Waiting interactive
+# reports are always executed before waiting batch ones. The priority is
+# taken from the jasper_priority key of the context or the action report.
+MAX_RENDERS = config_.getint('jasper', 'max_renders', default=0)
+MAX_BATCH_RENDERS = config_.getint('jasper', 'max_batch_renders', default=0)
+
+# Determines how previews (see the preview key of the report data or the
+# jasper_preview key of the context, which give the number of pages to
+# return) are rendered: with at most preview_records records of the ids and
+# preview_rows rows of data.
+PREVIEW_RECORDS = config_.getint('jasper', 'preview_records', default=20)
+PREVIEW_ROWS = config_.getint('jasper', 'preview_rows', default=1000)
+
+RECORD_DATA_GENERATORS = {
+    'csv': CsvRecordDataGenerator,
+    'binary': BinaryRecordDataGenerator,
+    'xml': XmlRecordDataGenerator,
+    }
+BROWSE_DATA_GENERATORS = {
+    'csv': CsvBrowseDataGenerator,
+    'binary': BinaryBrowseDataGenerator,
+    'xml': XmlBrowseDataGenerator,
+    }
+
 logger = logging.getLogger(__name__)
 
+coalescer = RenderCoalescer(
+    COALESCE_DIRECTORY if COALESCE == 'host' else None)
+admission = AdmissionController(MAX_RENDERS, MAX_BATCH_RENDERS)
+
 
 class JasperReport(Report):
     _get_report_file_cache = Cache('jasper_report.report_file')
@@ -230,35 +345,138 @@ class JasperReport(Report):
 
     @classmethod
     def render(cls, action_report, data, model, ids):
+        key = cls.render_key(action_report, data, model, ids)
+        if key is None:
+            return cls.render_report(action_report, data, model, ids)
+        return coalescer.run(key, cls.render_report, action_report, data,
+            model, ids)
+
+    @classmethod
+    def render_key(cls, action_report, data, model, ids):
+        """
+        Return the key identifying identical renders or None if the render
+        must not be shared.
+        """
+        if not COALESCE or data.get('data_source', 'model') == 'records':
+            return None
+        transaction = Transaction()
+        # It must see the changes of its transaction
+        if transaction.counter:
+            return None
+        try:
+            parameters = json.dumps(data.get('parameters', {}),
+                sort_keys=True, default=str)
+            # Any key of the context (company, dates, ...) may change what
+            # the records browse to
+            context = json.dumps(transaction.context, sort_keys=True,
+                default=str)
+        except TypeError:
+            return None
+        key = (transaction.database.name, transaction.user,
+            action_report.id, model, list(ids), transaction.language,
+            context, data.get('output_format', action_report.extension),
+            data.get('data_format', DATA_FORMAT), parameters,
+            cls.preview_pages(data))
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def render_report(cls, action_report, data, model, ids):
+        Workspace.sweep(WORKSPACE_DIRECTORY, WORKSPACE_MAX_AGE)
+        workspace = Workspace(WORKSPACE_DIRECTORY,
+            WORKSPACE_QUOTA * 1024 * 1024)
+        try:
+            return cls.render_workspace(workspace, action_report, data, model,
+                ids)
+        except WorkspaceQuotaExceeded as e:
+            raise UserError(str(e))
+        finally:
+            # Remove all temporary files created during the report
+            if UNLINK:
+                workspace.cleanup()
+
+    @classmethod
+    def preview_pages(cls, data):
+        "Return the number of pages of the preview to render or 0"
+        preview = data.get('preview',
+            Transaction().context.get('jasper_preview'))
+        if preview is True:
+            return 1
+        try:
+            return max(int(preview or 0), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    @classmethod
+    def render_workspace(cls, workspace, action_report, data, model, ids):
         output_format = action_report.extension
         if 'output_format' in data:
             output_format = data['output_format']
+        data_format = data.get('data_format', DATA_FORMAT)
+        if data_format not in BROWSE_DATA_GENERATORS:
+            logger.warning("Unknown data format '%s', using csv."
+                % data_format)
+            data_format = 'csv'
+        RecordDataGenerator = RECORD_DATA_GENERATORS[data_format]
+        BrowseDataGenerator = BROWSE_DATA_GENERATORS[data_format]
+
+        # Previews only use the first records and rows, the number of pages
+        # of the whole report is estimated from them
+        preview = cls.preview_pages(data)
+        allIds = ids
+        maxRows = 0
+        if preview:
+            ids = ids[:PREVIEW_RECORDS]
+            maxRows = PREVIEW_ROWS
 
         # Create temporary input (CSV) and output (PDF) files
-        temporary_files = []
-
-        fd, dataFile = tempfile.mkstemp()
-        os.close(fd)
-        fd, outputFile = tempfile.mkstemp()
-        os.close(fd)
-        temporary_files.append(dataFile)
-        temporary_files.append(outputFile)
+        dataFile = workspace.file()
+        outputFile = workspace.file()
         logger.info("Temporary data file: '%s'" % dataFile)
 
         start = time.time()
 
         report_path = cls.get_report_file(action_report)
         report = JReport(report_path)
+        rows = None
+        # Records and values loaded for the main report are reused by the
+        # subreports, which usually browse the same ids
+        cache = BrowseDataCache(workspace)
+
+        # Records given by the parser may be any iterable (see
+        # CsvRecordDataGenerator), they are only kept in memory if several
+        # data files must be generated from them.
+        records = data.get('records')
+        if (data.get('data_source', 'model') == 'records'
+                and not isinstance(records, (list, tuple))
+                and any(s['report'].language() == 'xpath'
+                    for s in report.subreports())):
+            records = list(records)
+
+        streaming = (data.get('streaming', STREAMING)
+            and report.language() == 'xpath' and hasattr(os, 'mkfifo'))
+        if streaming and report.rewindsDataSource():
+            # The JasperServer would wait forever to read the pipe again
+            logger.info("Report '%s' rewinds its data source, it is not "
+                "streamed." % report_path)
+            streaming = False
 
         # If the language used is xpath create the xmlFile in dataFile.
         if report.language() == 'xpath':
             if data.get('data_source', 'model') == 'records':
-                generator = CsvRecordDataGenerator(report, data['records'])
+                mainGenerator = RecordDataGenerator(report, records,
+                    columns=data.get('columns'), maxRows=maxRows,
+                    workspace=workspace)
             else:
-                generator = CsvBrowseDataGenerator(report, model, ids)
-                temporary_files += generator.temporary_files
+                mainGenerator = BrowseDataGenerator(report, model, ids,
+                    cache=cache, maxRows=maxRows)
 
-            generator.generate(dataFile)
+            if streaming:
+                # The rows are written once the JasperServer opens the pipe
+                os.unlink(dataFile)
+                os.mkfifo(dataFile, 0o600)
+            else:
+                mainGenerator.generate(dataFile)
+                rows = mainGenerator.rowCount
 
         subreportDataFiles = []
         for subreportInfo in report.subreports():
@@ -272,36 +490,48 @@ class JasperReport(Report):
                 message += 'for file %s' % subreportInfo['filename']
                 logger.info(message)
 
-                fd, subreportDataFile = tempfile.mkstemp()
-                os.close(fd)
+                subreportDataFile = workspace.file()
                 subreportDataFiles.append({
                     'parameter': subreportInfo['parameter'],
                     'dataFile': subreportDataFile,
+                    'dataFormat': data_format,
                     'jrxmlFile': subreportInfo['filename'],
                 })
-                temporary_files.append(subreportDataFile)
 
                 if subreport.isHeader():
-                    generator = CsvBrowseDataGenerator(subreport,
-                        'res.users', [Transaction().user])
+                    generator = BrowseDataGenerator(subreport,
+                        'res.users', [Transaction().user], cache=cache)
                 elif data.get('data_source', 'model') == 'records':
-                    generator = CsvRecordDataGenerator(subreport,
-                        data['records'])
+                    generator = RecordDataGenerator(subreport, records,
+                        columns=data.get('columns'), maxRows=maxRows,
+                        workspace=workspace)
                 else:
-                    generator = CsvBrowseDataGenerator(subreport, model, ids)
+                    generator = BrowseDataGenerator(subreport, model, ids,
+                        cache=cache, maxRows=maxRows)
                 generator.generate(subreportDataFile)
+                if rows is not None:
+                    rows = max(rows, generator.rowCount)
+
+        workspace.checkQuota(dataFile,
+            *[x['dataFile'] for x in subreportDataFiles])
 
         # Start: Report execution section
         locale = Transaction().language
 
         connectionParameters = {
             'output': output_format,
-            'csv': dataFile,
+            data_format: dataFile,
             'dsn': cls.dsn(),
             'user': cls.userName(),
             'password': cls.password(),
             'subreports': subreportDataFiles,
         }
+        virtualizer = cls.virtualizer(rows)
+        if virtualizer:
+            connectionParameters['virtualizer'] = virtualizer
+        if preview:
+            connectionParameters['maxPages'] = preview
+            connectionParameters['maxRecords'] = PREVIEW_ROWS
         sources_dir = os.path.join(
             MODULES_PATH,
             os.path.dirname(action_report.report) + os.sep)
@@ -313,17 +543,45 @@ class JasperReport(Report):
             'SUBREPORT_DIR': os.path.dirname(report_path) + os.path.sep,
             'REPORT_DIR': os.path.dirname(report_path),
         }
+        if (report.language() == 'sql' and IDS_TABLE_THRESHOLD
+                and len(ids) >= IDS_TABLE_THRESHOLD
+                and 'IDS_TABLE' in report.parameters()):
+            # A handle to the ids is sent instead of a huge XML-RPC array
+            idsFile = workspace.file()
+            with open(idsFile, 'w') as f:
+                for id in ids:
+                    f.write('%d\n' % id)
+            connectionParameters['ids'] = idsFile
+            del parameters['IDS']
         if 'parameters' in data:
             parameters.update(data['parameters'])
 
         # Call the external java application that will generate the PDF
         # file in outputFile
-        server = JasperServer(PORT)
+        server = JasperServer(PORT, SOCKET)
         server.setPidFile(PID)
-        pages = server.execute(connectionParameters, report_path,
-            outputFile, parameters)
+        server.setJvmOptions(JVM_OPTIONS)
+        server.setRecycle(RECYCLE_RENDERS, RECYCLE_MEMORY)
+        server.setFillLimits(MAX_FILLS, QUEUE_SIZE)
+        server.setStatsInterval(STATS_INTERVAL)
+        priority = cls.priority(action_report, data)
+        queued = time.time()
+        with admission.slot(priority):
+            if time.time() - queued > 1:
+                logger.info("Waited %.2f seconds to execute %s report" % (
+                        time.time() - queued, priority))
+            if streaming:
+                pages = cls.stream(server, mainGenerator, dataFile,
+                    connectionParameters, report_path, outputFile, parameters)
+            else:
+                pages = server.execute(connectionParameters, report_path,
+                    outputFile, parameters)
         # End: report execution section
 
+        if preview and pages:
+            pages = cls.estimate_pages(pages, allIds, ids,
+                mainGenerator if report.language() == 'xpath' else None)
+
         elapsed = (time.time() - start) / 60
         logger.info("Elapsed: %.4f seconds" % elapsed)
 
@@ -334,15 +592,86 @@ class JasperReport(Report):
         finally:
             f.close()
 
-        # Remove all temporary files created during the report
-        if UNLINK:
-            for file in temporary_files:
+        return (output_format, file_data, pages)
+
+    @classmethod
+    def estimate_pages(cls, pages, allIds, ids, generator=None):
+        """
+        Return the number of pages of the whole report from the pages
+        filled with the preview records.
+        """
+        total, rendered = len(allIds), len(ids)
+        if hasattr(generator, 'rootCount'):
+            rendered = generator.rootCount
+        elif generator is not None and hasattr(generator.records, '__len__'):
+            total, rendered = len(generator.records), generator.rowCount
+        if not rendered or rendered >= total:
+            return pages
+        return int(math.ceil(pages * total / rendered))
+
+    @classmethod
+    def priority(cls, action_report, data):
+        return (data.get('priority')
+            or Transaction().context.get('jasper_priority')
+            or getattr(action_report, 'jasper_priority', None)
+            or 'interactive')
+
+    @staticmethod
+    def queue_depth():
+        """
+        Return the number of reports of the process waiting for and being
+        executed by the JasperServer by priority.
+        """
+        return admission.queueDepth()
+
+    @classmethod
+    def stream(cls, server, generator, fifo, *args):
+        """
+        Execute the report in the JasperServer while the generator writes
+        its rows to the fifo it reads the data from.
+        """
+        # Only the main thread has a transaction so it generates the data
+        # and the report is executed in the background.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(server.execute, *args)
+            fd = None
+            while fd is None:
                 try:
-                    os.unlink(file)
-                except os.error:
-                    logger.warning("Could not remove file '%s'." % file)
+                    fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+                except OSError as e:
+                    if e.errno != errno.ENXIO:
+                        raise
+                    # No reader yet, unless the report already failed
+                    if future.done():
+                        return future.result()
+                    time.sleep(0.05)
+            try:
+                # Keeping a writer open ensures the JasperServer does not
+                # see the end of the data before the generator opens it.
+                generator.generate(fifo)
+            except BrokenPipeError:
+                # The JasperServer stopped reading, its result tells why
+                pass
+            finally:
+                os.close(fd)
+            return future.result()
 
-        return (output_format, file_data, pages)
+    @classmethod
+    def virtualizer(cls, rows=None):
+        """
+        Return the virtualizer parameters for a report with the given number
+        of rows (None if unknown, as in SQL reports) or None to fill the
+        report in memory.
+        """
+        if not VIRTUALIZER:
+            return
+        if rows is not None and rows < VIRTUALIZER_ROWS:
+            return
+        return {
+            'type': VIRTUALIZER,
+            'directory': VIRTUALIZER_DIRECTORY,
+            'maxSize': VIRTUALIZER_PAGES,
+            }
 
     @classmethod
     def dsn(cls):
@@ -0,0 +1,159 @@
+package com.nantic.jasperreports;
+
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.IOException;
+import java.math.BigDecimal;
+import java.math.BigInteger;
+import java.util.ArrayList;
+import java.util.Calendar;
+import java.util.Date;
+import java.util.HashMap;
+import java.util.Iterator;
+import java.util.List;
+import java.util.Map;
+
+/*
+Reads and writes the compact typed format of JasperReports/BinaryCodec.py.
+Every value is a tag byte followed by its payload, all numbers are big
+endian, which is what DataInputStream and DataOutputStream expect.
+*/
+public class BinaryCodec {
+	public static final byte[] MAGIC = { 'T', 'J', 'R', 'B' };
+	public static final int VERSION = 1;
+
+	public static final int END = 0;
+	public static final int ROW = 1;
+
+	public static final int TAG_NULL = 0;
+	public static final int TAG_STRING = 1;
+	public static final int TAG_LONG = 2;
+	public static final int TAG_DOUBLE = 3;
+	public static final int TAG_DECIMAL = 4;
+	public static final int TAG_DATE = 5;
+	public static final int TAG_DATETIME = 6;
+	public static final int TAG_BOOLEAN = 7;
+	public static final int TAG_MAP = 8;
+	public static final int TAG_LIST = 9;
+
+	public static String readString( DataInputStream in ) throws IOException {
+		byte[] data = new byte[ in.readInt() ];
+		in.readFully( data );
+		return new String( data, "UTF-8" );
+	}
+
+	public static Object readValue( DataInputStream in ) throws IOException {
+		int tag = in.readUnsignedByte();
+		switch ( tag ) {
+			case TAG_NULL:
+				return null;
+			case TAG_STRING:
+				return readString( in );
+			case TAG_LONG:
+				return new Long( in.readLong() );
+			case TAG_DOUBLE:
+				return new Double( in.readDouble() );
+			case TAG_DECIMAL: {
+				int scale = in.readInt();
+				byte[] unscaled = new byte[ in.readInt() ];
+				in.readFully( unscaled );
+				return new BigDecimal( new BigInteger( unscaled ), scale );
+			}
+			case TAG_DATE: {
+				Calendar calendar = Calendar.getInstance();
+				calendar.clear();
+				calendar.set( in.readShort(), in.readUnsignedByte() - 1, in.readUnsignedByte() );
+				return calendar.getTime();
+			}
+			case TAG_DATETIME: {
+				Calendar calendar = Calendar.getInstance();
+				calendar.clear();
+				calendar.set( in.readShort(), in.readUnsignedByte() - 1, in.readUnsignedByte(),
+					in.readUnsignedByte(), in.readUnsignedByte(), in.readUnsignedByte() );
+				calendar.set( Calendar.MILLISECOND, in.readInt() / 1000 );
+				return calendar.getTime();
+			}
+			case TAG_BOOLEAN:
+				return Boolean.valueOf( in.readUnsignedByte() != 0 );
+			case TAG_MAP: {
+				int size = in.readInt();
+				Map<String, Object> map = new HashMap<String, Object>();
+				for ( int i = 0; i < size; i++ ) {
+					String key = readString( in );
+					map.put( key, readValue( in ) );
+				}
+				return map;
+			}
+			case TAG_LIST: {
+				int size = in.readInt();
+				List<Object> list = new ArrayList<Object>( size );
+				for ( int i = 0; i < size; i++ )
+					list.add( readValue( in ) );
+				return list;
+			}
+			default:
+				throw new IOException( "Unknown value tag " + tag );
+		}
+	}
+
+	public static void writeString( DataOutputStream out, String value ) throws IOException {
+		byte[] data = value.getBytes( "UTF-8" );
+		out.writeInt( data.length );
+		out.write( data );
+	}
+
+	public static void writeValue( DataOutputStream out, Object value ) throws IOException {
+		if ( value == null ) {
+			out.writeByte( TAG_NULL );
+		} else if ( value instanceof String ) {
+			out.writeByte( TAG_STRING );
+			writeString( out, (String)value );
+		} else if ( value instanceof Boolean ) {
+			out.writeByte( TAG_BOOLEAN );
+			out.writeByte( ((Boolean)value).booleanValue() ? 1 : 0 );
+		} else if ( value instanceof Integer || value instanceof Long || value instanceof Short || value instanceof Byte ) {
+			out.writeByte( TAG_LONG );
+			out.writeLong( ((Number)value).longValue() );
+		} else if ( value instanceof Double || value instanceof Float ) {
+			out.writeByte( TAG_DOUBLE );
+			out.writeDouble( ((Number)value).doubleValue() );
+		} else if ( value instanceof BigDecimal || value instanceof BigInteger ) {
+			BigDecimal decimal = value instanceof BigDecimal ? (BigDecimal)value : new BigDecimal( (BigInteger)value );
+			byte[] unscaled = decimal.unscaledValue().toByteArray();
+			out.writeByte( TAG_DECIMAL );
+			out.writeInt( decimal.scale() );
+			out.writeInt( unscaled.length );
+			out.write( unscaled );
+		} else if ( value instanceof Date ) {
+			Calendar calendar = Calendar.getInstance();
+			calendar.setTime( (Date)value );
+			out.writeByte( TAG_DATETIME );
+			out.writeShort( calendar.get( Calendar.YEAR ) );
+			out.writeByte( calendar.get( Calendar.MONTH ) + 1 );
+			out.writeByte( calendar.get( Calendar.DAY_OF_MONTH ) );
+			out.writeByte( calendar.get( Calendar.HOUR_OF_DAY ) );
+			out.writeByte( calendar.get( Calendar.MINUTE ) );
+			out.writeByte( calendar.get( Calendar.SECOND ) );
+			out.writeInt( calendar.get( Calendar.MILLISECOND ) * 1000 );
+		} else if ( value instanceof Map ) {
+			Map map = (Map)value;
+			out.writeByte( TAG_MAP );
+			out.writeInt( map.size() );
+			Iterator it = map.entrySet().iterator();
+			while ( it.hasNext() ) {
+				Map.Entry entry = (Map.Entry)it.next();
+				writeString( out, entry.getKey().toString() );
+				writeValue( out, entry.getValue() );
+			}
+		} else if ( value instanceof List || value instanceof Object[] ) {
+			Object[] items = value instanceof List ? ((List)value).toArray() : (Object[])value;
+			out.writeByte( TAG_LIST );
+			out.writeInt( items.length );
+			for ( int i = 0; i < items.length; i++ )
+				writeValue( out, items[i] );
+		} else {
+			out.writeByte( TAG_STRING );
+			writeString( out, value.toString() );
+		}
+	}
+}
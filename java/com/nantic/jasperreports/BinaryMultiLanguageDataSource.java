@@ -0,0 +1,187 @@
+package com.nantic.jasperreports;
+
+import net.sf.jasperreports.engine.JRRewindableDataSource;
+import net.sf.jasperreports.engine.JRException;
+import net.sf.jasperreports.engine.JRField;
+
+import java.io.*;
+import java.math.BigDecimal;
+import java.math.BigInteger;
+import java.text.NumberFormat;
+import java.text.SimpleDateFormat;
+import java.util.Arrays;
+import java.util.Date;
+import java.util.HashMap;
+import java.util.Iterator;
+import java.util.Locale;
+import java.util.Map;
+
+/*
+This class reads the typed binary files generated by Python (see
+BinaryCodec). Values arrive with their native types so, unlike
+CsvMultiLanguageDataSource, no date nor number parsing is needed. Values
+of java.lang.Object fields come as a map with the data for each language
+or as the language~value|language~value text of the CSV files.
+*/
+public class BinaryMultiLanguageDataSource implements JRRewindableDataSource {
+	private String fileName;
+	private DataInputStream in;
+	private Map<String, Integer> columns;
+	private Object[] row;
+	private Translator translator;
+	private NumberFormat numberFormat = NumberFormat.getInstance( Locale.ENGLISH );
+	private SimpleDateFormat dateFormat = new SimpleDateFormat( "yyyy-MM-dd HH:mm:ss" );
+
+	public BinaryMultiLanguageDataSource(String fileName, Translator translator) throws JRException {
+		this.fileName = fileName;
+		this.translator = translator;
+		open();
+	}
+
+	private void open() throws JRException {
+		try {
+			in = new DataInputStream( new BufferedInputStream( new FileInputStream( fileName ), 65536 ) );
+			byte[] magic = new byte[ BinaryCodec.MAGIC.length ];
+			in.readFully( magic );
+			if ( ! Arrays.equals( magic, BinaryCodec.MAGIC ) )
+				throw new JRException( "Invalid binary data file: " + fileName );
+			int version = in.readUnsignedByte();
+			if ( version != BinaryCodec.VERSION )
+				throw new JRException( "Unsupported binary data file version " + version + ": " + fileName );
+			int count = in.readInt();
+			columns = new HashMap<String, Integer>();
+			for ( int i = 0; i < count; i++ )
+				columns.put( BinaryCodec.readString( in ), new Integer( i ) );
+			row = null;
+		} catch ( IOException exception ) {
+			throw new JRException( exception );
+		}
+	}
+
+	public void moveFirst() throws JRException {
+		close();
+		open();
+	}
+
+	public boolean next() throws JRException {
+		if ( in == null )
+			return false;
+		try {
+			if ( in.readUnsignedByte() != BinaryCodec.ROW ) {
+				close();
+				return false;
+			}
+			row = new Object[ columns.size() ];
+			for ( int i = 0; i < row.length; i++ )
+				row[i] = BinaryCodec.readValue( in );
+		} catch ( IOException exception ) {
+			throw new JRException( exception );
+		}
+		return true;
+	}
+
+	public Object getFieldValue(JRField jrField) throws JRException {
+		Integer index = columns.get( jrField.getName() );
+		if ( index == null )
+			throw new JRException( "Unknown column name: " + jrField.getName() );
+		if ( row == null )
+			return null;
+		return convert( row[ index.intValue() ], jrField.getValueClass() );
+	}
+
+	/* Converts the native value sent by Python to the class of the field */
+	protected Object convert( Object value, Class valueClass ) throws JRException {
+		// Columns missing from a row are empty text in CSV files
+		if ( value == null && ( valueClass.equals( String.class ) || valueClass.equals( Object.class ) ) )
+			value = "";
+		if ( value == null )
+			return null;
+		if ( valueClass.equals( Object.class ) && value instanceof String ) {
+			// Translations sent as text, parsed as CsvMultiLanguageDataSource
+			// does
+			LanguageTable values = new LanguageTable("en_US");
+			String[] p = ((String) value).split( "\\|" );
+			for( int j=0; j < p.length ; j++ ) {
+				String[] map = p[j].split( "~" );
+				if ( map.length == 2 )
+					values.put( map[0], map[1] );
+			}
+			return (Object)values;
+		}
+		if ( value instanceof Map ) {
+			LanguageTable values = new LanguageTable("en_US");
+			Iterator it = ((Map)value).entrySet().iterator();
+			while ( it.hasNext() ) {
+				Map.Entry entry = (Map.Entry)it.next();
+				values.put( entry.getKey(), entry.getValue() == null ? "" : entry.getValue().toString() );
+			}
+			value = (Object)values;
+		}
+		if ( valueClass.isInstance( value ) )
+			return value;
+		if ( valueClass.equals( String.class ) )
+			return value.toString();
+		try {
+			if ( value instanceof String ) {
+				String s = (String) value;
+				if ( s.length() == 0 )
+					return null;
+				if ( valueClass.equals( Boolean.class ) )
+					return Boolean.valueOf( s );
+				if ( Date.class.isAssignableFrom( valueClass ) )
+					value = dateFormat.parse( s );
+				else if ( Number.class.isAssignableFrom( valueClass ) )
+					value = new BigDecimal( numberFormat.parse( s ).toString() );
+			}
+			if ( value instanceof Number ) {
+				Number n = (Number) value;
+				if ( valueClass.equals( Integer.class ) )
+					return new Integer( n.intValue() );
+				if ( valueClass.equals( Long.class ) )
+					return new Long( n.longValue() );
+				if ( valueClass.equals( Short.class ) )
+					return new Short( n.shortValue() );
+				if ( valueClass.equals( Byte.class ) )
+					return new Byte( n.byteValue() );
+				if ( valueClass.equals( Double.class ) )
+					return new Double( n.doubleValue() );
+				if ( valueClass.equals( Float.class ) )
+					return new Float( n.floatValue() );
+				if ( valueClass.equals( BigDecimal.class ) )
+					return n instanceof BigDecimal ? n : new BigDecimal( n.toString() );
+				if ( valueClass.equals( BigInteger.class ) )
+					return new BigDecimal( n.toString() ).toBigInteger();
+				if ( valueClass.equals( Number.class ) )
+					return n;
+			}
+			if ( value instanceof Date ) {
+				long time = ((Date) value).getTime();
+				if ( valueClass.equals( java.sql.Timestamp.class ) )
+					return new java.sql.Timestamp( time );
+				if ( valueClass.equals( java.sql.Date.class ) )
+					return new java.sql.Date( time );
+				if ( valueClass.equals( java.sql.Time.class ) )
+					return new java.sql.Time( time );
+				if ( valueClass.equals( Date.class ) )
+					return value;
+			}
+		} catch ( java.text.ParseException exception ) {
+			throw new JRException( "Unable to parse value '" + value + "' as " + valueClass.getName(), exception );
+		}
+		throw new JRException( "Unable to convert value '" + value + "' to " + valueClass.getName() );
+	}
+
+	public void close() {
+		if ( in == null )
+			return;
+		try {
+			in.close();
+		} catch ( IOException exception ) {
+		}
+		in = null;
+	}
+
+	public Translator getTranslator() {
+		return translator;
+	}
+}
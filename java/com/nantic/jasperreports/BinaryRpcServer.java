@@ -0,0 +1,259 @@
+package com.nantic.jasperreports;
+
+import java.io.*;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.lang.reflect.Modifier;
+import java.net.StandardProtocolFamily;
+import java.net.UnixDomainSocketAddress;
+import java.nio.channels.Channels;
+import java.nio.channels.ClosedChannelException;
+import java.nio.channels.ServerSocketChannel;
+import java.nio.channels.SocketChannel;
+import java.nio.file.Files;
+import java.nio.file.Paths;
+import java.util.HashSet;
+import java.util.Hashtable;
+import java.util.Iterator;
+import java.util.LinkedHashSet;
+import java.util.List;
+import java.util.Map;
+import java.util.Set;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+
+/*
+Serves the methods of the "Report" XML-RPC handler (JasperServer) through a
+Unix domain socket (Java 16 or later) using a length-prefixed binary protocol
+(see JasperReports/BinaryRpc.py).
+
+Each frame is a 4 byte big endian length followed by a BinaryCodec value.
+Requests are a list with the method name and the list of arguments, responses
+a list with 0 and the result or 1, a fault code and a fault string.
+Connections are persistent: a client sends any number of requests, one at a
+time, until it closes the socket.
+
+Each connection is served by its own thread. With maxConnections, once that
+many are open the one waiting longest for a request is closed to make room
+for a new one (clients send their request again on a new connection) and if
+all of them are busy the new one is answered with a RETRY_LATER fault.
+*/
+public class BinaryRpcServer implements Runnable {
+	public static final int OK = 0;
+	public static final int FAULT = 1;
+
+	private String path;
+	private int maxConnections;
+	private ServerSocketChannel server;
+	// Connections being served and those of them waiting for a request, the
+	// first one waiting for longest
+	private final Set<SocketChannel> open = new HashSet<SocketChannel>();
+	private final LinkedHashSet<SocketChannel> idle = new LinkedHashSet<SocketChannel>();
+	// Answers connections over maxConnections, one at a time
+	private final ExecutorService rejecter = Executors.newSingleThreadExecutor();
+
+	public BinaryRpcServer( String path, int maxConnections ) {
+		this.path = path;
+		this.maxConnections = maxConnections;
+	}
+
+	public void start() throws IOException {
+		Files.deleteIfExists( Paths.get( path ) );
+		server = ServerSocketChannel.open( StandardProtocolFamily.UNIX );
+		server.bind( UnixDomainSocketAddress.of( path ) );
+		new File( path ).deleteOnExit();
+		Thread thread = new Thread( this, "JasperServer binary RPC" );
+		thread.start();
+	}
+
+	public void run() {
+		while ( true ) {
+			try {
+				final SocketChannel channel = server.accept();
+				if ( ! admit( channel ) ) {
+					rejecter.execute( new Runnable() {
+						public void run() {
+							reject( channel );
+						}
+					} );
+					continue;
+				}
+				Thread thread = new Thread( new Runnable() {
+					public void run() {
+						serve( channel );
+					}
+				}, "JasperServer binary RPC connection" );
+				thread.setDaemon( true );
+				thread.start();
+			} catch ( IOException exception ) {
+				System.err.println( "JasperServer: Binary RPC: " + exception );
+			}
+		}
+	}
+
+	/* Makes room for the channel if there are maxConnections open, returns false if all of them are busy */
+	private synchronized boolean admit( SocketChannel channel ) {
+		if ( maxConnections > 0 && open.size() >= maxConnections ) {
+			Iterator<SocketChannel> it = idle.iterator();
+			if ( ! it.hasNext() )
+				return false;
+			SocketChannel oldest = it.next();
+			it.remove();
+			open.remove( oldest );
+			close( oldest );
+		}
+		open.add( channel );
+		return true;
+	}
+
+	/* Marks the channel as waiting for a request or not, returns false if it was closed to make room */
+	private synchronized boolean setIdle( SocketChannel channel, boolean waiting ) {
+		if ( ! open.contains( channel ) )
+			return false;
+		if ( waiting )
+			idle.add( channel );
+		else
+			idle.remove( channel );
+		return true;
+	}
+
+	private synchronized void release( SocketChannel channel ) {
+		open.remove( channel );
+		idle.remove( channel );
+	}
+
+	private void serve( SocketChannel channel ) {
+		try {
+			DataInputStream in = new DataInputStream( new BufferedInputStream( Channels.newInputStream( channel ) ) );
+			DataOutputStream out = new DataOutputStream( new BufferedOutputStream( Channels.newOutputStream( channel ) ) );
+			while ( true ) {
+				int length;
+				try {
+					length = in.readInt();
+				} catch ( EOFException exception ) {
+					// The client closed the connection
+					break;
+				}
+				if ( ! setIdle( channel, false ) )
+					break;
+				byte[] request = new byte[ length ];
+				in.readFully( request );
+				byte[] response = handle( request );
+				write( out, response );
+				if ( ! setIdle( channel, true ) )
+					break;
+			}
+		} catch ( ClosedChannelException exception ) {
+			// Closed by admit() to make room for another connection
+		} catch ( IOException exception ) {
+			System.err.println( "JasperServer: Binary RPC: " + exception );
+		} finally {
+			release( channel );
+			close( channel );
+		}
+	}
+
+	/* Answers the first request of a connection with a RETRY_LATER fault and closes it */
+	private void reject( SocketChannel channel ) {
+		try {
+			DataInputStream in = new DataInputStream( new BufferedInputStream( Channels.newInputStream( channel ) ) );
+			DataOutputStream out = new DataOutputStream( new BufferedOutputStream( Channels.newOutputStream( channel ) ) );
+			in.readFully( new byte[ in.readInt() ] );
+			write( out, encode( fault( new org.apache.xmlrpc.XmlRpcException( JasperServer.RETRY_LATER,
+				"JasperServer is overloaded (" + maxConnections + " connections in progress), retry later." ) ) ) );
+		} catch ( IOException exception ) {
+			System.err.println( "JasperServer: Binary RPC: " + exception );
+		} finally {
+			close( channel );
+		}
+	}
+
+	private static void write( DataOutputStream out, byte[] response ) throws IOException {
+		out.writeInt( response.length );
+		out.write( response );
+		out.flush();
+	}
+
+	private static void close( SocketChannel channel ) {
+		try {
+			channel.close();
+		} catch ( IOException exception ) {
+		}
+	}
+
+	private byte[] handle( byte[] request ) throws IOException {
+		Object[] response;
+		try {
+			List call = (List)BinaryCodec.readValue( new DataInputStream( new ByteArrayInputStream( request ) ) );
+			response = new Object[] { new Integer( OK ), invoke( (String)call.get( 0 ), (Object[])toXmlRpc( call.get( 1 ) ) ) };
+		} catch ( InvocationTargetException exception ) {
+			response = fault( exception.getCause() );
+		} catch ( Exception exception ) {
+			response = fault( exception );
+		}
+		return encode( response );
+	}
+
+	private static byte[] encode( Object[] response ) throws IOException {
+		ByteArrayOutputStream buffer = new ByteArrayOutputStream();
+		BinaryCodec.writeValue( new DataOutputStream( buffer ), response );
+		return buffer.toByteArray();
+	}
+
+	private static Object[] fault( Throwable exception ) {
+		// The same fault code and string the XML-RPC server would send
+		String message = exception.getMessage();
+		if ( message == null )
+			message = exception.toString();
+		int code = 0;
+		if ( exception instanceof org.apache.xmlrpc.XmlRpcException )
+			code = ((org.apache.xmlrpc.XmlRpcException)exception).code;
+		return new Object[] { new Integer( FAULT ), new Integer( code ), message };
+	}
+
+	/* Calls the public method of a new handler as PropertyHandlerMapping does */
+	private static Object invoke( String name, Object[] args ) throws Exception {
+		if ( name.startsWith( "Report." ) )
+			name = name.substring( 7 );
+		Method[] methods = JasperServer.class.getMethods();
+		for ( int i = 0; i < methods.length; i++ ) {
+			Method method = methods[i];
+			if ( method.getName().equals( name ) && method.getParameterTypes().length == args.length
+					&& method.getDeclaringClass() == JasperServer.class ) {
+				Object handler = null;
+				if ( ! Modifier.isStatic( method.getModifiers() ) )
+					handler = new JasperServer();
+				return method.invoke( handler, args );
+			}
+		}
+		throw new NoSuchMethodException( "No such handler: Report." + name );
+	}
+
+	/* Converts decoded values to the types the XML-RPC server gives to handlers */
+	private static Object toXmlRpc( Object value ) {
+		if ( value instanceof Long ) {
+			long n = ((Long)value).longValue();
+			if ( n >= Integer.MIN_VALUE && n <= Integer.MAX_VALUE )
+				return new Integer( (int)n );
+		} else if ( value instanceof java.math.BigDecimal ) {
+			return new Double( ((java.math.BigDecimal)value).doubleValue() );
+		} else if ( value instanceof List ) {
+			List list = (List)value;
+			Object[] array = new Object[ list.size() ];
+			for ( int i = 0; i < array.length; i++ )
+				array[i] = toXmlRpc( list.get( i ) );
+			return array;
+		} else if ( value instanceof Map ) {
+			Hashtable table = new Hashtable();
+			Iterator it = ((Map)value).entrySet().iterator();
+			while ( it.hasNext() ) {
+				Map.Entry entry = (Map.Entry)it.next();
+				// Hashtable does not accept null values, nor does XML-RPC
+				if ( entry.getValue() != null )
+					table.put( entry.getKey(), toXmlRpc( entry.getValue() ) );
+			}
+			return table;
+		}
+		return value;
+	}
+}
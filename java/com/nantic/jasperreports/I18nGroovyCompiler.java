@@ -18,7 +18,7 @@ import java.util.List;
 
 public class I18nGroovyCompiler extends JRGroovyCompiler {
 	static public List sourceCodeList = null; 
-	static private String newImport = "import com.nantic.jasperreports.Translator;\nimport com.nantic.jasperreports.CsvMultiLanguageDataSource;\nimport net.sf.jasperreports.engine.JRDataSource;";
+	static private String newImport = "import com.nantic.jasperreports.Translator;\nimport com.nantic.jasperreports.CsvMultiLanguageDataSource;\nimport com.nantic.jasperreports.BinaryMultiLanguageDataSource;\nimport net.sf.jasperreports.engine.JRDataSource;";
 	static private String newVariable = "public Translator translator = null;\n";
 	static private String returnTranslator = 
 		"if (translator == null) {\n" + 
@@ -29,6 +29,8 @@ public class I18nGroovyCompiler extends JRGroovyCompiler {
 		"	JRDataSource dataSource = (JRDataSource)parameter_REPORT_PARAMETERS_MAP.getValue().get(\"REPORT_DATA_SOURCE\");\n" + 
 		"	if (dataSource.class == CsvMultiLanguageDataSource) {\n" + 
 		"		translator = ((CsvMultiLanguageDataSource)dataSource).getTranslator();\n" +
+		"	} else if (dataSource.class == BinaryMultiLanguageDataSource) {\n" + 
+		"		translator = ((BinaryMultiLanguageDataSource)dataSource).getTranslator();\n" +
 		"	} else if (translator == parameter_REPORT_PARAMETERS_MAP.getValue().containsKey(\"TRANSLATOR\")){\n"+
 		"		translator = (CsvMultiLanguageDataSource)parameter_TRANSLATOR.getValue();\n" + 
 		"	} else {\n" +
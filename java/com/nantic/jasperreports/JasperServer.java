@@ -22,6 +22,13 @@ import net.sf.jasperreports.engine.design.JasperDesign;
 import net.sf.jasperreports.engine.data.JRXmlDataSource;
 import net.sf.jasperreports.engine.data.JRCsvDataSource;
 import net.sf.jasperreports.engine.JREmptyDataSource;
+import net.sf.jasperreports.engine.fill.JRAbstractLRUVirtualizer;
+import net.sf.jasperreports.engine.fill.JRFileVirtualizer;
+import net.sf.jasperreports.engine.fill.JRSwapFileVirtualizer;
+import net.sf.jasperreports.engine.util.JRSwapFile;
+
+import org.postgresql.PGConnection;
+import org.postgresql.copy.CopyManager;
 
 // Exporters
 import net.sf.jasperreports.engine.JRAbstractExporter;
@@ -30,6 +37,7 @@ import net.sf.jasperreports.engine.export.JRPdfExporter;
 import net.sf.jasperreports.engine.export.JRRtfExporter;
 import net.sf.jasperreports.engine.export.JRCsvExporter;
 import net.sf.jasperreports.engine.export.JRXlsExporter;
+import net.sf.jasperreports.engine.export.ooxml.JRXlsxExporter;
 import net.sf.jasperreports.engine.export.JRTextExporter;
 import net.sf.jasperreports.engine.export.oasis.JROdtExporter;
 import net.sf.jasperreports.engine.export.oasis.JROdsExporter;
@@ -38,9 +46,11 @@ import net.sf.jasperreports.export.SimpleHtmlExporterConfiguration;
 import net.sf.jasperreports.export.SimpleOutputStreamExporterOutput;
 import net.sf.jasperreports.export.SimpleTextReportConfiguration;
 import net.sf.jasperreports.export.SimpleXlsReportConfiguration;
+import net.sf.jasperreports.export.SimpleXlsxReportConfiguration;
 
 import java.text.NumberFormat;
 import java.lang.Object;
+import java.util.ArrayList;
 import java.util.Date;
 import java.util.Iterator;
 import java.util.List;
@@ -52,6 +62,10 @@ import java.util.Hashtable;
 import java.io.ByteArrayInputStream;
 import java.io.*;
 import java.sql.*;
+import java.lang.management.ManagementFactory;
+import java.util.concurrent.ConcurrentHashMap;
+import java.util.concurrent.Semaphore;
+import java.util.concurrent.atomic.AtomicInteger;
 import java.lang.Class;
 import java.math.BigDecimal;
 import java.io.InputStream;
@@ -60,6 +74,53 @@ import java.util.Locale;
 
 
 public class JasperServer { 
+	/* Temporary table where the ids of SQL reports are staged (see loadIds) */
+	public static final String IDS_TABLE = "jasper_ids";
+
+	/* Fault code of calls the client should retry later */
+	public static final int RETRY_LATER = 503;
+
+	private static final AtomicInteger renders = new AtomicInteger();
+	private static final AtomicInteger activeRenders = new AtomicInteger();
+	// Set by drain() once the process is going to be recycled
+	private static volatile boolean draining = false;
+	// Seconds a draining process waits for the reports in progress before
+	// exiting (DRAIN_TIMEOUT of JasperServer.py)
+	public static final int DRAIN_TIMEOUT = 300;
+
+	// Limits given in the command line: concurrent fills and exports (0 means
+	// unlimited) and reports waiting for one of them (-1 means unlimited).
+	private static int maxFills = 0;
+	private static int maxPending = -1;
+	private static Semaphore fills = null;
+	private static final AtomicInteger pendingRenders = new AtomicInteger();
+
+	// Compilations and compile calls answered by an up to date .jasper file
+	private static final AtomicInteger compiles = new AtomicInteger();
+	private static final AtomicInteger compileCacheHits = new AtomicInteger();
+	private static final ConcurrentHashMap<String, ReportTimes> reportTimes = new ConcurrentHashMap<String, ReportTimes>();
+
+	/* Accumulated fill and export times of a report */
+	private static class ReportTimes {
+		private int renders = 0;
+		private long fillMillis = 0;
+		private long exportMillis = 0;
+
+		public synchronized void add( long fill, long export ) {
+			renders++;
+			fillMillis += fill;
+			exportMillis += export;
+		}
+
+		public synchronized Hashtable toHashtable() {
+			Hashtable times = new Hashtable();
+			times.put( "renders", new Integer( renders ) );
+			times.put( "averageFill", new Integer( (int)( fillMillis / renders ) ) );
+			times.put( "averageExport", new Integer( (int)( exportMillis / renders ) ) );
+			return times;
+		}
+	}
+
 	/* Compiles the given .jrxml (inputFile) */
 	public Boolean compile( String jrxmlPath ) throws java.lang.Exception {
 		File jrxmlFile;
@@ -73,6 +134,9 @@ public class JasperServer {
 			System.out.println( "JasperServer: Compiling " + jrxmlPath ) ;
 			JasperCompileManager.compileReportToFile( jrxmlPath, jasperPath( jrxmlPath ) );
 			System.out.println( "JasperServer: Compiled.");
+			compiles.incrementAndGet();
+		} else {
+			compileCacheHits.incrementAndGet();
 		}
 		return true;
 	}
@@ -93,19 +157,131 @@ public class JasperServer {
 	}
 
 	public int execute( Hashtable connectionParameters, String jrxmlPath, String outputPath, Hashtable parameters) throws java.lang.Exception {
+		// Counted before checking draining so drain() callers waiting for
+		// activeRenders to reach 0 never miss a render
+		activeRenders.incrementAndGet();
+		if ( draining ) {
+			activeRenders.decrementAndGet();
+			throw new XmlRpcException( RETRY_LATER, "JasperServer is being recycled, retry later." );
+		}
 		try {
-			return privateExecute( connectionParameters, jrxmlPath, outputPath, parameters );
+			acquireFill();
+			try {
+				return privateExecute( connectionParameters, jrxmlPath, outputPath, parameters );
+			} finally {
+				// Reports refused by acquireFill are not renders
+				renders.incrementAndGet();
+				if ( fills != null )
+					fills.release();
+			}
 		} catch (Exception exception) {
 			//exception.printStackTrace();
 			throw exception;
+		} finally {
+			activeRenders.decrementAndGet();
+		}
+	}
+
+	/* Waits for a fill slot or rejects the report if too many are waiting */
+	private static void acquireFill() throws XmlRpcException, InterruptedException {
+		if ( fills == null || fills.tryAcquire() )
+			return;
+		if ( maxPending >= 0 && pendingRenders.incrementAndGet() > maxPending ) {
+			pendingRenders.decrementAndGet();
+			throw new XmlRpcException( RETRY_LATER, "JasperServer is overloaded (" + maxFills + " reports in progress and "
+				+ maxPending + " waiting), retry later." );
+		}
+		if ( maxPending < 0 )
+			pendingRenders.incrementAndGet();
+		try {
+			fills.acquire();
+		} finally {
+			pendingRenders.decrementAndGet();
 		}
 	}
 
+	/*
+	Stops accepting reports so the process can be recycled once activeRenders
+	is 0. The process exits by itself then (or after DRAIN_TIMEOUT seconds) so
+	it is started again by the next report even if the process recycling it
+	died, instead of refusing reports forever.
+	*/
+	public Boolean drain() {
+		synchronized ( JasperServer.class ) {
+			if ( draining )
+				return Boolean.TRUE;
+			draining = true;
+		}
+		System.out.println( "JasperServer: Draining, " + activeRenders.get() + " reports in progress." );
+		Thread thread = new Thread( new Runnable() {
+			public void run() {
+				long end = System.currentTimeMillis() + DRAIN_TIMEOUT * 1000L;
+				try {
+					while ( activeRenders.get() > 0 && System.currentTimeMillis() < end )
+						Thread.sleep( 100 );
+				} catch ( InterruptedException exception ) {
+				}
+				System.out.println( "JasperServer: Drained, exiting with " + activeRenders.get() + " reports in progress." );
+				System.exit( 0 );
+			}
+		}, "JasperServer drain" );
+		thread.start();
+		return Boolean.TRUE;
+	}
+
+	/* Returns memory (in kilobytes), render and compile counters of the
+	   process and the average fill and export times (in milliseconds) of each
+	   report by name */
+	public Hashtable stats() {
+		Runtime runtime = Runtime.getRuntime();
+		Hashtable stats = new Hashtable();
+		stats.put( "heapUsed", kilobytes( runtime.totalMemory() - runtime.freeMemory() ) );
+		stats.put( "heapCommitted", kilobytes( runtime.totalMemory() ) );
+		stats.put( "heapMax", kilobytes( runtime.maxMemory() ) );
+		stats.put( "rss", new Integer( residentSetSize() ) );
+		stats.put( "renders", new Integer( renders.get() ) );
+		stats.put( "activeRenders", new Integer( activeRenders.get() ) );
+		stats.put( "pendingRenders", new Integer( pendingRenders.get() ) );
+		stats.put( "draining", Boolean.valueOf( draining ) );
+		stats.put( "compiles", new Integer( compiles.get() ) );
+		stats.put( "compileCacheHits", new Integer( compileCacheHits.get() ) );
+		Hashtable reports = new Hashtable();
+		Iterator<Map.Entry<String, ReportTimes>> it = reportTimes.entrySet().iterator();
+		while ( it.hasNext() ) {
+			Map.Entry<String, ReportTimes> entry = it.next();
+			reports.put( entry.getKey(), entry.getValue().toHashtable() );
+		}
+		stats.put( "reports", reports );
+		stats.put( "uptime", new Integer( (int)( ManagementFactory.getRuntimeMXBean().getUptime() / 1000 ) ) );
+		return stats;
+	}
+
+	private static Integer kilobytes( long bytes ) {
+		return new Integer( (int)( bytes / 1024 ) );
+	}
+
+	/* Returns the resident set size of the process in kilobytes or 0 if unknown */
+	private static int residentSetSize() {
+		try {
+			BufferedReader reader = new BufferedReader( new FileReader( "/proc/self/status" ) );
+			try {
+				String line;
+				while ( ( line = reader.readLine() ) != null ) {
+					if ( line.startsWith( "VmRSS:" ) )
+						return Integer.parseInt( line.substring( 6 ).replace( "kB", "" ).trim() );
+				}
+			} finally {
+				reader.close();
+			}
+		} catch ( Exception exception ) {
+		}
+		return 0;
+	}
+
 	public int privateExecute( Hashtable connectionParameters, String jrxmlPath, String outputPath, Hashtable parameters) throws java.lang.Exception {
 
 		JasperReport report = null;
 		byte[] result = null;
-		JasperPrint jasperPrint = null;
 		InputStream in = null;
 		int index;
 
@@ -159,7 +335,10 @@ public class JasperServer {
 					compile( (String)m.get("jrxmlFile") );
 
 				// Create DataSource for subreport
-				CsvMultiLanguageDataSource dataSource = new CsvMultiLanguageDataSource( (String)m.get("dataFile"), "utf-8", translator );
+				String dataFormat = "csv";
+				if ( m.containsKey("dataFormat") )
+					dataFormat = (String)m.get("dataFormat");
+				JRRewindableDataSource dataSource = createDataSource( (String)m.get("dataFile"), dataFormat, translator );
 				System.out.println( "JasperServer: Adding parameter '" + ( (String)m.get("parameter") ) + "' with datasource '" + ( (String)m.get("dataFile") ) + "'" );
 
 				parameters.put( m.get("parameter"), dataSource );
@@ -175,7 +354,50 @@ public class JasperServer {
 			parameters.put( JRParameter.IS_IGNORE_PAGINATION, Boolean.TRUE );
 
 
+		// Page the filled report to disk if Python asked for it so heap
+		// usage does not grow with the size of the report.
+		JRAbstractLRUVirtualizer virtualizer = null;
+		if ( connectionParameters.containsKey( "virtualizer" ) ) {
+			virtualizer = createVirtualizer( (Map)connectionParameters.get( "virtualizer" ) );
+			parameters.put( JRParameter.REPORT_VIRTUALIZER, virtualizer );
+		}
+
+		// Previews only fill the first records of the main data source
+		if ( connectionParameters.containsKey( "maxRecords" ) )
+			parameters.put( JRParameter.REPORT_MAX_COUNT, (Integer)connectionParameters.get( "maxRecords" ) );
+
+		try {
+			return fillAndExport( report, connectionParameters, parameters, translator, output, outputPath, virtualizer );
+		} finally {
+			if ( virtualizer != null )
+				virtualizer.cleanup();
+		}
+	}
+
+	public static JRAbstractLRUVirtualizer createVirtualizer( Map options ) {
+		String type = "file";
+		if ( options.containsKey( "type" ) )
+			type = (String)options.get( "type" );
+		String directory = System.getProperty( "java.io.tmpdir" );
+		if ( options.containsKey( "directory" ) )
+			directory = (String)options.get( "directory" );
+		int maxSize = 100;
+		if ( options.containsKey( "maxSize" ) )
+			maxSize = ((Integer)options.get( "maxSize" )).intValue();
+
+		System.out.println( "JasperServer: Using " + type + " virtualizer in " + directory + " keeping " + maxSize + " pages in memory" );
+		if ( type.equalsIgnoreCase( "swap" ) ) {
+			JRSwapFile swapFile = new JRSwapFile( directory, 4096, 100 );
+			return new JRSwapFileVirtualizer( maxSize, swapFile, true );
+		}
+		return new JRFileVirtualizer( maxSize, directory );
+	}
+
+	private int fillAndExport( JasperReport report, Hashtable connectionParameters, Hashtable parameters, Translator translator, String output, String outputPath, JRAbstractLRUVirtualizer virtualizer ) throws java.lang.Exception {
+		JasperPrint jasperPrint = null;
+
 		System.out.println( "JasperServer: Filling report..." );
+		long fillStart = System.currentTimeMillis();
 
 		// Fill in report
 		String language;
@@ -185,26 +407,47 @@ public class JasperServer {
 			language = report.getQuery().getLanguage();
 
 		if( language.equalsIgnoreCase( "XPATH")  ){
-			// If available, use a CSV file because it's faster to process.
-			// Otherwise we'll use an XML file.
-			if ( connectionParameters.containsKey("csv") ) {
-				CsvMultiLanguageDataSource dataSource = new CsvMultiLanguageDataSource( (String)connectionParameters.get("csv"), "utf-8", translator );
+			// If available, use a binary or CSV file because they are faster
+			// to process. Otherwise we'll use an XML file.
+			if ( connectionParameters.containsKey("binary") ) {
+				JRRewindableDataSource dataSource = createDataSource( (String)connectionParameters.get("binary"), "binary", translator );
+				jasperPrint = JasperFillManager.fillReport( report, parameters, dataSource );
+			} else if ( connectionParameters.containsKey("csv") ) {
+				JRRewindableDataSource dataSource = createDataSource( (String)connectionParameters.get("csv"), "csv", translator );
 				jasperPrint = JasperFillManager.fillReport( report, parameters, dataSource );
 			} else {
-				JRXmlDataSource dataSource = new JRXmlDataSource( (String)connectionParameters.get("xml"), "/data/record" );
-				dataSource.setDatePattern( "yyyy-MM-dd HH:mm:ss" );
-				dataSource.setNumberPattern( "#######0.##" );
-				dataSource.setLocale( Locale.ENGLISH );
+				JRRewindableDataSource dataSource = createDataSource( (String)connectionParameters.get("xml"), "xml", translator );
 				jasperPrint = JasperFillManager.fillReport( report, parameters, dataSource );
 			}
 		} else if( language.equalsIgnoreCase( "SQL")  ) {
 			Connection connection = getConnection( connectionParameters );
-			jasperPrint = JasperFillManager.fillReport( report, parameters, connection );
+			try {
+				if ( connectionParameters.containsKey( "ids" ) )
+					loadIds( connection, (String)connectionParameters.get( "ids" ), parameters );
+				jasperPrint = JasperFillManager.fillReport( report, parameters, connection );
+			} finally {
+				connection.close();
+			}
 		} else {
 			JREmptyDataSource dataSource = new JREmptyDataSource();
 			jasperPrint = JasperFillManager.fillReport( report, parameters, dataSource );
 		}
 
+		// Previews only export the first maxPages pages but return the number
+		// of filled ones so the number of pages of the report can be estimated
+		int pages = jasperPrint.getPages().size();
+		if ( connectionParameters.containsKey( "maxPages" ) ) {
+			int maxPages = ((Integer)connectionParameters.get( "maxPages" )).intValue();
+			while ( jasperPrint.getPages().size() > maxPages )
+				jasperPrint.removePage( jasperPrint.getPages().size() - 1 );
+		}
+
+		// No more pages will be added so the virtualizer can stop tracking changes
+		if ( virtualizer != null )
+			virtualizer.setReadOnly( true );
+
+		long exportStart = System.currentTimeMillis();
+
 		// Create output file
 		File outputFile = new File( outputPath );
 		JRAbstractExporter exporter;
@@ -232,6 +475,20 @@ public class JasperServer {
             exporterConfiguration.setWhitePageBackground(Boolean.TRUE);
             exporterConfiguration.setMaxRowsPerSheet(65535);
             exporter.setConfiguration(exporterConfiguration);
+		} else if ( output.equalsIgnoreCase( "xlsx" ) ) {
+			// Pagination is kept (unlike xls) so filled pages can be paged out
+			// by the virtualizer. The exporter writes each sheet through
+			// buffered temporary files instead of building the workbook in
+			// memory and starts a new sheet when the xlsx row limit is reached.
+			exporter = new JRXlsxExporter();
+			SimpleXlsxReportConfiguration exporterConfiguration = new SimpleXlsxReportConfiguration();
+			exporterConfiguration.setOnePagePerSheet(Boolean.FALSE);
+			exporterConfiguration.setRemoveEmptySpaceBetweenColumns(Boolean.TRUE);
+			exporterConfiguration.setRemoveEmptySpaceBetweenRows(Boolean.TRUE);
+			exporterConfiguration.setDetectCellType(Boolean.TRUE);
+			exporterConfiguration.setWhitePageBackground(Boolean.TRUE);
+			exporterConfiguration.setMaxRowsPerSheet(1048575);
+			exporter.setConfiguration(exporterConfiguration);
 		} else if ( output.equalsIgnoreCase( "rtf" ) ) {
 			exporter = new JRRtfExporter();
 		} else if ( output.equalsIgnoreCase( "odt" ) ) {
@@ -251,7 +508,73 @@ public class JasperServer {
 		exporter.setExporterOutput(new SimpleOutputStreamExporterOutput(outputFile));
 		exporter.exportReport();
 		System.out.println( "JasperServer: Exported." );
-		return jasperPrint.getPages().size(); 
+		long exportEnd = System.currentTimeMillis();
+		ReportTimes times = reportTimes.get( report.getName() );
+		if ( times == null ) {
+			// Added with its first sample so stats() never sees it empty
+			times = new ReportTimes();
+			times.add( exportStart - fillStart, exportEnd - exportStart );
+			times = reportTimes.putIfAbsent( report.getName(), times );
+		}
+		if ( times != null )
+			times.add( exportStart - fillStart, exportEnd - exportStart );
+		return pages;
+	}
+
+	/* Creates the data source for a data file generated by Python in the given format */
+	public static JRRewindableDataSource createDataSource( String fileName, String dataFormat, Translator translator ) throws java.lang.Exception {
+		if ( dataFormat.equalsIgnoreCase( "binary" ) )
+			return new BinaryMultiLanguageDataSource( fileName, translator );
+		if ( dataFormat.equalsIgnoreCase( "xml" ) ) {
+			XmlMultiLanguageDataSource dataSource = new XmlMultiLanguageDataSource( fileName, "/data/record" );
+			dataSource.setDatePattern( "yyyy-MM-dd HH:mm:ss" );
+			dataSource.setNumberPattern( "#######0.##" );
+			dataSource.setLocale( Locale.ENGLISH );
+			return dataSource;
+		}
+		return new CsvMultiLanguageDataSource( fileName, "utf-8", translator );
+	}
+
+	/*
+	Stages the ids written by Python (one per line) in the IDS_TABLE temporary
+	table of the connection so SQL reports can join against it instead of
+	expanding a huge IN list. The order of the ids is kept in its sequence
+	column. The IDS parameter is still filled for reports that use it.
+	*/
+	public static void loadIds( Connection connection, String fileName, Hashtable parameters ) throws java.lang.Exception {
+		Statement statement = connection.createStatement();
+		try {
+			statement.execute( "CREATE TEMPORARY TABLE " + IDS_TABLE + " (sequence SERIAL, id INTEGER NOT NULL)" );
+			CopyManager copyManager = ((PGConnection)connection).getCopyAPI();
+			InputStream in = new BufferedInputStream( new FileInputStream( fileName ) );
+			try {
+				long count = copyManager.copyIn( "COPY " + IDS_TABLE + " (id) FROM STDIN", in );
+				System.out.println( "JasperServer: Staged " + count + " ids in " + IDS_TABLE );
+			} finally {
+				in.close();
+			}
+			statement.execute( "ANALYZE " + IDS_TABLE );
+		} finally {
+			statement.close();
+		}
+		parameters.put( "IDS_TABLE", IDS_TABLE );
+
+		// Filled with the same type XML-RPC gives to arrays (Object[])
+		if ( ! parameters.containsKey( "IDS" ) ) {
+			List<Integer> ids = new ArrayList<Integer>();
+			BufferedReader reader = new BufferedReader( new FileReader( fileName ) );
+			try {
+				String line;
+				while ( ( line = reader.readLine() ) != null ) {
+					line = line.trim();
+					if ( line.length() > 0 )
+						ids.add( Integer.valueOf( line ) );
+				}
+			} finally {
+				reader.close();
+			}
+			parameters.put( "IDS", ids.toArray() );
+		}
 	}
 
 	public static Connection getConnection( Hashtable datasource ) throws java.lang.ClassNotFoundException, java.sql.SQLException { 
@@ -266,19 +589,50 @@ public class JasperServer {
 	public static void main (String [] args) {
 		try {
 			int port = 8090;
-			if ( args.length > 0 ) {
-				port = java.lang.Integer.parseInt( args[0] );
+			String socketPath = null;
+			for ( int i = 0; i < args.length; i++ ) {
+				if ( args[i].startsWith( "--socket=" ) )
+					socketPath = args[i].substring( 9 );
+				else if ( args[i].startsWith( "--max-fills=" ) )
+					maxFills = java.lang.Integer.parseInt( args[i].substring( 12 ) );
+				else if ( args[i].startsWith( "--queue-size=" ) )
+					maxPending = java.lang.Integer.parseInt( args[i].substring( 13 ) );
+				else
+					port = java.lang.Integer.parseInt( args[i] );
 			}
+			// Connections the binary transport serves at the same time (0
+			// means unlimited), as the threads of the XML-RPC server
+			int maxConnections = 0;
 			java.net.InetAddress localhost = java.net.Inet4Address.getByName("localhost");
 			System.out.println("JasperServer: Attempting to start XML-RPC Server at " + localhost.toString() + ":" + port + "...");
 			WebServer server = new WebServer( port, localhost );
 			XmlRpcServer xmlRpcServer = server.getXmlRpcServer();
+			if ( maxFills > 0 ) {
+				fills = new Semaphore( maxFills, true );
+				System.out.println("JasperServer: Filling at most " + maxFills + " reports at a time, " + ( maxPending < 0 ? "unlimited" : "" + maxPending ) + " waiting.");
+				// Enough threads for the reports in progress and waiting plus
+				// some to reject the overflow and answer stats calls.
+				if ( maxPending >= 0 ) {
+					maxConnections = maxFills + maxPending + 4;
+					xmlRpcServer.setMaxThreads( maxConnections );
+				}
+			}
 
 			PropertyHandlerMapping phm = new PropertyHandlerMapping();
 			phm.addHandler("Report", JasperServer.class);
 			xmlRpcServer.setHandlerMapping(phm);
 
 			server.start();
+
+			// The binary transport is optional, XML-RPC is always available
+			if ( socketPath != null ) {
+				try {
+					new BinaryRpcServer( socketPath, maxConnections ).start();
+					System.out.println("JasperServer: Binary RPC listening at " + socketPath);
+				} catch ( Throwable exception ) {
+					System.err.println("JasperServer: Could not start binary RPC at " + socketPath + ": " + exception);
+				}
+			}
 			System.out.println("JasperServer: Started successfully.");
 			System.out.println("JasperServer: Accepting requests. (Halt program to stop.)");
 		} catch (Exception exception) {
@@ -10,44 +10,75 @@ import net.sf.jasperreports.engine.design.JRDesignField;
 import java.io.*;
 import java.text.NumberFormat;
 import java.text.SimpleDateFormat;
+import java.util.HashMap;
 import java.util.Locale;
+import java.util.Map;
 
 
 /*
 This class overrides getFieldValue() from JRXmlDataSource to parse
 java.lang.Object fields that will come from Python coded with data
 for each language.
+
+Field descriptions are absolute paths (/data/record/amount) but the
+values of each record are nested under its record element, so they are
+evaluated relative to the current record (amount). Fields without a
+description are looked up by their name, as Python writes them.
 */
 public class XmlMultiLanguageDataSource extends JRXmlDataSource {
+	private static final String RECORD_PATH = "/data/record/";
+
+	// Fields with their relative description by name
+	private Map<String, JRField> fields = new HashMap<String, JRField>();
+
 	public XmlMultiLanguageDataSource(String uri, String selectExpression) throws JRException {
 		super(uri, selectExpression);
 	}
 
+	protected JRField relativeField(JRField jrField) {
+		JRField field = fields.get( jrField.getName() );
+		if ( field == null ) {
+			String description = jrField.getDescription();
+			if ( description == null || description.trim().length() == 0 )
+				description = jrField.getName();
+			description = description.trim();
+			if ( description.startsWith( RECORD_PATH ) )
+				description = description.substring( RECORD_PATH.length() );
+			JRDesignField fakeField = new JRDesignField();
+			fakeField.setName( jrField.getName() );
+			fakeField.setDescription( description );
+			if ( jrField.getValueClassName().equals( "java.lang.Object" ) ) {
+				fakeField.setValueClassName( "java.lang.String" );
+				fakeField.setValueClass( String.class );
+			} else {
+				fakeField.setValueClassName( jrField.getValueClassName() );
+				fakeField.setValueClass( jrField.getValueClass() );
+			}
+			field = fakeField;
+			fields.put( jrField.getName(), field );
+		}
+		return field;
+	}
+
 	public Object getFieldValue(JRField jrField) throws JRException {
 		Object value;
 		if ( jrField.getValueClassName().equals( "java.lang.Object" ) ) {
-			JRDesignField fakeField = new JRDesignField();
-			fakeField.setName( jrField.getName() );
-			fakeField.setDescription( jrField.getDescription() );
-			fakeField.setValueClassName( "java.lang.String" );
-			fakeField.setValueClass( String.class );
-			value = super.getFieldValue( fakeField );
+			value = super.getFieldValue( relativeField( jrField ) );
 
 			LanguageTable values = new LanguageTable("en_US");
-			String v = (String) value;
+			// Missing values are no translations, as an empty CSV column
+			String v = value == null ? "" : (String) value;
 			String[] p = v.split( "\\|" );
 			for( int j=0; j < p.length ; j++ ) {
 				//System.out.println( p[j] );
 				String[] map = p[j].split( "~" );
-				if ( map.length == 2 ) 
+				if ( map.length == 2 )
 					values.put( map[0], map[1] );
 			}
 			value = (Object)values;
 		} else {
-			value = super.getFieldValue(jrField);
+			value = super.getFieldValue( relativeField( jrField ) );
 		}
 		return value;
 	}
 }
-
-
@@ -0,0 +1,369 @@
+# This file is part jasper_reports module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from trytond.config import config as config_
+from trytond.exceptions import UserError
+from trytond.filestore import filestore
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.tools import grouped_slice, slugify
+from trytond.transaction import Transaction
+
+from .JasperReports import PdfConcatenator
+
+__all__ = ['MassPrint', 'MassPrintChunk']
+
+logger = logging.getLogger(__name__)
+
+# Determines the default number of records rendered by each chunk of a mass
+# print job and how many chunks are rendered at the same time.
+CHUNK_SIZE = config_.getint('jasper', 'mass_print_chunk_size', default=500)
+WORKERS = config_.getint('jasper', 'mass_print_workers', default=2)
+# Determines the seconds after which a job being processed that did not
+# render any chunk is considered interrupted (e.g. by a restart) and can be run
+# again.
+TIMEOUT = config_.getint('jasper', 'mass_print_timeout', default=3600)
+
+STATES = {
+    'readonly': Eval('state') != 'draft',
+    }
+
+
+def store(f, prefix):
+    """
+    Store the content of the file f in the filestore and return its id. The
+    default filestore gets it copied from the file so it is never all in
+    memory, others (set with the class option of the database section) at
+    once.
+    """
+    f.seek(0)
+    if type(filestore).__module__ != 'trytond.filestore':
+        return filestore.set(f.read(), prefix=prefix)
+    digest = hashlib.md5()
+    for block in iter(lambda: f.read(65536), b''):
+        digest.update(block)
+    id = digest.hexdigest()
+    filename = filestore._filename(id, prefix)
+    # Otherwise it is already stored
+    if not os.path.exists(filename):
+        os.makedirs(os.path.dirname(filename), mode=0o770, exist_ok=True)
+        f.seek(0)
+        with open(filename, 'wb') as fp:
+            shutil.copyfileobj(f, fp)
+    return id
+
+
+class MassPrint(ModelSQL, ModelView):
+    'Jasper Mass Print'
+    __name__ = 'jasper_reports.mass_print'
+    report = fields.Many2One('ir.action.report', 'Report', required=True,
+        domain=[
+            ('template_extension', '=', 'jrxml'),
+            ], states=STATES)
+    record_ids = fields.Text('Record IDs', required=True, states=STATES,
+        help='JSON list of the ids of the records of the report model.')
+    data = fields.Text('Data', states=STATES,
+        help='JSON dictionary given as data to the report.')
+    assembly = fields.Selection([
+            ('pdf', 'Merged PDF'),
+            ('zip', 'Zip'),
+            ], 'Assembly', required=True, states=STATES)
+    chunk_size = fields.Integer('Chunk Size', required=True, states=STATES)
+    workers = fields.Integer('Workers', required=True, states=STATES,
+        help='Number of chunks rendered at the same time.')
+    chunks = fields.One2Many('jasper_reports.mass_print.chunk', 'mass_print',
+        'Chunks', readonly=True)
+    progress = fields.Function(fields.Float('Progress', digits=(1, 4)),
+        'get_progress')
+    pages = fields.Integer('Pages', readonly=True)
+    output = fields.Binary('Output', filename='output_name',
+        file_id='output_id', store_prefix='jasper_mass_print', readonly=True)
+    output_name = fields.Char('Output Name', readonly=True)
+    output_id = fields.Char('Output ID', readonly=True)
+    processing_date = fields.Timestamp('Processing Date', readonly=True,
+        help='When a task started processing the job.')
+    state = fields.Selection([
+            ('draft', 'Draft'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'State', readonly=True, required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(MassPrint, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._buttons.update({
+                'run': {
+                    'invisible': Eval('state') == 'done',
+                    'depends': ['state'],
+                    },
+                })
+
+    @staticmethod
+    def default_assembly():
+        return 'pdf'
+
+    @staticmethod
+    def default_chunk_size():
+        return CHUNK_SIZE
+
+    @staticmethod
+    def default_workers():
+        return WORKERS
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @classmethod
+    def get_progress(cls, jobs, name):
+        progress = {}
+        for job in jobs:
+            done = [c for c in job.chunks if c.state == 'done']
+            progress[job.id] = (len(done) / len(job.chunks)
+                if job.chunks else 0.0)
+        return progress
+
+    @classmethod
+    def copy(cls, jobs, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('chunks', None)
+        default.setdefault('pages', None)
+        default.setdefault('output', None)
+        default.setdefault('output_name', None)
+        default.setdefault('output_id', None)
+        default.setdefault('processing_date', None)
+        default.setdefault('state', 'draft')
+        return super(MassPrint, cls).copy(jobs, default=default)
+
+    @classmethod
+    @ModelView.button
+    def run(cls, jobs):
+        """
+        Render the chunks of the jobs that are not done yet. Jobs interrupted
+        by a failure or a restart resume from their last finished chunk.
+        """
+        pool = Pool()
+        Chunk = pool.get('jasper_reports.mass_print.chunk')
+        cls.lock(jobs)
+        for job in jobs:
+            if job.state == 'done':
+                raise UserError('Mass print %d of report "%s" is already '
+                    'done.' % (job.id, job.report.rec_name))
+            if job.is_processing():
+                raise UserError('Mass print %d of report "%s" is being '
+                    'processed.' % (job.id, job.report.rec_name))
+        chunks = []
+        for job in jobs:
+            Report = pool.get(job.report.report_name, type='report')
+            Report.check_access(job.report, job.report.model,
+                job.get_record_ids())
+            if not job.chunks:
+                for sequence, ids in enumerate(grouped_slice(
+                            job.get_record_ids(), max(job.chunk_size, 1))):
+                    chunks.append(Chunk(mass_print=job, sequence=sequence,
+                            record_ids=json.dumps(list(ids))))
+        Chunk.save(chunks)
+        cls.write(jobs, {
+                'state': 'running',
+                'processing_date': None,
+                })
+        # Chunks are rendered and committed by their own transactions so the
+        # job is processed once this transaction is committed
+        cls.__queue__.process(jobs)
+
+    @classmethod
+    def process(cls, jobs):
+        pool = Pool()
+        Chunk = pool.get('jasper_reports.mass_print.chunk')
+        transaction = Transaction()
+        context = dict(transaction.context)
+        # The jobs are marked as being processed and committed at once, so
+        # they are neither locked nor in an open transaction while their
+        # chunks are rendered
+        cls.lock(jobs)
+        jobs = [j for j in jobs
+            if j.state == 'running' and not j.is_processing()]
+        cls.write(jobs, {'processing_date': datetime.datetime.now()})
+        transaction.commit()
+        for job in jobs:
+            workers = max(job.workers, 1)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {}
+                for chunk in job.chunks:
+                    if chunk.state != 'done':
+                        futures[chunk.id] = executor.submit(
+                            Chunk.render_chunk, transaction.database.name,
+                            transaction.user, context, chunk.id)
+                try:
+                    job.assemble(futures)
+                except Exception:
+                    logger.exception('Mass print %s failed' % job.id)
+                    job.state = 'failed'
+                    job.processing_date = None
+                    job.save()
+
+    def is_processing(self):
+        """
+        Return whether a task is processing the job. Its chunks are committed
+        as they are rendered, so it is considered interrupted if none was
+        for TIMEOUT seconds.
+        """
+        if self.state != 'running' or not self.processing_date:
+            return False
+        last = max([self.processing_date]
+            + [c.write_date for c in self.chunks if c.write_date])
+        return (datetime.datetime.now() - last
+            < datetime.timedelta(seconds=TIMEOUT))
+
+    def get_record_ids(self):
+        return json.loads(self.record_ids)
+
+    def get_data(self):
+        data = json.loads(self.data) if self.data else {}
+        # Mass prints never delay interactive reports
+        data.setdefault('priority', 'batch')
+        if self.assembly == 'pdf':
+            data['output_format'] = 'pdf'
+        return data
+
+    def assemble(self, futures):
+        """
+        Build the output from the chunks in sequence order as soon as each one
+        is rendered, taking the output of the chunks finished by previous runs
+        from their checkpoint instead of rendering them again.
+
+        Only the output of one chunk at a time is in memory, the merged PDF or
+        the zip is written to a temporary file as it is built and stored from
+        it.
+        """
+        pool = Pool()
+        Chunk = pool.get('jasper_reports.mass_print.chunk')
+        name = slugify(self.report.name)[:40]
+        pages = 0
+        failed = False
+        with tempfile.TemporaryFile() as output:
+            if self.assembly == 'pdf':
+                writer = PdfConcatenator(output)
+            else:
+                writer = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+            for chunk in sorted(self.chunks, key=lambda c: c.sequence):
+                if chunk.id in futures:
+                    done = futures.pop(chunk.id).result()
+                else:
+                    done = chunk.state == 'done'
+                if not done:
+                    failed = True
+                if failed:
+                    # Keep rendering to checkpoint the remaining chunks
+                    continue
+                if chunk.state != 'done':
+                    # Rendered by this run, so committed after this
+                    # transaction started
+                    with Transaction().new_transaction(readonly=True):
+                        chunk = Chunk(chunk.id)
+                        output_format, data, chunk_pages = (
+                            chunk.output_format, chunk.output, chunk.pages)
+                else:
+                    output_format, data, chunk_pages = (
+                        chunk.output_format, chunk.output, chunk.pages)
+                pages += chunk_pages or 0
+                logger.info('Adding chunk %s of mass print %s' % (
+                        chunk.sequence, self.id))
+                if self.assembly == 'pdf':
+                    writer.append(data)
+                else:
+                    writer.writestr('%s-%05d.%s' % (name, chunk.sequence,
+                            output_format), data)
+            writer.close()
+            self.processing_date = None
+            if failed:
+                self.state = 'failed'
+                self.save()
+                return
+            self.output_id = store(output,
+                self.__class__.output.store_prefix)
+        self.output_name = '%s.%s' % (name, self.assembly)
+        self.pages = pages
+        self.state = 'done'
+        self.save()
+
+
+class MassPrintChunk(ModelSQL, ModelView):
+    'Jasper Mass Print Chunk'
+    __name__ = 'jasper_reports.mass_print.chunk'
+    mass_print = fields.Many2One('jasper_reports.mass_print', 'Mass Print',
+        required=True, ondelete='CASCADE', readonly=True)
+    sequence = fields.Integer('Sequence', required=True, readonly=True)
+    record_ids = fields.Text('Record IDs', required=True, readonly=True)
+    output = fields.Binary('Output', file_id='output_id',
+        store_prefix='jasper_mass_print', readonly=True)
+    output_id = fields.Char('Output ID', readonly=True)
+    output_format = fields.Char('Output Format', readonly=True)
+    pages = fields.Integer('Pages', readonly=True)
+    error = fields.Text('Error', readonly=True)
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'State', readonly=True, required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(MassPrintChunk, cls).__setup__()
+        cls._order.insert(0, ('sequence', 'ASC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @classmethod
+    def render_chunk(cls, database_name, user, context, chunk_id):
+        """
+        Render the chunk in a transaction of its own, committed with the
+        output so it is kept if the job is interrupted. Return whether it was
+        rendered and committed.
+        """
+        try:
+            with Transaction().start(database_name, user, context=context):
+                pool = Pool()
+                chunk = cls(chunk_id)
+                job = chunk.mass_print
+                Report = pool.get(job.report.report_name, type='report')
+                try:
+                    output_format, data, pages = Report.render(job.report,
+                        job.get_data(), job.report.model,
+                        json.loads(chunk.record_ids))
+                except Exception as e:
+                    logger.exception('Chunk %s of mass print %s failed' % (
+                            chunk.sequence, job.id))
+                    chunk.error = str(e)
+                    chunk.state = 'failed'
+                    chunk.save()
+                    return False
+                chunk.output = bytes(data)
+                chunk.output_format = output_format
+                chunk.pages = pages
+                chunk.error = None
+                chunk.state = 'done'
+                chunk.save()
+            return True
+        except Exception:
+            # The transaction could not be started or committed
+            logger.exception('Chunk %s of mass print failed' % chunk_id)
+            return False
@@ -4,7 +4,7 @@
 # the full copyright notices and license terms.
 import sys
 import unicodedata
-from xml.dom.minidom import getDOMImplementation
+from io import BytesIO
 
 from trytond.pool import Pool, PoolMeta
 
@@ -41,56 +41,67 @@ class Model(metaclass=PoolMeta):
         :return file
         """
         IrModel = Pool().get('ir.model')
-        document = getDOMImplementation().createDocument(None, 'data', None)
-        topNode = document.documentElement
-        recordNode = document.createElement('record')
-        topNode.appendChild(recordNode)
-        IrModel.get_jreport_xml(model, recordNode, document, depth)
-        file_data = topNode.toxml()
-        return bytes(file_data, encoding='utf-8')
+        # Fields of each model and XML of each (model, depth) subtree, shared
+        # by all the nodes of the template
+        schema = {}
+        subtrees = {}
+        content = BytesIO()
+        content.write(b'<data><record>')
+        content.write(IrModel.get_jreport_xml(model, depth, schema, subtrees))
+        # Create relation with user
+        content.write(b'<user-user>')
+        content.write(IrModel.get_jreport_xml('res.user', depth - 1, schema,
+                subtrees))
+        content.write(b'</user-user>')
+        content.write(b'</record></data>')
+        return content.getvalue()
 
     @staticmethod
-    def get_jreport_xml(model, parentNode, document, depth=1, first_call=True):
-        """Get data fields XML
+    def get_jreport_fields(model, schema):
+        """Get the (node name, type, relation) of the model fields
         @param model: str
-        @param parentNode: object
-        @param document: object
-        @param depth: str
-        @param first_call: boolean
+        @param schema: dict
         """
-        pool = Pool()
-        IrModel = pool.get('ir.model')
-
-        model = IrModel.search([('name', '=', model)])[0]
-
-        fieldNode = document.createElement('id')
-        parentNode.appendChild(fieldNode)
-        valueNode = document.createTextNode('1')
-        fieldNode.appendChild(valueNode)
-
-        for field in model.fields:
-            if field.name == 'id':
-                continue
+        if model not in schema:
+            IrModel = Pool().get('ir.model')
+            model_ = IrModel.search([('name', '=', model)])[0]
+            fields = []
+            for field in model_.fields:
+                if field.name == 'id':
+                    continue
+                name = IrModel.unaccent(field.name)
+                fields.append(('%s-%s' % (name, name), field.ttype,
+                        field.relation))
+            schema[model] = fields
+        return schema[model]
 
-            name = IrModel.unaccent(field.name)
-            name = '%s-%s' % (name, name)
-            fieldNode = document.createElement(name)
-            parentNode.appendChild(fieldNode)
+    @staticmethod
+    def get_jreport_xml(model, depth, schema, subtrees):
+        """Get data fields XML
+        @param model: str
+        @param depth: int
+        @param schema: dict
+        @param subtrees: dict
+        """
+        key = (model, depth)
+        if key in subtrees:
+            return subtrees[key]
 
-            fieldType = field.ttype
-            if fieldType in ('many2one', 'one2many', 'many2many'):
-                if depth <= 1:
-                    continue
-                newName = field.relation
-                IrModel.get_jreport_xml(newName, fieldNode, document,
-                    depth - 1, False)
-                continue
+        IrModel = Pool().get('ir.model')
+        content = [b'<id>1</id>']
+        for name, ttype, relation in IrModel.get_jreport_fields(model,
+                schema):
+            name = name.encode('utf-8')
+            if (ttype in ('many2one', 'one2many', 'many2many')
+                    and depth > 1):
+                content.append(b'<%s>' % name)
+                content.append(IrModel.get_jreport_xml(relation, depth - 1,
+                        schema, subtrees))
+                content.append(b'</%s>' % name)
+            else:
+                content.append(b'<%s/>' % name)
 
         # TODO: Create relation with attachments
 
-        if first_call:
-            # Create relation with user
-            fieldNode = document.createElement('user-user')
-            parentNode.appendChild(fieldNode)
-            IrModel.get_jreport_xml('res.user', fieldNode, document,
-                depth - 1, False)
+        subtrees[key] = b''.join(content)
+        return subtrees[key]
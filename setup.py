@@ -80,6 +80,7 @@ setup(name='%s_%s' % (PREFIX, MODULE),
     package_data={
         'trytond.modules.%s' % MODULE: (info.get('xml', [])
             + ['tryton.cfg', 'view/*.xml', 'locale/*.po', 'tests/*.rst',
+               'tests/*.jrxml',
                'java/*', 'java/lib/*', 'java/fonts/*', 'java/com/*',
                'java/com/nantic/*', 'java/com/nantic/jasperreports/*',
             ]),
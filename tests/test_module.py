@@ -1,13 +1,1467 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import csv
+import datetime
+import json
+import os
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from decimal import Decimal
+from io import BytesIO, StringIO
+from xmlrpc.client import Fault
+from unittest.mock import Mock, patch
+
+from lxml import etree
+
+from pypdf import PdfReader, PdfWriter
+
+from trytond.exceptions import UserError
+from trytond.model import Model
+from trytond.filestore import filestore
+from trytond.modules.jasper_reports import jasper, mass_print
+from trytond.modules.jasper_reports.JasperReports import (
+    AdmissionController, BinaryBrowseDataGenerator, BinaryRecordDataGenerator,
+    BrowseDataCache, CsvBrowseDataGenerator, CsvRecordDataGenerator,
+    JasperReport, JasperServer, RenderCoalescer, Workspace,
+    WorkspaceQuotaExceeded, XmlRecordDataGenerator)
+from trytond.modules.jasper_reports.JasperReports.BinaryCodec import (
+    END, MAGIC, ROW, BinaryDataWriter, decodeString, decodeValue, encodeValue)
+from trytond.modules.jasper_reports.JasperReports.BinaryRpc import (
+    BinaryRpcProxy)
+from trytond.modules.jasper_reports.JasperReports.AdmissionController \
+    import BATCH, INTERACTIVE
+from trytond.modules.jasper_reports.JasperReports.JasperServer import (
+    RETRY_LATER)
+from trytond.modules.jasper_reports.JasperReports.RenderCoalescer import (
+    OUTPUT_TTL)
+from trytond.modules.jasper_reports.JasperReports.XmlDataWriter import (
+    XmlDataWriter)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+FIXTURES = os.path.dirname(__file__)
+
+
+def pdf(pages):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=100, height=100)
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def jasper_report(*paths, relations=None, types=None):
+    """
+    Return a report with a field for each path, of the Java class given by
+    types or java.lang.String
+    """
+    report = JasperReport()
+    for path in paths:
+        name = path.replace('/', '_')
+        report._fields[path] = {
+            'name': name,
+            'type': (types or {}).get(path, 'java.lang.String'),
+            'description': path,
+            }
+        report._fieldNames.append(name)
+    report._relations = relations or []
+    return report
+
+
+def subreport_infos(report):
+    "Return the infos of the subreports of report without the report objects"
+    infos = []
+    for info in report.subreports():
+        info = info.copy()
+        subreport = info.pop('report')
+        if os.path.isabs(info['filename']):
+            info['filename'] = os.path.relpath(info['filename'], FIXTURES)
+        info['fields'] = {p: f['name'] for p, f in subreport.fields().items()}
+        info['relations'] = subreport.relations()
+        infos.append(info)
+    return infos
+
+
+def generate(generator):
+    "Return the content of the data file written by generator"
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, 'data')
+        generator.generate(fileName)
+        with open(fileName, 'rb') as f:
+            return f.read()
+
+
+def read_binary(data):
+    "Return the column names and the rows of a binary data file"
+    assert data[:len(MAGIC)] == MAGIC
+    offset = len(MAGIC) + 1
+    size, = struct.unpack_from('>i', data, offset)
+    offset += 4
+    names = []
+    for _ in range(size):
+        name, offset = decodeString(data, offset)
+        names.append(name)
+    rows = []
+    while data[offset] == ROW:
+        offset += 1
+        row = {}
+        for name in names:
+            row[name], offset = decodeValue(data, offset)
+        rows.append(row)
+    assert data[offset] == END
+    return names, rows
+
+
+class DictJoinGenerator(CsvBrowseDataGenerator):
+    """
+    The join of the generator before JoinedRecord: a dict copied for each row
+    and the columns of each row generated without the segment cache.
+    """
+    def generateRows(self):
+        for record in self.cache.browse(self.model, self.ids):
+            for records in self.generateIds(record, self.report.relations(),
+                    '', [{'root': record}]):
+                row = {}
+                self.generateCsvRecord(record, records, row, '',
+                    self.report.fields())
+                yield row
+
+    def generateIds(self, record, relations, path, currentRecords):
+        unrepeated = set([field.partition('/')[0] for field in relations])
+        for relation in unrepeated:
+            root = relation.partition('/')[0]
+            currentPath = '%s/%s' % (path, root) if path else root
+            value = getattr(record, root)
+            if isinstance(value, Model):
+                relations2 = [f.partition('/')[2] for f in relations if
+                    f.partition('/')[0] == root and f.partition('/')[2]]
+                return self.generateIds(value, relations2, currentPath,
+                    currentRecords)
+            if value:
+                newRecords = []
+                for v in value:
+                    currentNewRecords = []
+                    for id in currentRecords:
+                        new = id.copy()
+                        new[currentPath] = v
+                        currentNewRecords.append(new)
+                    relations2 = [f.partition('/')[2] for f in relations
+                        if f.partition('/')[0] == root and
+                        f.partition('/')[2]]
+                    newRecords += self.generateIds(v, relations2,
+                        currentPath, currentNewRecords)
+                currentRecords = newRecords
+        return currentRecords
+
+    def generateSegment(self, record, records, row, path, fields):
+        self.generateCsvRecord(record, records, row, path, fields)
+
+
+def start_thread(function, *args):
+    thread = threading.Thread(target=function, args=args)
+    thread.start()
+    return thread
+
+
+def wait_until(condition, timeout=10):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def admit(controller, priority, admitted):
+    "Append priority to admitted once it gets a slot of controller"
+    with controller.slot(priority):
+        admitted.append(priority)
+
 
-from trytond.tests.test_tryton import ModuleTestCase
+def server_calls(server, *results):
+    """
+    Make the calls of server other than drain return each of results in turn,
+    raising it if it is an exception. Return the list of the methods called.
+    """
+    results = iter(results)
+    methods = []
+
+    def call(method, *args):
+        methods.append(method)
+        if method == 'drain':
+            return True
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    server.call = call
+    return methods
+
+
+def process_stats(renders=0, activeRenders=0, rss=0, draining=False):
+    return {
+        'renders': renders,
+        'activeRenders': activeRenders,
+        'rss': rss,
+        'heapUsed': 0,
+        'draining': draining,
+        }
+
+
+class BinaryRpcServer:
+    """
+    Serve in a thread the binary RPC protocol on a Unix domain socket at path:
+    for each list of responses, accept a connection, answer its requests with
+    them and close it. The requests received are kept in requests.
+    """
+    def __init__(self, path, *connections):
+        self.requests = []
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.thread = start_thread(self.serve, connections)
+
+    @staticmethod
+    def receive(connection, size):
+        data = b''
+        while len(data) < size:
+            data += connection.recv(size - len(data))
+        return data
+
+    def serve(self, connections):
+        for responses in connections:
+            connection, _ = self.listener.accept()
+            with connection:
+                for response in responses:
+                    size, = struct.unpack('>i', self.receive(connection, 4))
+                    request = self.receive(connection, size)
+                    self.requests.append(decodeValue(request)[0])
+                    data = bytearray(4)
+                    encodeValue(data, response)
+                    struct.pack_into('>i', data, 0, len(data) - 4)
+                    connection.sendall(data)
+        self.listener.close()
+
+
+class FifoServer:
+    """
+    JasperServer whose execute reads the data file (the fifo) of the
+    connection parameters, up to size bytes if given, and returns it.
+    """
+    def __init__(self, size=None, error=None):
+        self.size = size
+        self.error = error
+
+    def execute(self, connectionParameters, *args):
+        if self.error:
+            raise self.error
+        with open(connectionParameters['csv'], 'rb') as f:
+            return f.read(self.size)
+
+
+class CoalescedRenders:
+    """
+    Renders run through coalescers in threads: each render waits for release
+    and returns its name as output, or raises if it is in failing.
+    """
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.calls = []
+        self.results = {}
+        self.started = threading.Event()
+        self.waiting = threading.Event()
+        self.release = threading.Event()
+
+    def watch(self, coalescer):
+        "Set waiting when a render of coalescer waits for another one"
+        coalescer.logger = Mock()
+        coalescer.logger.info.side_effect = lambda *a: self.waiting.set()
+
+    def render(self, name):
+        self.calls.append(name)
+        self.started.set()
+        self.release.wait(10)
+        if name in self.failing:
+            raise ValueError(name)
+        return ('pdf', name.encode(), 1)
+
+    def run(self, coalescer, name):
+        try:
+            self.results[name] = coalescer.run('key', self.render, name)
+        except ValueError as e:
+            self.results[name] = e
+
+    def leader_and_follower(self, leader_coalescer, follower_coalescer):
+        "Run a render and an identical one started while it is running"
+        self.watch(follower_coalescer)
+        leader = start_thread(self.run, leader_coalescer, 'leader')
+        self.started.wait(10)
+        follower = start_thread(self.run, follower_coalescer, 'follower')
+        self.waiting.wait(10)
+        self.release.set()
+        leader.join(10)
+        follower.join(10)
 
 
 class JasperReportsTestCase(ModuleTestCase):
     'Test JasperReports module'
     module = 'jasper_reports'
 
+    def create_mass_print(self, **values):
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        MassPrint = pool.get('jasper_reports.mass_print')
+        report, = ActionReport.create([{
+                    'name': 'Test Report',
+                    'model': 'res.user',
+                    'report_name': 'jasper_reports.test',
+                    'template_extension': 'jrxml',
+                    }])
+        values.setdefault('record_ids', json.dumps([1, 2, 3]))
+        job, = MassPrint.create([dict(report=report.id, **values)])
+        return job
+
+    def create_chunks(self, job, *chunks):
+        pool = Pool()
+        Chunk = pool.get('jasper_reports.mass_print.chunk')
+        return Chunk.create([dict(mass_print=job.id, sequence=sequence,
+                    record_ids='[]', **values)
+                for sequence, values in enumerate(chunks)])
+
+    @with_transaction()
+    def test_mass_print_assemble_pdf(self):
+        'Test mass print merges the PDF of the chunks in sequence order'
+        pool = Pool()
+        MassPrint = pool.get('jasper_reports.mass_print')
+        job = self.create_mass_print(state='running')
+        self.create_chunks(job,
+            {'state': 'done', 'output': pdf(2), 'output_format': 'pdf',
+                'pages': 2},
+            {'state': 'done', 'output': pdf(3), 'output_format': 'pdf',
+                'pages': 3})
+
+        MassPrint.process([job])
+
+        job = MassPrint(job.id)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.pages, 5)
+        self.assertEqual(job.output_name, 'Test-Report.pdf')
+        self.assertEqual(len(PdfReader(BytesIO(job.output)).pages), 5)
+        self.assertEqual(job.progress, 1)
+
+    @with_transaction()
+    def test_mass_print_assemble_zip(self):
+        'Test mass print zips the output of the chunks'
+        pool = Pool()
+        MassPrint = pool.get('jasper_reports.mass_print')
+        job = self.create_mass_print(state='running', assembly='zip')
+        self.create_chunks(job,
+            {'state': 'done', 'output': b'a', 'output_format': 'xls'},
+            {'state': 'done', 'output': b'b', 'output_format': 'xls'})
+
+        MassPrint.process([job])
+
+        job = MassPrint(job.id)
+        self.assertEqual(job.state, 'done')
+        with zipfile.ZipFile(BytesIO(job.output)) as output:
+            self.assertEqual(output.namelist(),
+                ['Test-Report-00000.xls', 'Test-Report-00001.xls'])
+
+    @with_transaction()
+    def test_mass_print_failed_chunk(self):
+        'Test mass print fails if a chunk is not rendered'
+        pool = Pool()
+        MassPrint = pool.get('jasper_reports.mass_print')
+        Chunk = pool.get('jasper_reports.mass_print.chunk')
+        job = self.create_mass_print(state='running')
+        self.create_chunks(job,
+            {'state': 'done', 'output': pdf(1), 'output_format': 'pdf'},
+            {'state': 'pending'})
+
+        with patch.object(Chunk, 'render_chunk', return_value=False):
+            MassPrint.process([job])
+
+        job = MassPrint(job.id)
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.output, None)
+        self.assertEqual(job.progress, 0.5)
+
+    @with_transaction()
+    def test_mass_print_assemble_error(self):
+        'Test mass print fails if the output can not be assembled'
+        pool = Pool()
+        MassPrint = pool.get('jasper_reports.mass_print')
+        job = self.create_mass_print(state='running')
+        self.create_chunks(job,
+            {'state': 'done', 'output': b'not a pdf', 'output_format': 'pdf'})
+
+        MassPrint.process([job])
+
+        self.assertEqual(MassPrint(job.id).state, 'failed')
+
+    @with_transaction()
+    def test_mass_print_render_chunk_transaction_error(self):
+        'Test a chunk whose transaction can not be started is not rendered'
+        pool = Pool()
+        Chunk = pool.get('jasper_reports.mass_print.chunk')
+        transaction = Transaction()
+        database_name, user = transaction.database.name, transaction.user
+
+        with patch.object(Transaction, 'start', side_effect=Exception):
+            self.assertFalse(Chunk.render_chunk(database_name, user, {}, 1))
+
+    @with_transaction()
+    def test_mass_print_run_done(self):
+        'Test mass print can not be run once it is done'
+        pool = Pool()
+        MassPrint = pool.get('jasper_reports.mass_print')
+        job = self.create_mass_print(state='done')
+
+        with self.assertRaises(UserError):
+            MassPrint.run([job])
+
+    @with_transaction()
+    def test_mass_print_process_not_running(self):
+        'Test mass print is only processed while it is running'
+        pool = Pool()
+        MassPrint = pool.get('jasper_reports.mass_print')
+        job = self.create_mass_print(state='failed')
+        self.create_chunks(job,
+            {'state': 'done', 'output': pdf(1), 'output_format': 'pdf'})
+
+        MassPrint.process([job])
+
+        self.assertEqual(MassPrint(job.id).state, 'failed')
+
+    @with_transaction()
+    def test_mass_print_being_processed(self):
+        'Test mass print is not processed nor run twice at the same time'
+        pool = Pool()
+        MassPrint = pool.get('jasper_reports.mass_print')
+        job = self.create_mass_print(state='running',
+            processing_date=datetime.datetime.now())
+        self.create_chunks(job,
+            {'state': 'done', 'output': pdf(1), 'output_format': 'pdf'})
+
+        MassPrint.process([job])
+        with self.assertRaises(UserError):
+            MassPrint.run([job])
+
+        job = MassPrint(job.id)
+        self.assertEqual(job.state, 'running')
+        self.assertEqual(job.output, None)
+
+    @with_transaction()
+    def test_mass_print_interrupted(self):
+        'Test mass print is processed again once no chunk is rendered'
+        pool = Pool()
+        MassPrint = pool.get('jasper_reports.mass_print')
+        Chunk = pool.get('jasper_reports.mass_print.chunk')
+        interrupted = (datetime.datetime.now()
+            - datetime.timedelta(seconds=mass_print.TIMEOUT + 1))
+        job = self.create_mass_print(state='running',
+            processing_date=interrupted)
+        chunk, = self.create_chunks(job,
+            {'state': 'done', 'output': pdf(1), 'output_format': 'pdf'})
+
+        self.assertFalse(job.is_processing())
+        Chunk.write([chunk], {'pages': 1})
+        # A chunk was rendered since
+        self.assertTrue(MassPrint(job.id).is_processing())
+        with patch.object(mass_print, 'TIMEOUT', 0):
+            MassPrint.process([job])
+
+        job = MassPrint(job.id)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.processing_date, None)
+        self.assertFalse(job.is_processing())
+
+    @with_transaction()
+    def test_mass_print_store(self):
+        'Test the output is stored in the filestore from its file'
+        data = os.urandom(200000)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            with patch.object(filestore, 'set') as set_:
+                id = mass_print.store(f, 'jasper_mass_print')
+                self.assertEqual(mass_print.store(f, 'jasper_mass_print'),
+                    id)
+
+        set_.assert_not_called()
+        self.assertEqual(filestore.get(id, 'jasper_mass_print'), data)
+
+    @with_transaction()
+    def test_mass_print_copy(self):
+        'Test copied mass print is a new draft job'
+        pool = Pool()
+        MassPrint = pool.get('jasper_reports.mass_print')
+        job = self.create_mass_print(state='done', pages=1,
+            output_name='test.pdf')
+        self.create_chunks(job, {'state': 'done'})
+
+        copy, = MassPrint.copy([job])
+
+        self.assertEqual(copy.state, 'draft')
+        self.assertEqual(copy.chunks, ())
+        self.assertEqual(copy.pages, None)
+        self.assertEqual(copy.record_ids, job.record_ids)
+
+    @with_transaction()
+    def test_mass_print_data(self):
+        'Test mass print renders batch PDFs'
+        job = self.create_mass_print(data=json.dumps({'a': 1}))
+
+        self.assertEqual(job.get_data(), {
+                'a': 1,
+                'priority': 'batch',
+                'output_format': 'pdf',
+                })
+
+    def test_jasper_server_needs_recycle(self):
+        'Test the process is recycled after its renders or memory limits'
+        server = JasperServer()
+        server.setRecycle(renders=10, memory=100)
+
+        self.assertFalse(server.needsRecycle(process_stats(renders=9,
+                    rss=100 * 1024 - 1)))
+        self.assertTrue(server.needsRecycle(process_stats(renders=10)))
+        self.assertTrue(server.needsRecycle(process_stats(rss=100 * 1024)))
+        self.assertTrue(server.needsRecycle(process_stats(draining=True)))
+
+    def jasper_server(self, directory):
+        "Return a server whose process is never started nor stopped"
+        server = JasperServer()
+        server.setPidFile(os.path.join(directory, 'jasper.pid'))
+        server.setRecycle(renders=10)
+        server.start = Mock()
+        server.stop = Mock()
+        server.waitReady = Mock(return_value=True)
+        return server
+
+    @patch('time.sleep')
+    def test_jasper_server_recycle(self, sleep):
+        'Test recycle waits for the reports in progress and restarts'
+        with tempfile.TemporaryDirectory() as directory:
+            server = self.jasper_server(directory)
+            methods = server_calls(server, process_stats(renders=10),
+                process_stats(activeRenders=2), process_stats(activeRenders=1),
+                process_stats())
+
+            server.recycle()
+
+        self.assertEqual(methods, ['stats', 'drain', 'stats', 'stats',
+                'stats'])
+        server.stop.assert_called_once_with(server.pidfile)
+        server.start.assert_called_once_with()
+
+    @patch('time.sleep')
+    def test_jasper_server_recycle_exited(self, sleep):
+        'Test recycle restarts a process that exited once drained'
+        with tempfile.TemporaryDirectory() as directory:
+            server = self.jasper_server(directory)
+            server_calls(server, process_stats(renders=10),
+                process_stats(activeRenders=1), ConnectionRefusedError())
+
+            server.recycle()
+
+        server.start.assert_called_once_with()
+
+    def test_jasper_server_recycle_not_needed(self):
+        'Test recycle does nothing if another process already recycled it'
+        with tempfile.TemporaryDirectory() as directory:
+            server = self.jasper_server(directory)
+            methods = server_calls(server, process_stats(renders=1))
+
+            server.recycle()
+
+        self.assertEqual(methods, ['stats'])
+        server.start.assert_not_called()
+
+    def test_jasper_server_after_execute_recycle(self):
+        'Test a report starts the recycle of the process without waiting'
+        server = JasperServer()
+        server.setRecycle(renders=10)
+        recycled = threading.Event()
+        server.recycle = Mock(side_effect=recycled.set)
+        server_calls(server, process_stats(renders=10))
+
+        server.afterExecute()
+
+        self.assertTrue(recycled.wait(10))
+
+    @patch('time.sleep')
+    def test_jasper_server_execute_retry(self, sleep):
+        'Test reports refused while recycling or overloaded are retried'
+        server = JasperServer()
+        server.ensureStarted = Mock()
+        methods = server_calls(server, Fault(RETRY_LATER, 'draining'),
+            Fault(RETRY_LATER, 'overloaded'), 3)
+
+        self.assertEqual(server.execute(), 3)
+        self.assertEqual(methods, ['execute'] * 3)
+        server.ensureStarted.assert_not_called()
+
+    @patch('time.sleep')
+    def test_jasper_server_execute_start(self, sleep):
+        'Test the process is started by the report that finds it down'
+        server = JasperServer()
+        server.ensureStarted = Mock()
+        server_calls(server, ConnectionRefusedError(),
+            ConnectionRefusedError(), 2)
+
+        self.assertEqual(server.execute(), 2)
+        server.ensureStarted.assert_called_once_with()
+
+    def test_jasper_server_execute_fault(self):
+        'Test other faults of the process are raised'
+        server = JasperServer()
+        server_calls(server, Fault(1, 'error'))
+
+        with self.assertRaises(Fault):
+            server.execute()
+
+    def test_jasper_server_ensure_started(self):
+        'Test the process is only started if it is not running'
+        with tempfile.TemporaryDirectory() as directory:
+            server = self.jasper_server(directory)
+            # Left by a crashed process and reused by another one
+            with open(server.pidfile, 'w') as f:
+                f.write(str(os.getpid()))
+            server.isReady = Mock(return_value=True)
+
+            server.ensureStarted()
+            server.start.assert_not_called()
+
+            server.isReady.return_value = False
+            server.ensureStarted()
+            server.start.assert_called_once_with()
+
+    @patch.dict(JasperServer.binaryProxies)
+    def test_jasper_server_binary_call(self):
+        'Test calls go through the binary transport when it is served'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jasper.sock')
+            rpc = BinaryRpcServer(path, [[0, 3], [1, 1, 'error']])
+            server = JasperServer(socketPath=path)
+            server.proxy = Mock()
+
+            self.assertIs(JasperServer(socketPath=path).binaryProxy,
+                server.binaryProxy)
+            self.assertEqual(server.call('execute', 'report'), 3)
+            # Faults are not sent again through XML-RPC
+            with self.assertRaises(Fault):
+                server.call('stats')
+            rpc.thread.join(10)
+            server.binaryProxy.close()
+
+        self.assertEqual(rpc.requests, [['Report.execute', ['report']],
+                ['Report.stats', []]])
+        server.proxy.Report.execute.assert_not_called()
+        server.proxy.Report.stats.assert_not_called()
+
+    @patch.dict(JasperServer.binaryProxies)
+    def test_jasper_server_binary_fallback(self):
+        'Test calls go through XML-RPC if the binary transport is not served'
+        with tempfile.TemporaryDirectory() as directory:
+            server = JasperServer(socketPath=os.path.join(directory,
+                    'jasper.sock'))
+            server.proxy = Mock()
+            server.proxy.Report.execute.return_value = 2
+
+            self.assertEqual(server.call('execute', 'report'), 2)
+            # Left by a process that does not listen on it
+            with socket.socket(socket.AF_UNIX) as listener:
+                listener.bind(server.socketPath)
+                self.assertEqual(server.call('execute', 'report'), 2)
+
+        server.proxy.Report.execute.assert_called_with('report')
+        self.assertEqual(server.proxy.Report.execute.call_count, 2)
+
+    def test_binary_rpc_proxy_reconnect(self):
+        'Test calls are sent again if the process closed the connection'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jasper.sock')
+            server = BinaryRpcServer(path, [[0, 1]], [[0, 2], [0, 3]])
+            proxy = BinaryRpcProxy(path)
+
+            self.assertEqual(proxy.Report.stats(), 1)
+            # Closed by the process to make room for another connection
+            self.assertEqual(proxy.Report.stats(), 2)
+            self.assertEqual(proxy.Report.execute(1, 'a'), 3)
+            server.thread.join(10)
+            proxy.close()
+
+        self.assertEqual(server.requests, [['Report.stats', []],
+                ['Report.stats', []], ['Report.execute', [1, 'a']]])
+
+    def test_binary_rpc_proxy_fault(self):
+        'Test faults of the process are raised and new connections not resent'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jasper.sock')
+            server = BinaryRpcServer(path, [[1, RETRY_LATER, 'overloaded']],
+                [])
+            proxy = BinaryRpcProxy(path)
+
+            with self.assertRaises(Fault) as cm:
+                proxy.Report.stats()
+            with self.assertRaises(socket.error):
+                proxy.Report.stats()
+            server.thread.join(10)
+
+        self.assertEqual(cm.exception.faultCode, RETRY_LATER)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_workspace_quota(self):
+        'Test the quota counts the files written to the workspace'
+        with tempfile.TemporaryDirectory() as root:
+            with Workspace(root, quota=10) as workspace:
+                first = workspace.file()
+                with open(first, 'wb') as f:
+                    f.write(b'12345')
+                workspace.checkQuota(first)
+                second = workspace.file()
+                with open(second, 'wb') as f:
+                    f.write(b'12345')
+                workspace.checkQuota(second)
+                # Only the files being written are read again
+                with open(first, 'ab') as f:
+                    f.write(b'6')
+                workspace.checkQuota(second)
+                self.assertEqual(workspace.used, 10)
+
+                with self.assertRaises(WorkspaceQuotaExceeded):
+                    workspace.checkQuota(first)
+                with self.assertRaises(WorkspaceQuotaExceeded):
+                    workspace.file()
+                path = workspace.path
+
+            self.assertEqual(os.listdir(root), [])
+        self.assertFalse(os.path.exists(path))
+
+    def test_workspace_generator_quota(self):
+        'Test data generators stop once the quota is exceeded'
+        with tempfile.TemporaryDirectory() as root:
+            workspace = Workspace(root, quota=1000)
+            report = jasper_report('name')
+            generator = CsvRecordDataGenerator(report,
+                ({'name': 'x' * 100} for _ in range(100000)),
+                workspace=workspace)
+
+            with self.assertRaises(WorkspaceQuotaExceeded):
+                generator.generate(workspace.file())
+            self.assertLess(generator.rowCount, 100000)
+            workspace.cleanup()
+
+    def test_workspace_sweep(self):
+        'Test sweep removes the workspaces of dead processes and old ones'
+        with tempfile.TemporaryDirectory() as root:
+            process = subprocess.Popen(['true'])
+            process.wait()
+            now = int(time.time())
+            names = {
+                'dead': 'jasper-%d-%d-x' % (process.pid, now),
+                'old': 'jasper-%d-%d-x' % (os.getpid(), now - 100),
+                'running': 'jasper-%d-%d-x' % (os.getpid(), now),
+                'other': 'other-%d-%d-x' % (process.pid, now),
+                }
+            for name in names.values():
+                os.mkdir(os.path.join(root, name))
+
+            with patch.object(Workspace, 'lastSweep', 0):
+                Workspace.sweep(root, maxAge=50)
+                # Not swept again before SWEEP_INTERVAL
+                os.mkdir(os.path.join(root, names['dead']))
+                Workspace.sweep(root, maxAge=50)
+            remaining = sorted(os.listdir(root))
+
+        self.assertEqual(remaining, sorted([names['dead'], names['running'],
+                    names['other']]))
+
+    def test_admission_interactive_first(self):
+        'Test waiting interactive executions are admitted before batch ones'
+        controller = AdmissionController(limit=1)
+        admitted = []
+        priority = controller.acquire(BATCH)
+        batch = start_thread(admit, controller, BATCH, admitted)
+        self.assertTrue(wait_until(
+                lambda: controller.queueDepth()['waiting'][BATCH]))
+        interactive = start_thread(admit, controller, INTERACTIVE, admitted)
+        self.assertTrue(wait_until(
+                lambda: controller.queueDepth()['waiting'][INTERACTIVE]))
+
+        controller.release(priority)
+        batch.join(10)
+        interactive.join(10)
+
+        self.assertEqual(admitted, [INTERACTIVE, BATCH])
+
+    def test_admission_batch_limit(self):
+        'Test batch executions are limited but not interactive ones'
+        controller = AdmissionController(limit=3, batchLimit=1)
+        admitted = []
+        priority = controller.acquire(BATCH)
+        batch = start_thread(admit, controller, BATCH, admitted)
+        self.assertTrue(wait_until(
+                lambda: controller.queueDepth()['waiting'][BATCH]))
+
+        with controller.slot(INTERACTIVE):
+            self.assertEqual(controller.queueDepth(), {
+                    'waiting': {INTERACTIVE: 0, BATCH: 1},
+                    'active': {INTERACTIVE: 1, BATCH: 1},
+                    })
+        self.assertEqual(admitted, [])
+        controller.release(priority)
+        batch.join(10)
+
+        self.assertEqual(admitted, [BATCH])
+
+    def test_admission_release_on_error(self):
+        'Test the slot of a failed execution is released'
+        controller = AdmissionController(limit=1)
+
+        with self.assertRaises(ValueError):
+            with controller.slot(BATCH):
+                raise ValueError
+        with controller.slot('unknown'):
+            depth = controller.queueDepth()
+
+        self.assertEqual(depth['active'], {INTERACTIVE: 1, BATCH: 0})
+        self.assertEqual(controller.queueDepth()['active'],
+            {INTERACTIVE: 0, BATCH: 0})
+
+    @with_transaction()
+    def test_render_key_context(self):
+        'Test renders are only shared within the same context'
+        report = Mock(id=1, extension='pdf')
+
+        def render_key():
+            return jasper.JasperReport.render_key(report, {}, 'res.user',
+                [1])
+
+        with patch.object(jasper, 'COALESCE', 'process'):
+            key = render_key()
+            with Transaction().set_context(company=1):
+                company1 = render_key()
+                self.assertEqual(render_key(), company1)
+            with Transaction().set_context(company=2):
+                company2 = render_key()
+
+        self.assertIsNotNone(key)
+        self.assertEqual(len({key, company1, company2}), 3)
+
+    def test_render_coalescer_follower(self):
+        'Test an identical render waits for the running one and shares it'
+        coalescer = RenderCoalescer()
+        renders = CoalescedRenders()
+
+        renders.leader_and_follower(coalescer, coalescer)
+
+        self.assertEqual(renders.calls, ['leader'])
+        self.assertEqual(renders.results, {
+                'leader': ('pdf', b'leader', 1),
+                'follower': ('pdf', b'leader', 1),
+                })
+        self.assertEqual(coalescer.flights, {})
+
+    def test_render_coalescer_leader_failure(self):
+        'Test an identical render renders itself if the running one fails'
+        coalescer = RenderCoalescer()
+        renders = CoalescedRenders(failing=['leader'])
+
+        renders.leader_and_follower(coalescer, coalescer)
+
+        self.assertEqual(renders.calls, ['leader', 'follower'])
+        self.assertIsInstance(renders.results['leader'], ValueError)
+        self.assertEqual(renders.results['follower'],
+            ('pdf', b'follower', 1))
+        self.assertEqual(coalescer.flights, {})
+
+    def test_render_coalescer_host(self):
+        'Test identical renders of other processes share the output file'
+        with tempfile.TemporaryDirectory() as directory:
+            renders = CoalescedRenders()
+
+            # Each process has its own coalescer
+            renders.leader_and_follower(RenderCoalescer(directory),
+                RenderCoalescer(directory))
+
+            self.assertEqual(renders.calls, ['leader'])
+            self.assertEqual(renders.results['follower'],
+                ('pdf', b'leader', 1))
+
+    def test_render_coalescer_host_leader_failure(self):
+        'Test renders of other processes render if the running one fails'
+        with tempfile.TemporaryDirectory() as directory:
+            renders = CoalescedRenders(failing=['leader'])
+
+            renders.leader_and_follower(RenderCoalescer(directory),
+                RenderCoalescer(directory))
+
+            self.assertEqual(renders.calls, ['leader', 'follower'])
+            self.assertEqual(renders.results['follower'],
+                ('pdf', b'follower', 1))
+
+    def test_render_coalescer_expired(self):
+        'Test expired outputs and lock files are removed unless locked'
+        with tempfile.TemporaryDirectory() as directory:
+            coalescer = RenderCoalescer(directory)
+            held, _ = RenderCoalescer(directory).acquire('held')
+            expired = time.time() - OUTPUT_TTL - 1
+            for name in ['old.out', 'old.tmp', 'old.lock', 'new.out',
+                    'held.lock', 'other']:
+                path = os.path.join(directory, name)
+                with open(path, 'a'):
+                    pass
+                if name != 'new.out':
+                    os.utime(path, (expired, expired))
+
+            coalescer.removeExpired()
+            held.close()
+
+            self.assertEqual(sorted(os.listdir(directory)),
+                ['held.lock', 'new.out', 'other'])
+
+    def test_render_coalescer_output(self):
+        'Test only outputs written since the render started are shared'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'key')
+            start = time.time()
+            RenderCoalescer.writeOutput(path, ('pdf', b'data\n', 2))
+
+            self.assertEqual(RenderCoalescer.readOutput(path, start),
+                ('pdf', b'data\n', 2))
+            os.utime(path + '.out', (start - 1, start - 1))
+            self.assertIsNone(RenderCoalescer.readOutput(path, start))
+
+    def test_binary_codec_round_trip(self):
+        'Test values written by BinaryDataWriter are decoded unchanged'
+        values = [
+            None, '', 'Caf\xe9 \u20ac', True, False, 0, -1, 2 ** 63 - 1,
+            -2 ** 63, 2 ** 64, 1.5, -0.25, Decimal('1.230'),
+            Decimal('-0.001'), Decimal('0'), Decimal('1E+3'),
+            datetime.date(2024, 2, 29),
+            datetime.datetime(2024, 2, 29, 23, 59, 58, 123456),
+            {'en': 'Name', 'ca': None}, [1, 'a', [None, 2.5]],
+            ]
+        output = BytesIO()
+        writer = BinaryDataWriter(output, ['value', 'other'])
+        writer.writerows({'value': v} for v in values)
+        writer.close()
+
+        names, rows = read_binary(output.getvalue())
+
+        self.assertEqual(names, ['value', 'other'])
+        self.assertEqual([r['value'] for r in rows], values)
+        self.assertEqual([type(r['value']) for r in rows[:9]],
+            [type(v) for v in values[:9]])
+        self.assertEqual(rows[9]['value'], Decimal(2 ** 64))
+        self.assertEqual(str(rows[12]['value']), '1.230')
+        self.assertEqual(set(r['other'] for r in rows), {None})
+
+    def test_binary_codec_special_values(self):
+        'Test values without a native encoding are written as text'
+        output = BytesIO()
+        writer = BinaryDataWriter(output, ['value'])
+        writer.writerows([
+                {'value': Decimal('NaN')},
+                {'value': datetime.timedelta(hours=1)},
+                ])
+        writer.close()
+
+        _, rows = read_binary(output.getvalue())
+
+        self.assertEqual([r['value'] for r in rows], ['NaN', '1:00:00'])
+
+    def test_xml_data_writer(self):
+        'Test XmlDataWriter nests the values following the fields'
+        report = jasper_report('name', 'party/name', 'party/active',
+            'date', 'amount', 'translated')
+        output = BytesIO()
+        writer = XmlDataWriter(output, report)
+        writer.writerows([{
+                    'name': 'A & B',
+                    'party_name': 'Party',
+                    'party_active': True,
+                    'date': datetime.date(2024, 1, 2),
+                    'amount': 1.5,
+                    'translated': {'en': 'Yes', 'ca': None},
+                    'unknown': 'x',
+                    }, {
+                    'name': None,
+                    'amount': Decimal('2.50'),
+                    }])
+        writer.close()
+
+        data = etree.fromstring(output.getvalue())
+        first, second = data.findall('record')
+        self.assertEqual(first.findtext('name'), 'A & B')
+        self.assertEqual(first.findtext('party/name'), 'Party')
+        self.assertEqual(first.findtext('party/active'), 'true')
+        self.assertEqual(len(first.findall('party')), 1)
+        self.assertEqual(first.findtext('date'), '2024-01-02 00:00:00')
+        self.assertEqual(first.findtext('amount'), '1.5000000000')
+        self.assertEqual(first.findtext('translated'), 'en~Yes|ca~')
+        self.assertIsNone(first.find('unknown'))
+        self.assertEqual(second.findtext('name'), '')
+        self.assertEqual(second.findtext('party/name'), '')
+        self.assertEqual(second.findtext('amount'), '2.50')
+
+    def test_xml_data_writer_records(self):
+        'Test the field descriptions find the values of each record'
+        report = jasper_report('number', 'party/name', 'amount')
+        for path in ['number', 'party/name']:
+            report._fields[path]['description'] = '/data/record/' + path
+        records = [
+            {'number': '1', 'party/name': 'P1', 'amount': Decimal('1.5')},
+            {'number': '2', 'party/name': None, 'amount': None},
+            {'number': '3', 'party/name': 'P3'},
+            ]
+
+        generator = XmlRecordDataGenerator(report, records)
+        data = etree.fromstring(generate(generator))
+
+        # As XmlMultiLanguageDataSource evaluates them, relative to the
+        # record
+        values = []
+        for record in data.xpath('/data/record'):
+            row = {}
+            for path, field in report.fields().items():
+                description = field['description']
+                if description.startswith('/data/record/'):
+                    description = description[len('/data/record/'):]
+                nodes = record.xpath(description)
+                self.assertEqual(len(nodes), 1)
+                row[path] = nodes[0].text or ''
+            values.append(row)
+        self.assertEqual(values, [
+                {'number': '1', 'party/name': 'P1', 'amount': '1.5'},
+                {'number': '2', 'party/name': '', 'amount': ''},
+                {'number': '3', 'party/name': 'P3', 'amount': ''},
+                ])
+
+    @with_transaction()
+    def test_jasper_report_preview_pages(self):
+        'Test the pages of a preview are taken from the data or the context'
+        preview_pages = jasper.JasperReport.preview_pages
+
+        self.assertEqual(preview_pages({}), 0)
+        self.assertEqual(preview_pages({'preview': True}), 1)
+        self.assertEqual(preview_pages({'preview': '3'}), 3)
+        self.assertEqual(preview_pages({'preview': 'all'}), 0)
+        self.assertEqual(preview_pages({'preview': -1}), 0)
+        with Transaction().set_context(jasper_preview=2):
+            self.assertEqual(preview_pages({}), 2)
+            self.assertEqual(preview_pages({'preview': False}), 0)
+
+    def test_jasper_report_estimate_pages(self):
+        'Test the pages of the whole report are estimated from a preview'
+        estimate_pages = jasper.JasperReport.estimate_pages
+        report = jasper_report('name')
+        records = [{'name': 'Row %d' % i} for i in range(100)]
+        generator = CsvRecordDataGenerator(report, records, maxRows=10)
+        generate(generator)
+
+        # From the ids filled
+        self.assertEqual(estimate_pages(2, list(range(50)), list(range(20))),
+            5)
+        self.assertEqual(estimate_pages(2, [1, 2], [1, 2]), 2)
+        # From the rows of the records given by the parser
+        self.assertEqual(generator.rowCount, 10)
+        self.assertEqual(estimate_pages(3, [1], [1], generator), 30)
+        # Unless their number is unknown
+        generator.records = iter(records)
+        self.assertEqual(estimate_pages(3, [1, 2], [1], generator), 6)
+
+    @with_transaction()
+    def test_browse_data_generator_preview(self):
+        'Test preview rows of a browsed report and the records filled'
+        pool = Pool()
+        User = pool.get('res.user')
+        users = User.create([
+                {'name': 'User %d' % i, 'login': 'preview%d' % i}
+                for i in range(3)])
+        report = jasper_report('login', 'groups/name')
+        generator = CsvBrowseDataGenerator(report, 'res.user',
+            [u.id for u in users], cache=BrowseDataCache(), maxRows=2)
+
+        rows = list(generator.generateRows())
+
+        self.assertEqual([r['login'] for r in rows],
+            ['preview0', 'preview1'])
+        self.assertEqual(generator.rootCount, 2)
+        self.assertEqual(jasper.JasperReport.estimate_pages(1,
+                [u.id for u in users], [u.id for u in users], generator), 2)
+
+    @with_transaction()
+    def test_browse_data_generator_copies(self):
+        'Test copies and shared related records are serialised once'
+        pool = Pool()
+        User = pool.get('res.user')
+        users = User.create([
+                {'name': 'User 1', 'login': 'user1'},
+                {'name': 'User 2', 'login': 'user2'},
+                ])
+        report = jasper_report('login', 'create_uid/login')
+        # The id of the user gives the number of copies
+        report._copiesField = 'id'
+        generator = CsvBrowseDataGenerator(report, 'res.user',
+            [users[0].id], cache=BrowseDataCache())
+
+        rows = list(generator.generateRows())
+
+        self.assertEqual(len(rows), users[0].id)
+        self.assertTrue(all(r is rows[0] for r in rows))
+        self.assertEqual(rows[0], {
+                'login': 'user1',
+                'create_uid_login': 'admin',
+                })
+
+        generator = CsvBrowseDataGenerator(report, 'res.user',
+            [u.id for u in users], cache=generator.cache)
+        with patch.object(CsvBrowseDataGenerator, 'generateCsvRecord',
+                autospec=True,
+                side_effect=CsvBrowseDataGenerator.generateCsvRecord) as m:
+            list(generator.generateRows())
+        # The create_uid of the first user was serialised by the first
+        # generator and both users share it
+        paths = [c.args[4] for c in m.call_args_list]
+        self.assertEqual(paths, ['', ''])
+
+    def test_record_data_generator_columns(self):
+        'Test record generators read tuples of columns from a generator'
+        report = jasper_report('name', 'amount')
+
+        def records():
+            yield ('A', 1, 'ignored')
+            yield ('B', None, 'ignored')
+            yield ('C', 3.5, 'ignored')
+
+        generator = CsvRecordDataGenerator(report, records(),
+            columns=['name', 'amount', 'unknown'])
+        output = generate(generator).decode('utf-8')
+
+        self.assertEqual(list(csv.reader(StringIO(output))), [
+                ['name', 'amount', ''],
+                ['A', '1', ''],
+                ['B', '', ''],
+                ['C', '3.5000000000', ''],
+                ])
+        self.assertEqual(generator.rowCount, 3)
+
+    def test_binary_record_data_generator(self):
+        'Test binary record generator keeps the types of the values'
+        report = jasper_report('name', 'amount',
+            types={'amount': 'java.math.BigDecimal'})
+        records = ({'name': n, 'amount': Decimal(n)} for n in '123')
+
+        generator = BinaryRecordDataGenerator(report, records, maxRows=2)
+        names, rows = read_binary(generate(generator))
+
+        self.assertEqual(names, ['name', 'amount'])
+        self.assertEqual(rows, [
+                {'name': '1', 'amount': Decimal(1)},
+                {'name': '2', 'amount': Decimal(2)},
+                ])
+        self.assertEqual(generator.rowCount, 2)
+
+    def test_binary_record_data_generator_text(self):
+        'Test binary values of the fields shown as text are the CSV ones'
+        report = jasper_report('string', 'object', 'number',
+            types={
+                'object': 'java.lang.Object',
+                'number': 'java.lang.Double',
+                })
+        values = [True, 1.5, Decimal('2.50'), datetime.date(2024, 1, 2),
+            None, 'en~Yes|ca~Si']
+        records = [{'string': v, 'object': v, 'number': v} for v in values]
+
+        csv_rows = list(CsvRecordDataGenerator(report, records)
+            .generateRows())
+        binary_rows = list(BinaryRecordDataGenerator(report, records)
+            .generateRows())
+
+        for csv_row, binary_row, value in zip(
+                csv_rows, binary_rows, values):
+            self.assertEqual(binary_row['string'], csv_row['string'])
+            self.assertEqual(binary_row['object'], csv_row['object'])
+            self.assertIs(binary_row['number'], value)
+        self.assertEqual([r['string'] for r in binary_rows],
+            ['True', '1.5000000000', '2.50', '2024-01-02', '',
+                'en~Yes|ca~Si'])
+
+    @with_transaction()
+    def test_binary_browse_data_generator_text(self):
+        'Test binary values of the fields shown as text are the CSV ones'
+        pool = Pool()
+        User = pool.get('res.user')
+        user, = User.create([{'name': 'User', 'login': 'user'}])
+        report = jasper_report('login', 'active', 'id', 'name',
+            'create_uid/active', 'create_date',
+            types={
+                'id': 'java.lang.Object',
+                'name': 'java.lang.Object',
+                'create_uid/active': 'java.lang.Boolean',
+                'create_date': 'java.util.Date',
+                })
+
+        csv_row, = CsvBrowseDataGenerator(report, 'res.user', [user.id],
+            cache=BrowseDataCache()).generateRows()
+        binary_row, = BinaryBrowseDataGenerator(report, 'res.user',
+            [user.id], cache=BrowseDataCache()).generateRows()
+
+        for name in ['login', 'active', 'id', 'name']:
+            self.assertEqual(binary_row[name], csv_row[name])
+        self.assertEqual(binary_row['active'], str(user.active))
+        self.assertEqual(binary_row['name'], 'en~User')
+        self.assertEqual(binary_row['create_uid_active'],
+            user.create_uid.active)
+        self.assertEqual(binary_row['create_date'], user.create_date)
+
+    def test_xml_record_data_generator_columns(self):
+        'Test XML record generator with tuples of columns'
+        report = jasper_report('name', 'party/name')
+
+        generator = XmlRecordDataGenerator(report,
+            iter([('A', 'P1'), ('B', None)]), columns=['name', 'party/name'])
+        data = etree.fromstring(generate(generator))
+
+        self.assertEqual([r.findtext('name') for r in data], ['A', 'B'])
+        self.assertEqual([r.findtext('party/name') for r in data],
+            ['P1', ''])
+
+    @with_transaction()
+    def test_browse_data_generator_join(self):
+        'Test the rows of the join are the ones of the dict-copy join'
+        pool = Pool()
+        User = pool.get('res.user')
+        Group = pool.get('res.group')
+        group1, group2, group3 = Group.create([
+                {'name': 'Group 1'}, {'name': 'Group 2'}, {'name': 'Group 3'},
+                ])
+        users = User.create([{
+                    'name': 'User 1',
+                    'login': 'user1',
+                    'groups': [('add', [group1.id, group2.id])],
+                    }, {
+                    'name': 'User 2',
+                    'login': 'user2',
+                    'groups': [('add', [group1.id, group3.id])],
+                    }, {
+                    'name': 'User 3',
+                    'login': 'user3',
+                    }])
+        ids = [u.id for u in users]
+        report = jasper_report('login', 'groups/name', 'groups/users/login',
+            'create_uid/login', relations=['groups', 'groups/users'])
+
+        rows = list(CsvBrowseDataGenerator(report, 'res.user', ids,
+                cache=BrowseDataCache()).generateRows())
+        expected = list(DictJoinGenerator(report, 'res.user', ids,
+                cache=BrowseDataCache()).generateRows())
+
+        self.assertEqual(rows, expected)
+        self.assertEqual(len(rows), 7)
+        self.assertIn({
+                'login': 'user2',
+                'groups_name': 'Group 1',
+                'groups_users_login': 'user1',
+                'create_uid_login': 'admin',
+                }, rows)
+        self.assertIn({
+                'login': 'user3',
+                'create_uid_login': 'admin',
+                }, rows)
+
+    def test_jasper_report_parser(self):
+        'Test the fields, relations and subreports of the fixture reports'
+        report = JasperReport(os.path.join(FIXTURES, 'parser_main.jrxml'))
+
+        self.assertEqual(report.language(), 'xpath')
+        self.assertEqual(report.copiesField(), 'copies')
+        self.assertEqual(report.relations(), ['lines', 'taxes'])
+        self.assertEqual(report.fields(), {
+                'number': {
+                    'name': 'number',
+                    'type': 'java.lang.String',
+                    'description': '/data/record/number',
+                    },
+                'party/name': {
+                    'name': 'party_name',
+                    'type': 'java.lang.String',
+                    'description': '/data/record/Tercer-party/Nom-name',
+                    },
+                'party/code': {
+                    'name': 'party_code',
+                    'type': 'java.lang.Object',
+                    'description': 'party/code',
+                    },
+                'total_amount': {
+                    'name': 'total',
+                    'type': 'java.math.BigDecimal',
+                    'description': 'total_amount',
+                    },
+                })
+        lines = {
+            'lines/product/name': 'product',
+            'lines/quantity': 'quantity',
+            }
+        taxes = {
+            'lines/tax/name': 'tax',
+            'lines/amount': 'amount',
+            }
+        self.assertEqual(subreport_infos(report), [{
+                    'parameter': 'LINES',
+                    'filename': 'parser_lines.jrxml',
+                    'model': 'sale.line',
+                    'pathPrefix': 'lines',
+                    'depth': 1,
+                    'fields': lines,
+                    'relations': ['lines/taxes'],
+                    }, {
+                    'parameter': 'LINE_TAXES',
+                    'filename': 'parser_taxes.jrxml',
+                    'model': '',
+                    'pathPrefix': '',
+                    'depth': 2,
+                    'fields': taxes,
+                    'relations': ['lines'],
+                    }, {
+                    # The model and the path prefix of a subreport are the
+                    # first ones of the report
+                    'parameter': 'LINES_AGAIN',
+                    'filename': 'parser_lines.jrxml',
+                    'model': 'sale.line',
+                    'pathPrefix': 'lines',
+                    'depth': 1,
+                    'fields': lines,
+                    'relations': ['lines/taxes'],
+                    }, {
+                    'parameter': 'LINE_TAXES',
+                    'filename': 'parser_taxes.jrxml',
+                    'model': '',
+                    'pathPrefix': '',
+                    'depth': 2,
+                    'fields': taxes,
+                    'relations': ['lines'],
+                    }, {
+                    # The reportElement of a list is two levels up
+                    'parameter': 'TAXES',
+                    'filename': 'DATASET',
+                    'model': 'account.tax',
+                    'pathPrefix': 'taxes',
+                    'fields': {
+                        'taxes/name': 'tax_name',
+                        'taxes/amount': 'tax_amount',
+                        },
+                    'relations': ['taxes'],
+                    }, {
+                    # The reportElement of a crosstab is three levels up
+                    'parameter': 'SALES',
+                    'filename': 'DATASET',
+                    'model': '',
+                    'pathPrefix': '',
+                    'fields': {
+                        'lines/product/name': 'product',
+                        'lines/quantity': 'quantity',
+                        },
+                    'relations': ['lines', 'lines/product'],
+                    }])
+        # The main data source is only passed on
+        self.assertEqual(report.rewindsDataSource(), False)
+
+    def stream(self, server, generator):
+        "Return the result of streaming the data of generator to server"
+        with tempfile.TemporaryDirectory() as directory:
+            fifo = os.path.join(directory, 'data')
+            os.mkfifo(fifo, 0o600)
+            return jasper.JasperReport.stream(server, generator, fifo,
+                {'csv': fifo}, 'report.jrxml', 'output', {})
+
+    @unittest.skipUnless(hasattr(os, 'mkfifo'), 'requires named pipes')
+    def test_jasper_report_stream(self):
+        'Test the data is generated while the JasperServer reads it'
+        report = jasper_report('name')
+        generator = CsvRecordDataGenerator(report,
+            ({'name': 'Row %d' % i} for i in range(10000)))
+
+        data = self.stream(FifoServer(), generator)
+
+        self.assertEqual(generator.rowCount, 10000)
+        lines = data.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 10001)
+        self.assertEqual(lines[-1], 'Row 9999,')
+
+    @unittest.skipUnless(hasattr(os, 'mkfifo'), 'requires named pipes')
+    def test_jasper_report_stream_stopped(self):
+        'Test the result is returned if the JasperServer stops reading'
+        report = jasper_report('name')
+        generator = CsvRecordDataGenerator(report,
+            ({'name': 'Row %d' % i} for i in range(1000000)))
+
+        data = self.stream(FifoServer(size=10), generator)
+
+        self.assertEqual(len(data), 10)
+        self.assertLess(generator.rowCount, 1000000)
+
+    @unittest.skipUnless(hasattr(os, 'mkfifo'), 'requires named pipes')
+    def test_jasper_report_stream_error(self):
+        'Test the error of a report failing before reading is raised'
+        report = jasper_report('name')
+        generator = CsvRecordDataGenerator(report, [{'name': 'Row'}])
+
+        with self.assertRaises(ValueError):
+            self.stream(FifoServer(error=ValueError()), generator)
+        self.assertEqual(generator.rowCount, 0)
+
+    def test_jasper_report_rewinds_data_source(self):
+        'Test only reports calling moveFirst on their data source rewind it'
+        template = (
+            '<jasperReport xmlns="http://jasperreports.sourceforge.net/'
+            'jasperreports" name="rewind"><detail><band height="20">'
+            '<subreport><reportElement x="0" y="0" width="10" height="10"/>'
+            '%s<subreportExpression><![CDATA[$P{SUBREPORT_DIR} + '
+            '"parser_taxes.jasper"]]>'
+            '</subreportExpression></subreport></band></detail>'
+            '</jasperReport>')
+        passed = ('<dataSourceExpression><![CDATA[$P{REPORT_DATA_SOURCE}]]>'
+            '</dataSourceExpression>')
+        rewound = ('<parametersMapExpression><![CDATA[{ '
+            '$P{REPORT_DATA_SOURCE}.moveFirst(); $P{REPORT_PARAMETERS_MAP} '
+            '}()]]></parametersMapExpression>')
+        other = ('<parametersMapExpression><![CDATA[{ $P{LINES}.moveFirst(); '
+            '$P{REPORT_PARAMETERS_MAP} }()]]></parametersMapExpression>')
+
+        for content, rewinds in [
+                (passed, False),
+                (passed + rewound, True),
+                (other, False),
+                ]:
+            with tempfile.NamedTemporaryFile('w', suffix='.jrxml',
+                    dir=FIXTURES) as f:
+                f.write(template % content)
+                f.flush()
+                report = JasperReport(f.name)
+            self.assertEqual(report.rewindsDataSource(), rewinds, content)
+
+    def test_jasper_report_parser_memo(self):
+        'Test each fixture report is parsed once and shared by its uses'
+        with patch.object(JasperReport, 'parse',
+                wraps=JasperReport.parse) as parse:
+            report = JasperReport(os.path.join(FIXTURES, 'parser_main.jrxml'))
+        self.assertEqual(parse.call_count, 3)
+
+        lines1, taxes1, lines2, taxes2 = report.subreports()[:4]
+        self.assertIs(lines1['report'], lines2['report'])
+        self.assertIs(taxes1['report'], taxes2['report'])
+        # Infos of the shared subreports are copied, not updated
+        self.assertEqual(
+            [i['depth'] for i in lines1['report'].subreports()], [1])
+
 
 del ModuleTestCase
@@ -2,7 +2,10 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 import re
-from xml import dom
+import hashlib
+from io import BytesIO
+from lxml import etree
+from trytond.cache import Cache
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
 
@@ -11,29 +14,35 @@ __all__ = [
     'TranslationClean',
     ]
 
+TRANSLATABLE_STRING = re.compile(r'tr *\([^\(]*,[ ]*"([^"]*)"\)')
+
 
 class ReportTranslationSet(metaclass=PoolMeta):
     __name__ = "ir.translation.set"
+    # Strings of each report content, by hash, so unchanged reports are not
+    # parsed again
+    _jasper_strings_cache = Cache('ir.translation.set.jasper_strings',
+        context=False)
+
+    def extract_report_jrxml(self, content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        key = hashlib.sha256(content).hexdigest()
+        strings = self._jasper_strings_cache.get(key)
+        if strings is not None:
+            return list(strings)
 
-    def _translate_jasper_report(self, node):
         strings = []
-        if node.nodeType in (node.CDATA_SECTION_NODE, node.TEXT_NODE):
-            if not (node.parentNode and
-                    node.parentNode.tagName.endswith('Expression')):
-                return []
-            if node.nodeValue:
-                node_strings = re.findall(r'tr *\([^\(]*,[ ]*"([^"]*)"\)',
-                node.nodeValue)
-                strings += [x for x in node_strings if x]
-
-        for child in [x for x in node.childNodes]:
-            strings.extend(self._translate_jasper_report(child))
+        for _, element in etree.iterparse(BytesIO(content), events=('end',),
+                remove_comments=True):
+            if (isinstance(element.tag, str)
+                    and element.tag.endswith('Expression') and element.text):
+                strings += [x for x in
+                    TRANSLATABLE_STRING.findall(element.text) if x]
+            element.clear()
+        self._jasper_strings_cache.set(key, strings)
         return strings
 
-    def extract_report_jrxml(self, content):
-        document = dom.minidom.parseString(content)
-        return self._translate_jasper_report(document)
-
 
 class TranslationClean(metaclass=PoolMeta):
     __name__ = 'ir.translation.clean'